@@ -0,0 +1,427 @@
+'''
+User-defined alert rules on tracked items (command 'alert'). A rule is checked after every batch of item checks: the rules of every server
+are evaluated at once, with numpy, over a columnar snapshot of all the tracked items (one array per column: current price, previous price,
+N-day low, discount, episode/chapter number), so thousands of rules take a few milliseconds.
+
+A rule fires when its condition becomes true, and can only fire again after the condition was false (ex: a target price fires once when the
+price drops under it, not after every check while the price stays low).
+'''
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import asyncio
+import logging
+import re
+import time
+import storage
+import guilds
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# VARIABLES -----------------------------------------------------------------------------------------------------------------
+
+# Kinds of rules and the categories they apply to:
+#   below (price): the price is at or below a target price.
+#   drop (percent): the price dropped by at least this percentage since the previous check.
+#   low (days): the price is lower than every price recorded in the previous N days.
+#   discount: the game is on discount.
+#   above (number): the episode/chapter number is greater than X.
+KINDS = ['below','drop','low','discount','above']
+PRICE_CATEGORIES = ['ygo','pkmn','mtg','physical','digital']
+RULE_CATEGORIES = {'below': PRICE_CATEGORIES, 'drop': PRICE_CATEGORIES, 'low': PRICE_CATEGORIES, 'discount': ['physical','digital'],
+                   'above': ['anime','manga']}
+
+# Longest period (in days) of a 'low' rule.
+MAX_LOW_DAYS = 365
+
+# Seconds to wait after an item check before evaluating the rules, so the checks that are due together are evaluated in one pass.
+BATCH_DELAY = 5
+
+# The snapshot of the tracked items is taken again after this many seconds (see AlertEngine).
+SNAPSHOT_MAX_AGE = 3600
+
+# Changes every time a rule is added or removed, so the alert engine reads the rules again.
+_version = 0
+
+_numbers = re.compile(r'\d+(?:\.\d+)?')
+
+# HELPER FUNCTIONS ----------------------------------------------------------------------------------------------------------
+
+def status_number(status):
+    '''
+    Returns the episode/chapter number of a status (the last number in it, ex: 1050.0 for 'Chapter 1050'), or None if it has no number.
+    '''
+    numbers = _numbers.findall(status or '')
+    return float(numbers[-1]) if numbers else None
+
+def _value(number):
+    # 5.0 -> '5', 12.5 -> '12.5'
+    return str(int(number)) if float(number).is_integer() else str(number)
+
+def describe(kind,value):
+    '''
+    Describes the condition of a rule, ex: 'price at or below 5€'.
+    '''
+    if kind == 'below':
+        return 'price at or below '+_value(value)+'€'
+    if kind == 'drop':
+        return 'price drops by '+_value(value)+'% or more'
+    if kind == 'low':
+        return 'lowest price in '+_value(value)+' days'
+    if kind == 'discount':
+        return 'on discount'
+    return 'episode/chapter above '+_value(value)
+
+# RULE FUNCTIONS ------------------------------------------------------------------------------------------------------------
+
+def add_alert(guild_id,channel_id,category,kind,value,name):
+    '''
+    Saves an alert rule on an item tracked by a server.
+
+            Parameters:
+                    guild_id (int): Server id.
+                    channel_id (int): Channel where the rule was added (its alerts are sent there if the server didn't choose a channel for
+                                      the category, see guilds.set_channel).
+                    category (str): Item category.
+                    kind (str): One of KINDS.
+                    value (str): Target price, percentage, number of days or episode/chapter number ('' for 'discount').
+                    name (str): Item name (as printed by 'list').
+
+            Returns:
+                    msg (str): Log message.
+    '''
+    if kind not in KINDS:
+        return 'Please choose a valid rule between "below", "drop", "low", "discount" or "above".'
+    if category not in RULE_CATEGORIES[kind]:
+        return 'The rule "'+kind+'" only works for '+', '.join(RULE_CATEGORIES[kind])+'.'
+    if kind == 'discount':
+        number = 0.0
+    else:
+        try:
+            number = float(value.replace(',','.').rstrip('€%'))
+        except ValueError:
+            return 'Please write a number after "'+kind+'" (ex: "alert add ygo below 5 Dark Magician").'
+        if number < 0 or (kind == 'drop' and not 0 < number <= 100) or (kind == 'low' and not (number.is_integer() and 1 <= number <= MAX_LOW_DAYS)):
+            return 'Please write a valid number after "'+kind+'" (drop: 1-100%, low: 1-'+str(MAX_LOW_DAYS)+' days).'
+    tracked = {item.lower(): item for item in guilds.items(guild_id,category)}
+    if name.lower() not in tracked:
+        return 'Item name is ambiguous. It should perfectly match the name of an item tracked in this server (see "list '+category+'").'
+    name = tracked[name.lower()]
+    global _version
+    conn = storage.connect()
+    with conn:
+        alert_id = conn.execute('INSERT INTO alerts (GuildID, ChannelID, Category, Name, Kind, Value) VALUES (?, ?, ?, ?, ?, ?)',
+                                (guild_id, channel_id, category, name, kind, number)).lastrowid
+    _version += 1
+    return 'Alert #'+str(alert_id)+' saved: '+name+', '+describe(kind,number)+'.'
+
+def remove_alert(guild_id,alert_id):
+    '''
+    Removes one of a server's alert rules. Returns a log message.
+    '''
+    global _version
+    conn = storage.connect()
+    with conn:
+        cur = conn.execute('DELETE FROM alerts WHERE GuildID = ? AND ID = ?', (guild_id, alert_id))
+    _version += 1
+    if cur.rowcount == 0:
+        return 'There is no alert #'+str(alert_id)+' in this server (see "alert list").'
+    return 'Alert #'+str(alert_id)+' removed.'
+
+def forget(guild_id,category,name):
+    '''
+    Removes a server's alert rules on an item (called when the server stops tracking it). Returns the number of rules removed.
+    '''
+    global _version
+    conn = storage.connect()
+    with conn:
+        cur = conn.execute('DELETE FROM alerts WHERE GuildID = ? AND Category = ? AND Name = ?', (guild_id, category, name))
+    if cur.rowcount:
+        _version += 1
+    return cur.rowcount
+
+def list_alerts(guild_id):
+    '''
+    Lists a server's alert rules.
+
+            Returns:
+                    msg_list (list): One message per rule, ex: '#3 Dark Magician (ygo): price at or below 5€'.
+    '''
+    rows = storage.connect().execute('SELECT * FROM alerts WHERE GuildID = ? ORDER BY ID', (guild_id,))
+    return ['#'+str(row['ID'])+' '+row['Name']+' ('+row['Category']+'): '+describe(row['Kind'],row['Value']) for row in rows]
+
+def count():
+    '''
+    Returns the number of saved alert rules (of every server).
+    '''
+    return storage.connect().execute('SELECT COUNT(*) FROM alerts').fetchone()[0]
+
+# EVALUATION FUNCTIONS ------------------------------------------------------------------------------------------------------
+
+def snapshot(low_days=()):
+    '''
+    Columnar snapshot of every tracked item, read from the tracking tables and the price history.
+
+            Parameters:
+                    low_days (iterable): Periods (in days) of the 'low' rules.
+
+            Returns:
+                    snap (dict): 'index': dictionary (category, name) -> row, 'discount_text': list with the discount of every row ('' if
+                                 none), and one numpy array per column: 'price' (current price), 'previous' (price of the observation
+                                 before the last one), 'discount' (True if on discount), 'number' (episode/chapter number) and 'low'
+                                 (dictionary N -> lowest price in the last N days, without the last observation). Unknown values are NaN. The
+                                 arrays have one more row than there are items: an empty item, for the rules on items that are no longer tracked.
+    '''
+    import numpy as np # Imported on first use, to keep Pheme's startup fast
+    conn = storage.connect()
+    prices = conn.execute('SELECT Category, Name, Lowest_Price FROM prices').fetchall()
+    statuses = conn.execute('SELECT Category, Name, Status FROM statuses').fetchall()
+    index = {}
+    for row in prices + statuses:
+        index.setdefault((row['Category'], row['Name']), len(index))
+    n = len(index)
+    price = np.full(n + 1, np.nan)
+    price[[index[(row['Category'], row['Name'])] for row in prices]] = [row['Lowest_Price'] for row in prices]
+    number = np.full(n + 1, np.nan)
+    numbers = [status_number(row['Status']) for row in statuses]
+    number[[index[(row['Category'], row['Name'])] for row in statuses]] = [np.nan if x is None else x for x in numbers]
+
+    # Last two observations and N-day lows of every item, from its price history
+    low_days = sorted({int(days) for days in low_days})
+    rows = [row for row in storage.observations(max(low_days + [storage.HISTORY_DAYS])) if (row['Category'], row['Name']) in index]
+    item = np.fromiter((index[(row['Category'], row['Name'])] for row in rows), dtype=np.int64, count=len(rows))
+    timestamp = np.fromiter((row['Timestamp'] for row in rows), dtype=np.float64, count=len(rows))
+    observed = np.fromiter((row['Price'] for row in rows), dtype=np.float64, count=len(rows))
+    order = np.lexsort((timestamp, item))
+    (item, timestamp, observed) = (item[order], timestamp[order], observed[order])
+    last = np.flatnonzero(np.append(item[1:] != item[:-1], True)) if len(item) else np.zeros(0, dtype=np.int64)
+    second = last[(last > 0) & (item[np.maximum(last - 1, 0)] == item[last])]
+    previous = np.full(n + 1, np.nan)
+    previous[item[second]] = observed[second - 1]
+    latest = np.full(n + 1, np.inf)
+    latest[item[last]] = timestamp[last]
+    discount_text = [''] * (n + 1)
+    for i in last:
+        discount_text[item[i]] = rows[order[i]]['Discount'] or ''
+    discount = np.array([text != '' for text in discount_text], dtype=bool)
+    low = {}
+    older = timestamp < latest[item]
+    for days in low_days:
+        mask = older & (timestamp >= time.time() - days*86400)
+        lowest = np.full(n + 1, np.inf)
+        np.minimum.at(lowest, item[mask], observed[mask])
+        lowest[np.isinf(lowest)] = np.nan
+        low[days] = lowest
+    return {'index': index, 'price': price, 'previous': previous, 'discount': discount, 'discount_text': discount_text, 'number': number,
+            'low': low}
+
+def update_snapshot(snap,items):
+    '''
+    Reads the latest price/status and price history of some items into a snapshot (see snapshot), in place.
+
+            Parameters:
+                    snap (dict): Snapshot.
+                    items (iterable): Items to read again: (category, name) tuples.
+
+            Returns:
+                    updated (bool): False if one of the items is not in the snapshot (a new snapshot must be taken).
+    '''
+    for (category, name) in items:
+        i = snap['index'].get((category, name))
+        if i is None:
+            return False
+        if category in ['anime','manga']:
+            row = storage.get_status(category,name)
+            number = status_number(row['Status']) if row is not None else None
+            snap['number'][i] = float('nan') if number is None else number
+            continue
+        row = storage.get_price(category,name)
+        rows = [r for r in storage.history(category,name,max(list(snap['low']) + [storage.HISTORY_DAYS])) if r['Price'] is not None]
+        snap['price'][i] = row['Lowest_Price'] if row is not None else float('nan')
+        snap['previous'][i] = rows[-2]['Price'] if len(rows) > 1 else float('nan')
+        snap['discount_text'][i] = (rows[-1]['Discount'] or '') if rows else ''
+        snap['discount'][i] = snap['discount_text'][i] != ''
+        for (days, lowest) in snap['low'].items():
+            since = time.time() - days*86400
+            older = [r['Price'] for r in rows[:-1] if r['Timestamp'] >= since]
+            lowest[i] = min(older) if older else float('nan')
+    return True
+
+def load_rules():
+    '''
+    Reads every alert rule into columns: 'rows' (list of sqlite3.Row) and one numpy array per column ('kind': index in KINDS, 'value',
+    'active').
+    '''
+    import numpy as np # Imported on first use, to keep Pheme's startup fast
+    rows = storage.connect().execute('SELECT ID, GuildID, ChannelID, Category, Name, Kind, Value, Active FROM alerts').fetchall()
+    return {'rows': rows,
+            'kind': np.fromiter((KINDS.index(row['Kind']) for row in rows), dtype=np.int8, count=len(rows)),
+            'value': np.fromiter((row['Value'] for row in rows), dtype=np.float64, count=len(rows)),
+            'active': np.fromiter((row['Active'] for row in rows), dtype=bool, count=len(rows))}
+
+def rule_items(rules,snap):
+    '''
+    Returns a numpy array with the snapshot row of the item of every rule (the empty last row for items that are no longer tracked).
+    '''
+    import numpy as np # Imported on first use, to keep Pheme's startup fast
+    missing = len(snap['index'])
+    return np.fromiter((snap['index'].get((row['Category'], row['Name']), missing) for row in rules['rows']), dtype=np.int64, count=len(rules['rows']))
+
+def match(rules,snap,item):
+    '''
+    Evaluates every rule at once over a snapshot of the tracked items.
+
+            Parameters:
+                    rules (dict): Rules (see load_rules).
+                    snap (dict): Snapshot of the tracked items (see snapshot).
+                    item (numpy.ndarray): Snapshot row of the item of every rule (see rule_items).
+
+            Returns:
+                    matches (numpy.ndarray): True for the rules whose condition is true.
+    '''
+    import numpy as np # Imported on first use, to keep Pheme's startup fast
+    (kind, value) = (rules['kind'], rules['value'])
+
+    # Item columns of every rule, then every condition at once (comparisons with NaN are False)
+    price = snap['price'][item]
+    previous = snap['previous'][item]
+    low = np.full(len(kind), np.nan)
+    for (days, lowest) in snap['low'].items():
+        mask = (kind == KINDS.index('low')) & (value == days)
+        low[mask] = lowest[item[mask]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drop = 100 * (previous - price) / previous
+        matches = np.select([kind == k for k in range(len(KINDS))],
+                            [price <= value, drop >= value, price < low, snap['discount'][item], snap['number'][item] > value], False)
+    return matches
+
+def _message(rule,snap,i):
+    # Notification of a rule that fired (i = row of its item in the snapshot).
+    name = rule['Name']
+    price = snap['price'][i]
+    if rule['Kind'] == 'below':
+        return 'Alert #'+str(rule['ID'])+': the price of '+name+' is '+str(price)+'€ (target: '+_value(rule['Value'])+'€).'
+    if rule['Kind'] == 'drop':
+        previous = snap['previous'][i]
+        return ('Alert #'+str(rule['ID'])+': the price of '+name+' dropped by '+str(round(100 * (previous - price) / previous))+'%, from '
+                +str(previous)+'€ to '+str(price)+'€.')
+    if rule['Kind'] == 'low':
+        return ('Alert #'+str(rule['ID'])+': '+name+' costs '+str(price)+'€, its lowest price in '+_value(rule['Value'])+' days (previous low: '
+                +str(snap['low'][int(rule['Value'])][i])+'€).')
+    if rule['Kind'] == 'discount':
+        return 'Alert #'+str(rule['ID'])+': '+name+' is on discount ('+snap['discount_text'][i]+')!'
+    return 'Alert #'+str(rule['ID'])+': '+name+' reached '+_value(snap['number'][i])+' (above '+_value(rule['Value'])+').'
+
+# ALERT ENGINE --------------------------------------------------------------------------------------------------------------
+
+class AlertEngine:
+    '''
+    Evaluates the alert rules after every batch of item checks. Each check only asks for an evaluation (see request): the evaluation runs
+    BATCH_DELAY seconds later, once for all the checks made in the meantime, in a thread so it never blocks the event loop. The rules and the
+    snapshot of the tracked items stay in memory: only the items checked since the last evaluation are read again, and the snapshot is taken
+    again when the rules change or after SNAPSHOT_MAX_AGE seconds (so the N-day lows follow the calendar).
+
+            Parameters:
+                    delay (float): Seconds to wait for the rest of a batch of checks.
+    '''
+    def __init__(self, delay=BATCH_DELAY):
+        self.delay = delay
+        self.notify = None
+        self.task = None
+        self.requested = None
+        # Rules and snapshot in memory (+ the snapshot row of the item of every rule), the version of the rules they were read for and when
+        # the snapshot was taken
+        self.rules = None
+        self.snap = None
+        self.item = None
+        self.version = None
+        self.taken = 0
+        # Items checked since the last evaluation
+        self.checked = set()
+        # Counters: evaluations, alerts sent, and duration of the last evaluation (in seconds)
+        self.evaluations = 0
+        self.fired = 0
+        self.seconds = 0.0
+
+    def start(self, notify):
+        '''
+        Starts the engine on the running event loop (only once; later calls only replace 'notify'). The rules are evaluated once at startup.
+
+                Parameters:
+                        notify (function): Async function called as notify(messages) with the alerts that fired (see evaluate).
+        '''
+        self.notify = notify
+        if self.task is None:
+            self.requested = asyncio.Event()
+            self.requested.set()
+            self.task = asyncio.ensure_future(self.run())
+
+    def request(self, category=None, name=None):
+        '''
+        Asks for an evaluation of the rules. Called after every item check (with the item), and when a rule is added.
+        '''
+        if name is not None:
+            self.checked.add((category, name))
+        if self.requested is not None:
+            self.requested.set()
+
+    def evaluate(self, checked=()):
+        '''
+        Evaluates every alert rule in one pass (see match), and marks the rules that fired.
+
+                Parameters:
+                        checked (iterable): Items checked since the last evaluation: (category, name) tuples.
+
+                Returns:
+                        messages (dict): Dictionary (server id, category, channel id) -> list of strings with the alerts that fired.
+        '''
+        if self.version != _version:
+            (self.version, self.rules, self.snap) = (_version, load_rules(), None)
+        rules = self.rules
+        if not rules['rows']:
+            return {}
+        if self.snap is None or time.time() - self.taken > SNAPSHOT_MAX_AGE or not update_snapshot(self.snap, checked):
+            # The rules are read again too, in case an item was renamed (see storage._rename_item)
+            rules = self.rules = load_rules()
+            self.snap = snapshot(row['Value'] for row in rules['rows'] if row['Kind'] == 'low')
+            self.item = rule_items(rules, self.snap)
+            self.taken = time.time()
+        matches = match(rules, self.snap, self.item)
+        fired = (matches & ~rules['active']).nonzero()[0]
+        changed = (matches != rules['active']).nonzero()[0]
+        rules['active'] = matches
+
+        messages = {}
+        now = time.time()
+        conn = storage.connect()
+        with conn:
+            conn.executemany('UPDATE alerts SET Active = ? WHERE ID = ?', [(int(matches[r]), rules['rows'][r]['ID']) for r in changed])
+            conn.executemany('UPDATE alerts SET LastFired = ? WHERE ID = ?', [(now, rules['rows'][r]['ID']) for r in fired])
+        for r in fired:
+            rule = rules['rows'][r]
+            messages.setdefault((rule['GuildID'], rule['Category'], rule['ChannelID']),[]).append(_message(rule,self.snap,self.item[r]))
+            metrics.alerts_fired.inc(kind=rule['Kind'])
+        return messages
+
+    async def run(self):
+        while True:
+            await self.requested.wait()
+            await asyncio.sleep(self.delay)
+            self.requested.clear()
+            (checked, self.checked) = (self.checked, set())
+            start = time.perf_counter()
+            try:
+                messages = await asyncio.get_running_loop().run_in_executor(None, self.evaluate, checked)
+            except Exception:
+                logger.exception('Could not evaluate the alert rules')
+                # Start again from the database next time
+                (self.rules, self.snap, self.version) = (None, None, None)
+                continue
+            self.seconds = time.perf_counter() - start
+            self.evaluations += 1
+            metrics.alert_seconds.observe(self.seconds)
+            if messages:
+                self.fired += sum(len(m_list) for m_list in messages.values())
+                await self.notify(messages)
+
+engine = AlertEngine()
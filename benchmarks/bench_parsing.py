@@ -0,0 +1,164 @@
+'''
+Parsing benchmark: compares the original scrapers (a full html.parser tree of every page) with the extractors in parsers.py (lxml backend +
+partial parsing) on saved webpages. It checks that both return exactly the same results and prints the time per page.
+
+Usage:
+        python benchmarks/bench_parsing.py [--pages DIR] [-n REPEAT]
+
+The pages are read from DIR (default: benchmarks/fixtures). Each file name must start with the name of the page type it contains
+(ex: 'steam_search_portal.html'), so saved copies of the live webpages can be dropped into the folder and benchmarked too.
+'''
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import argparse
+import os
+import sys
+import time
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import parsers
+
+# ORIGINAL SCRAPERS (parsing part only, as it was in tracking.py) ----------------------------------------------------------
+
+def legacy_nedgame_search(html):
+    soup = BeautifulSoup(html,'html.parser')
+    products = soup.find_all("div", attrs={"class": "productShopHeader"})
+    results = []
+    for p in products:
+        title = p.find('div', attrs={'class':'title'}).text.split("\n\n")[1]
+        url = p.find('div', attrs={'class':'titlewrapper'}).find('a', attrs={'class':'productTitleLink'},href=True)['href']
+        all_prices = p.find('div', attrs={'class':'buy'})
+        (states,prices) = (all_prices.find_all('div', attrs={'class':'staat'}), all_prices.find_all("div", attrs={"class":"currentprice"}))
+        price_info = []
+        for s,pr in zip(states,prices):
+            state = (s.text.replace("Nieuw","New").replace("Gebruikt","Used")+': '+pr.text)
+            price_info.append(state)
+        results.append((title, price_info, url, ''))
+    return results[:5]
+
+def legacy_steam_search(html):
+    soup = BeautifulSoup(html,'html.parser')
+    products = soup.find_all("div", attrs={"class": "responsive_search_name_combined"})
+    results = []
+    for idx,p in enumerate(products):
+        title = p.find("span", attrs={"class": "title"}).text
+        url = soup.find_all("a",attrs={"class": "search_result_row ds_collapse_flag"},href=True)[idx]['href']
+        try:
+            price = p.find("div", attrs={"class": "col search_price responsive_secondrow"}).text.split("\r\n")[1].strip()
+            results.append((title, price, url, ''))
+        except:
+            try:
+                price = p.find("div", attrs={"class": "col search_price discounted responsive_secondrow"}).text.split("\n")[1].strip().split("€")[0]+'€'
+                discount_price = p.find("div", attrs={"class": "col search_price discounted responsive_secondrow"}).text.split("\n")[1].strip().split("€")[1]+'€'
+                results.append((title, price, url, discount_price))
+            except:
+                pass
+    return results[:5]
+
+def legacy_nedgame_product(html):
+    soup = BeautifulSoup(html,'html.parser')
+    title = soup.find('div', attrs={'class':'productTitle show-for-mobile'}).text.split("\n")[1]
+    all_prices = soup.find('div', attrs={'class':'buy'})
+    (states, prices) = (all_prices.find_all('div', attrs={'class':'staat'}),all_prices.find_all('div', attrs={'class':'currentprice'}))
+    price_info = []
+    for s,pr in zip(states,prices):
+        state = (s.text.replace("Nieuw","New").replace("Gebruikt","Used")+': '+pr.text)
+        price_info.append(state)
+    return [(title, price_info, 'url', '')]
+
+def legacy_steam_product(html):
+    soup = BeautifulSoup(html,'html.parser')
+    title = soup.find('div', attrs={'class':'apphub_AppName'}).text
+    price = soup.find("div", attrs={"class": "game_purchase_price price"}).text.split("\r\n")[1].replace('\t','')
+    try:
+        discount = soup.find("p", attrs={"class": "game_purchase_discount_countdown"}).text
+        discount_price = soup.find("div", attrs={"class": "discount_final_price"}).text
+    except:
+        discount_price = ''
+    return [(title, price, 'url', discount_price)]
+
+def legacy_cardmarket(html):
+    results = []
+    soup = BeautifulSoup(html,'html.parser')
+    (cardnames,expansions,prices) = (soup.find_all("div", attrs={"class": "col-10 col-md-8 px-2 flex-column align-items-start justify-content-center"}),soup.find_all("div", attrs={"class": "col-icon small"}),soup.find_all("div", attrs={"class": "col-price pr-sm-2"}) )
+    for n,e,p in zip(cardnames,expansions,prices):
+        name = n.text
+        price = p.text
+        if (name != 'Name') and (price != "From"):
+            expansion = str(e).split('title=')[1].split('"')[1]
+            results.append((name,expansion,price))
+    return results
+
+def legacy_manga_search(html):
+    soup = BeautifulSoup(html,'html.parser')
+    series = soup.find_all("div", attrs={"class": "story_item"})
+    results = []
+    for s in series:
+        title = s.find("h3", attrs={"class": "story_name"}).text.split("\n")[1]
+        chpt = s.find("em", attrs={"class": "story_chapter"}).text.split('\n')[2].strip()
+        results.append((title, chpt))
+    return results
+
+def legacy_anime_search(html):
+    soup = BeautifulSoup(html,'html.parser')
+    series = soup.find_all("div", attrs={"class": "flw-item flw-item-big"})
+    results = []
+    for s in series:
+        title = s.find("h3", attrs={"class": "film-name"}).text.split("\n")[1]
+        ep = s.find("div", attrs={"class": "tick-item tick-eps"}).text
+        results.append((title, ep))
+    return results
+
+# Page type (start of the file name) -> (original scraper, new extractor)
+PAGES = {
+    'nedgame_search': (legacy_nedgame_search, lambda html: parsers.nedgame_search(html,5)),
+    'nedgame_product': (legacy_nedgame_product, lambda html: [parsers.nedgame_product(html,'url')]),
+    'steam_search': (legacy_steam_search, lambda html: parsers.steam_search(html,5)),
+    'steam_product': (legacy_steam_product, lambda html: [parsers.steam_product(html,'url')]),
+    'cardmarket': (legacy_cardmarket, parsers.cardmarket),
+    'manga_search': (legacy_manga_search, parsers.manga_search),
+    'anime_search': (legacy_anime_search, parsers.anime_search),
+}
+
+# BENCHMARK -----------------------------------------------------------------------------------------------------------------
+
+def timeit(function,html,repeat):
+    # Returns the best time (in ms) of 'repeat' runs, and the result of the function.
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(html)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return (best, result)
+
+def main():
+    default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+    arg_parser = argparse.ArgumentParser(description='Compare the original scrapers with parsers.py on saved webpages.')
+    arg_parser.add_argument('--pages', default=default, help='folder with the saved webpages')
+    arg_parser.add_argument('-n', '--repeat', type=int, default=10, help='number of runs per page (the best run is reported)')
+    args = arg_parser.parse_args()
+
+    print('Backend: ' + parsers.PARSER)
+    print('%-32s %10s %10s %10s %8s' % ('page', 'KB', 'old (ms)', 'new (ms)', 'speedup'))
+    (total_old, total_new, mismatches) = (0, 0, 0)
+    for file_name in sorted(os.listdir(args.pages)):
+        page_type = next((p for p in PAGES if file_name.startswith(p)), None)
+        if page_type is None or not file_name.endswith('.html'):
+            continue
+        with open(os.path.join(args.pages, file_name), newline='', encoding='utf-8') as file:
+            html = file.read()
+        (legacy, new) = PAGES[page_type]
+        (old_ms, old_result) = timeit(legacy, html, args.repeat)
+        (new_ms, new_result) = timeit(new, html, args.repeat)
+        same = old_result == new_result
+        mismatches += not same
+        (total_old, total_new) = (total_old + old_ms, total_new + new_ms)
+        print('%-32s %10.0f %10.2f %10.2f %7.1fx%s' % (file_name, len(html)/1024, old_ms, new_ms, old_ms/new_ms, '' if same else '  RESULTS DIFFER'))
+    if total_new:
+        print('%-32s %10s %10.2f %10.2f %7.1fx' % ('total', '', total_old, total_new, total_old/total_new))
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+'''
+Offline benchmark suite for tracking.py. All the websites are replaced by the local stub server (benchmarks/stub_server.py), so the results
+only depend on Pheme's own code (plus the latency/errors injected in the stub).
+
+It measures:
+        - parse/<page>: time (ms) of every extractor in parsers.py on the saved pages;
+        - track/<category>, art/<tcg>: wall time (s), peak memory (MB) and number of requests of one 'track'/'show' command;
+        - price_decrease/<category>, status_change/<category>: the same for a sweep over ITEMS tracked items.
+
+Usage:
+        python benchmarks/run_benchmarks.py [--items 50] [--latency MS] [--jitter MS] [--error-rate FRACTION] [--rate-limits]
+                                            [--output results.json]
+        python benchmarks/run_benchmarks.py --compare old.json new.json [--threshold 10]
+
+--compare prints the difference between two runs and exits with status 1 if any time/memory metric got worse by more than
+'threshold' percent.
+'''
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+import http_client
+import image_cache
+import parsers
+import storage
+import tracking
+from bench_parsing import PAGES, timeit
+from stub_server import StubServer, FIXTURES
+
+# Card names that are on the saved Cardmarket page (a tracked card must match a result exactly).
+CARD_NAMES = ['Dark Magician', 'Dark Magician Girl', 'Dark Magician of Chaos', 'Dark Magician Knight', 'The Dark Magicians',
+              'Dark Magic Attack', 'Dark Magic Curtain', 'Dark Magician Girl the Dragon Knight', 'Magician of Dark Illusion',
+              'Dark Magical Circle', 'Dark Magic Veil', 'Dark Magic Expanded', 'Dark Magic Twin Burst', 'Dark Magician the Dragon Knight',
+              'Dark Magic Inheritance']
+
+# Metrics where a bigger value is worse (used by --compare).
+COSTS = ('ms', 'seconds', 'peak_mb', 'requests')
+
+# SETUP ---------------------------------------------------------------------------------------------------------------------
+
+def fresh_database(folder,name):
+    # Points storage.py to a new, empty database file (and image_cache.py to a new, empty folder).
+    storage.DB_PATH = os.path.join(folder, name + '.db')
+    image_cache.CACHE_DIR = os.path.join(folder, name + '_images')
+    image_cache._urls.clear()
+    storage._local = threading.local()
+    storage._initialized = False
+
+def seed(category,items):
+    # Fills the database with 'items' tracked items of a category, all with a price/status higher than the saved pages.
+    for i in range(items):
+        if category == 'digital':
+            row = {'Name': 'Game ' + str(i), 'Lowest_Price': 99.0, 'Expansion': '', 'URL': 'https://store.steampowered.com/app/' + str(1000+i) + '/Game/'}
+        elif category == 'physical':
+            row = {'Name': 'Game ' + str(i), 'Lowest_Price': 99.0, 'Expansion': '', 'URL': 'https://www.nedgame.nl/switch/game-' + str(i) + '/' + str(i) + '/'}
+        elif category in ['ygo', 'pkmn', 'mtg']:
+            if i >= len(CARD_NAMES):
+                break
+            row = {'Name': CARD_NAMES[i], 'Lowest_Price': 99.0, 'Expansion': 'X', 'URL': ''}
+        else:
+            row = {'Name': 'Series ' + str(i), 'Status': 'Ep 0'}
+        row.update({'Category': category, 'DateChecked': '01/01/2022, 00:00:00'})
+        if 'Status' in row:
+            storage.upsert_status(row)
+        else:
+            storage.upsert_price(row)
+
+# MEASUREMENTS --------------------------------------------------------------------------------------------------------------
+
+async def measure(name,setup,run,stub,folder):
+    '''
+    Runs a scenario twice: once to measure its wall time and once (under tracemalloc) to measure its peak memory. The database and the
+    response cache are reset before each run.
+
+            Returns:
+                    result (dict): seconds, peak_mb, requests, errors failed (+ messages for the sweeps).
+    '''
+    result = {}
+    for traced in (False, True):
+        fresh_database(folder, name.replace('/', '_') + ('_mem' if traced else ''))
+        setup()
+        http_client.cache = http_client.ResponseCache(http_client.CACHE_MAX_BYTES)
+        requests_before = sum(stub.requests.values())
+        errors_before = stub.errors
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            output = await run()
+        except Exception as error:
+            # Scrapers may fail when errors are injected: the scenario is still measured.
+            output = error
+        elapsed = time.perf_counter() - start
+        if traced:
+            result['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+            tracemalloc.stop()
+        else:
+            result['seconds'] = round(elapsed, 4)
+            result['requests'] = sum(stub.requests.values()) - requests_before
+            result['errors'] = stub.errors - errors_before
+            result['failed'] = isinstance(output, Exception)
+            if isinstance(output, list):
+                # Sweeps: number of notification messages
+                result['messages'] = len(output)
+    return result
+
+def parse_benchmarks(repeat):
+    results = {}
+    for file_name in sorted(os.listdir(FIXTURES)):
+        page_type = next((p for p in PAGES if file_name.startswith(p)), None)
+        if page_type is None:
+            continue
+        with open(os.path.join(FIXTURES, file_name), newline='', encoding='utf-8') as file:
+            html = file.read()
+        (ms, _) = timeit(PAGES[page_type][1], html, repeat)
+        results['parse/' + file_name.rsplit('.', 1)[0]] = {'ms': round(ms, 3)}
+    return results
+
+async def end_to_end_benchmarks(stub,items,folder):
+    results = {}
+    nothing = lambda: None
+    scenarios = [
+        ('track/physical', nothing, lambda: tracking.track_async('physical', 'zelda', 1)),
+        ('track/digital', nothing, lambda: tracking.track_async('digital', 'portal', 1)),
+        ('track/ygo', nothing, lambda: tracking.track_async('ygo', 'Dark Magician', 1)),
+        ('track/anime', nothing, lambda: tracking.track_async('anime', 'one piece', 1)),
+        ('track/manga', nothing, lambda: tracking.track_async('manga', 'one piece', 1)),
+        ('art/mtg', nothing, lambda: tracking.mtg_art_async('lightning bolt')),
+        ('art/ygo', nothing, lambda: tracking.ygo_art_async('Dark Magician')),
+    ]
+    for category in ['physical', 'digital', 'ygo']:
+        scenarios.append(('price_decrease/' + category, lambda c=category: seed(c, items), lambda c=category: tracking.price_decrease_async(c)))
+    for category in ['anime', 'manga']:
+        scenarios.append(('status_change/' + category, lambda c=category: seed(c, items), lambda c=category: tracking.status_change_async(c)))
+
+    for (name, setup, run) in scenarios:
+        results[name] = await measure(name, setup, run, stub, folder)
+        print('%-26s %8.3fs %8.2f MB %5d requests %3d errors %5s messages' % (name, results[name]['seconds'], results[name]['peak_mb'],
+              results[name]['requests'], results[name]['errors'], results[name].get('messages', '-')))
+    await http_client.close_session()
+    return results
+
+# COMPARE -------------------------------------------------------------------------------------------------------------------
+
+def compare(old_file,new_file,threshold):
+    '''
+    Prints the difference between two benchmark runs. Returns the number of regressions (time/memory metrics that got worse by more than
+    'threshold' percent).
+    '''
+    with open(old_file) as file:
+        old = json.load(file)['results']
+    with open(new_file) as file:
+        new = json.load(file)['results']
+    regressions = 0
+    print('%-34s %-8s %12s %12s %9s' % ('benchmark', 'metric', 'old', 'new', 'change'))
+    for name in sorted(set(old) & set(new)):
+        for metric in COSTS:
+            if metric not in old[name] or metric not in new[name]:
+                continue
+            (a, b) = (old[name][metric], new[name][metric])
+            change = ((b - a) / a * 100) if a else 0.0
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            print('%-34s %-8s %12s %12s %8.1f%%%s' % (name, metric, a, b, change, flag))
+    for name in sorted(set(old) ^ set(new)):
+        print('%-34s only in %s' % (name, old_file if name in old else new_file))
+    return regressions
+
+# MAIN ----------------------------------------------------------------------------------------------------------------------
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Offline benchmarks of tracking.py against a local stub server.')
+    arg_parser.add_argument('--items', type=int, default=50, help='tracked items per category in the sweep benchmarks')
+    arg_parser.add_argument('--repeat', type=int, default=10, help='runs per page in the parse benchmarks (the best run is reported)')
+    arg_parser.add_argument('--latency', type=float, default=0, help='delay added by the stub server to every response (ms)')
+    arg_parser.add_argument('--jitter', type=float, default=0, help='random extra delay added by the stub server (ms)')
+    arg_parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests the stub server answers with HTTP 500')
+    arg_parser.add_argument('--rate-limits', action='store_true', help='keep the per-host rate limits of http_client.py')
+    arg_parser.add_argument('--output', help='save the results to this JSON file')
+    arg_parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved runs instead of running the benchmarks')
+    arg_parser.add_argument('--threshold', type=float, default=10, help='regression threshold for --compare (percent)')
+    args = arg_parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    if not args.rate_limits:
+        http_client._buckets.clear()
+    stub = StubServer(port=0, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    http_client.REDIRECT = stub.start_in_thread()
+
+    print('Parser backend: ' + parsers.PARSER)
+    results = parse_benchmarks(args.repeat)
+    for (name, result) in results.items():
+        print('%-40s %8.2f ms' % (name, result['ms']))
+    with tempfile.TemporaryDirectory() as folder:
+        results.update(asyncio.run(end_to_end_benchmarks(stub, args.items, folder)))
+    stub.stop_thread()
+
+    if args.output:
+        meta = {'date': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(), 'parser': parsers.PARSER,
+                'items': args.items, 'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+                'rate_limits': args.rate_limits, 'sweep_concurrency': tracking.SWEEP_CONCURRENCY}
+        with open(args.output, 'w') as file:
+            json.dump({'meta': meta, 'results': results}, file, indent=2)
+        print('Results saved to ' + args.output)
+
+if __name__ == '__main__':
+    main()
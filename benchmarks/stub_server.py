@@ -0,0 +1,187 @@
+'''
+Local stub of every website/API used by tracking.py, serving the saved responses in benchmarks/fixtures. Requests must use the path format
+of http_client.REDIRECT: /<original host>/<original path>.
+
+Usage:
+        python benchmarks/stub_server.py [--port 8099] [--latency MS] [--jitter MS] [--error-rate FRACTION]
+
+and start Pheme (or the benchmarks) with PHEME_HTTP_REDIRECT=http://127.0.0.1:8099.
+'''
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import argparse
+import asyncio
+import os
+import random
+import threading
+from collections import Counter
+from aiohttp import web
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# ROUTES --------------------------------------------------------------------------------------------------------------------
+
+def fixture_for(host,path):
+    '''
+    Chooses the saved response of a request.
+
+            Parameters:
+                    host (str): Original host (ex: 'store.steampowered.com').
+                    path (str): Original path (ex: '/app/620/Portal_2/').
+
+            Returns:
+                    (file_name,content_type) (tuple): Fixture file + content type, or None if the endpoint is unknown (404).
+    '''
+    if host == 'www.nedgame.nl':
+        return ('nedgame_search.html' if path.startswith('/zoek/') else 'nedgame_product.html', 'text/html')
+    if host == 'store.steampowered.com':
+        if path.startswith('/search/'):
+            return ('steam_search.html', 'text/html')
+        if path.startswith('/app/'):
+            # Games with an odd app id are on discount.
+            app_id = path.split('/')[2]
+            discount = app_id.isdigit() and int(app_id) % 2 == 1
+            return ('steam_product_discount.html' if discount else 'steam_product.html', 'text/html')
+    if host == 'www.cardmarket.com':
+        return ('cardmarket_ygo.html', 'text/html')
+    if host == 'animebee.to':
+        return ('anime_search.html', 'text/html')
+    if host == 'mangarock.herokuapp.com':
+        return ('manga_search.html', 'text/html')
+    if host == 'api.scryfall.com' and path.startswith('/cards/named'):
+        return ('scryfall_card.json', 'application/json')
+    if host == 'api.scryfall.com' and path.startswith('/catalog/card-names'):
+        return ('scryfall_card_names.json', 'application/json')
+    if host == 'db.ygoprodeck.com' and path.startswith('/api/v7/cardinfo'):
+        return ('ygoprodeck_cardinfo.json', 'application/json')
+    if host == 'yugiohprices.com' and path.startswith('/api/card_image/'):
+        return ('ygo_card_image.jpg', 'image/jpeg')
+    return None
+
+def steam_appdetails(app_ids):
+    '''
+    Builds the response of the Steam storefront API (appdetails, 'price_overview' filter) with the same prices as the saved store pages:
+    games with an odd app id are on discount, and app ids that are multiples of 10 are not available (so the store page is used instead).
+    '''
+    data = {}
+    for app_id in app_ids.split(','):
+        if not app_id.isdigit() or int(app_id) % 10 == 0:
+            data[app_id] = {'success': False}
+        elif int(app_id) % 2 == 1:
+            data[app_id] = {'success': True, 'data': {'price_overview': {'currency': 'EUR', 'initial': 819, 'final': 195, 'discount_percent': 76,
+                                                                         'initial_formatted': '8,19€', 'final_formatted': '1,95€'}}}
+        else:
+            data[app_id] = {'success': True, 'data': {'price_overview': {'currency': 'EUR', 'initial': 819, 'final': 819, 'discount_percent': 0,
+                                                                         'initial_formatted': '', 'final_formatted': '8,19€'}}}
+    return data
+
+class StubServer:
+    '''
+    Stub HTTP server with configurable latency and error injection. It counts the requests it receives per host.
+
+            Parameters:
+                    port (int): Port to listen on (0 = any free port).
+                    latency (float): Delay added to every response, in milliseconds.
+                    jitter (float): Random extra delay (0 to 'jitter' milliseconds).
+                    error_rate (float): Fraction of the requests answered with '500 Internal Server Error'.
+                    seed (int): Seed of the random generator (jitter and errors), so runs are reproducible.
+    '''
+    def __init__(self, port=8099, latency=0, jitter=0, error_rate=0, seed=0):
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self.errors = 0
+        self._cache = {}
+        self._runner = None
+        self._thread = None
+        self._loop = None
+
+    async def handle(self, request):
+        host = request.match_info['host']
+        path = '/' + request.match_info['path']
+        self.requests[host] += 1
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay / 1000)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=500, text='Injected error')
+        if host == 'api.scryfall.com' and request.query.get('fuzzy', '').startswith('zzz'):
+            return web.json_response({'object': 'error', 'code': 'not_found'}, status=404)
+        if host == 'store.steampowered.com' and path == '/api/appdetails':
+            return web.json_response(steam_appdetails(request.query.get('appids', '')))
+        fixture = fixture_for(host, path)
+        if fixture is None:
+            return web.Response(status=404, text='No fixture for ' + host + path)
+        (file_name, content_type) = fixture
+        if file_name not in self._cache:
+            with open(os.path.join(FIXTURES, file_name), 'rb') as file:
+                self._cache[file_name] = file.read()
+        if content_type == 'image/jpeg':
+            return web.Response(body=self._cache[file_name], content_type=content_type)
+        return web.Response(body=self._cache[file_name], content_type=content_type, charset='utf-8')
+
+    async def start(self):
+        '''
+        Starts the server on the running event loop. Returns the base URL to use as http_client.REDIRECT.
+        '''
+        app = web.Application()
+        app.router.add_get('/{host}/{path:.*}', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        return 'http://127.0.0.1:' + str(self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def start_in_thread(self):
+        '''
+        Starts the server on its own event loop in a background thread (so the stub's work doesn't slow down the code being measured).
+        Returns the base URL to use as http_client.REDIRECT.
+        '''
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+        result = {}
+        def run():
+            asyncio.set_event_loop(self._loop)
+            result['url'] = self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+        self._thread = threading.Thread(target=run, name='stub-server', daemon=True)
+        self._thread.start()
+        started.wait()
+        return result['url']
+
+    def stop_thread(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Serve the saved responses of every website used by Pheme.')
+    arg_parser.add_argument('--port', type=int, default=8099)
+    arg_parser.add_argument('--latency', type=float, default=0, help='delay added to every response (ms)')
+    arg_parser.add_argument('--jitter', type=float, default=0, help='random extra delay (ms)')
+    arg_parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests answered with HTTP 500')
+    args = arg_parser.parse_args()
+
+    server = StubServer(args.port, args.latency, args.jitter, args.error_rate)
+    async def serve():
+        url = await server.start()
+        print('Stub server running on ' + url + ' (set PHEME_HTTP_REDIRECT=' + url + ')')
+        await asyncio.Event().wait()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
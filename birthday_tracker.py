@@ -1,32 +1,251 @@
-from datetime import datetime
-
-def birthday():
-    '''
-    Returns a birthday message if today is a discor user's birthday.
-            
-            Returns: 
-                    msg_list (list): List of strings with birthday message(s).
-    '''
-    # Dictionary with user's birthday information
-    bdays = [
-        ("Burn",'24/07',228494443668439040),
-        ("Momo",'20/11',233955951323906048),
-        ("Sukoi",'06/09',234424901157650432),
-        ("BlueRaven",'06/11',233993911624794123),
-        ("Daniel",'29/06',243214755785867264),
-        ("Coarse",'17/04',319503417783615498)
-    ]
-
-    # Check today's date
-    now = datetime.now() 
-    today = now.strftime('%d/%m')
-
-    msg_list = []
-
-    # If today's date corresponds to a birthday date, send a birthday message
-    for user,date,id in bdays:
-        if date == today:    
-            msg = 'Happy Birthday, '+ user +'!'
-            msg_list.append(msg)
-    
-    return msg_list
\ No newline at end of file
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+import storage
+
+logger = logging.getLogger(__name__)
+
+# VARIABLES -----------------------------------------------------------------------------------------------------------------
+
+# Birthdays are wished at midnight in this time zone.
+TIMEZONE = ZoneInfo(os.getenv('PHEME_TIMEZONE', 'Europe/Amsterdam'))
+
+# Every server has its own calendar: a user can save a birthday in each server they share with Pheme.
+SCHEMA = '''
+CREATE TABLE birthdays (
+    GuildID INTEGER NOT NULL DEFAULT 0,
+    UserID INTEGER NOT NULL,
+    Name TEXT NOT NULL,
+    Day INTEGER NOT NULL,
+    Month INTEGER NOT NULL,
+    DayOfYear INTEGER NOT NULL,
+    LastWished TEXT NOT NULL DEFAULT '',
+    ChannelID INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (GuildID, UserID)
+);
+CREATE INDEX birthdays_day_of_year ON birthdays (DayOfYear);
+'''
+
+# Columns copied when the table is rebuilt (see _load).
+COLUMNS = 'GuildID, UserID, Name, Day, Month, DayOfYear, LastWished, ChannelID'
+
+# Birthdays that were written in this file before the calendar was saved in the database. They are imported once, when the table is created,
+# without a server (server id 0) until the server Pheme was made for adopts them (see adopt).
+OLD_BIRTHDAYS = [
+    ("Burn",'24/07',228494443668439040),
+    ("Momo",'20/11',233955951323906048),
+    ("Sukoi",'06/09',234424901157650432),
+    ("BlueRaven",'06/11',233993911624794123),
+    ("Daniel",'29/06',243214755785867264),
+    ("Coarse",'17/04',319503417783615498)
+]
+
+# Calendar in memory: day of the year (1-366, see day_of_year) -> {(server id, user id): (name, channel id)}. Loaded from the database the
+# first time it is used.
+_calendar = None
+_lock = threading.Lock()
+
+# HELPER FUNCTIONS ----------------------------------------------------------------------------------------------------------
+
+def day_of_year(day,month):
+    '''
+    Number of a date in a leap year (1-366), so that every possible birthday (including 29/02) has its own number. Raises ValueError if the
+    date doesn't exist.
+    '''
+    return date(2000,month,day).timetuple().tm_yday
+
+def parse_date(text):
+    '''
+    Reads a birthday written as 'dd/mm' (ex: '24/07'). Returns (day, month), or None if the text is not a valid date.
+    '''
+    try:
+        (day,month) = (int(part) for part in text.strip().split('/'))
+        day_of_year(day,month)
+    except ValueError:
+        return None
+    return (day,month)
+
+def today():
+    '''
+    Returns today's date in TIMEZONE.
+    '''
+    return datetime.now(TIMEZONE).date()
+
+def next_midnight(now=None):
+    '''
+    Returns the next midnight in TIMEZONE (a timezone-aware datetime). Python subtracts two datetimes of the same time zone by their wall
+    times, ignoring daylight saving time changes in between: compare its timestamp() with time.time() to know how long to wait.
+    '''
+    now = now or datetime.now(TIMEZONE)
+    return datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=TIMEZONE)
+
+def _load():
+    # Creates the birthdays table the first time (importing OLD_BIRTHDAYS) and loads the calendar.
+    global _calendar
+    with _lock:
+        if _calendar is not None:
+            return _calendar
+        conn = storage.connect()
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'birthdays'").fetchone() is None:
+            with conn:
+                conn.executescript(SCHEMA)
+                for (name,text,user_id) in OLD_BIRTHDAYS:
+                    (day,month) = parse_date(text)
+                    conn.execute('INSERT INTO birthdays (UserID, Name, Day, Month, DayOfYear) VALUES (?, ?, ?, ?, ?)',
+                                 (user_id, name, day, month, day_of_year(day,month)))
+        columns = {row['name']: row['pk'] for row in conn.execute('PRAGMA table_info(birthdays)')}
+        if 'GuildID' not in columns:
+            # Calendars saved before Pheme supported several servers
+            with conn:
+                conn.execute('ALTER TABLE birthdays ADD COLUMN GuildID INTEGER NOT NULL DEFAULT 0')
+                conn.execute('ALTER TABLE birthdays ADD COLUMN ChannelID INTEGER NOT NULL DEFAULT 0')
+        if not columns.get('GuildID'):
+            # Calendars keyed by user only (one birthday per user for every server): the table is rebuilt with the new key
+            # (in one script, since the table changes don't start a transaction by themselves)
+            with conn:
+                conn.executescript('BEGIN; ALTER TABLE birthdays RENAME TO birthdays_old; DROP INDEX birthdays_day_of_year;' + SCHEMA +
+                                   'INSERT INTO birthdays (' + COLUMNS + ') SELECT ' + COLUMNS + ' FROM birthdays_old; DROP TABLE birthdays_old; COMMIT;')
+        calendar = {}
+        for row in conn.execute('SELECT UserID, Name, DayOfYear, GuildID, ChannelID FROM birthdays'):
+            calendar.setdefault(row['DayOfYear'],{})[(row['GuildID'], row['UserID'])] = (row['Name'], row['ChannelID'])
+        _calendar = calendar
+        return _calendar
+
+# CALENDAR FUNCTIONS --------------------------------------------------------------------------------------------------------
+
+def add_birthday(user_id,name,text,guild_id=0,channel_id=0):
+    '''
+    Saves (or changes) a user's birthday in a server.
+
+            Parameters:
+                    user_id (int): Discord id of the user.
+                    name (str): Name used in the birthday message.
+                    text (str): Birthday, written as 'dd/mm'.
+                    guild_id (int): Server where the birthday is wished.
+                    channel_id (int): Channel where the birthday was saved (used if the server didn't choose a birthday channel).
+
+            Returns:
+                    msg (str): Log message.
+    '''
+    parsed = parse_date(text)
+    if parsed is None:
+        return 'Please write the birthday as day/month (ex: "bday add 24/07").'
+    (day,month) = parsed
+    calendar = _load()
+    conn = storage.connect()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO birthdays (UserID, Name, Day, Month, DayOfYear, GuildID, ChannelID) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (user_id, name, day, month, day_of_year(day,month), guild_id, channel_id))
+    with _lock:
+        for users in calendar.values():
+            users.pop((guild_id, user_id), None)
+        calendar.setdefault(day_of_year(day,month),{})[(guild_id, user_id)] = (name, channel_id)
+    return "Saved "+name+"'s birthday: "+str(day).zfill(2)+'/'+str(month).zfill(2)+'.'
+
+def remove_birthday(user_id,guild_id=0):
+    '''
+    Removes a user's birthday from the calendar of a server. Returns a log message.
+    '''
+    calendar = _load()
+    conn = storage.connect()
+    with conn:
+        row = conn.execute('SELECT Name FROM birthdays WHERE GuildID = ? AND UserID = ?', (guild_id, user_id)).fetchone()
+        conn.execute('DELETE FROM birthdays WHERE GuildID = ? AND UserID = ?', (guild_id, user_id))
+    if row is None:
+        return 'There is no birthday saved for this user.'
+    with _lock:
+        for users in calendar.values():
+            users.pop((guild_id, user_id), None)
+    return "Removed "+row['Name']+"'s birthday."
+
+def list_birthdays(guild_id=None):
+    '''
+    Lists the saved birthdays (of one server, if 'guild_id' is given), starting with the next one.
+
+            Returns:
+                    msg_list (list): One message per user, ex: '24/07: Burn'.
+    '''
+    _load()
+    now = today()
+    start = day_of_year(now.day,now.month)
+    rows = storage.connect().execute('SELECT Name, Day, Month, DayOfYear, GuildID FROM birthdays').fetchall()
+    rows = [row for row in rows if guild_id is None or row['GuildID'] == guild_id]
+    rows.sort(key=lambda row: ((row['DayOfYear'] - start) % 366, row['Name']))
+    return [str(row['Day']).zfill(2)+'/'+str(row['Month']).zfill(2)+': '+row['Name'] for row in rows]
+
+def birthday(now=None):
+    '''
+    Returns a birthday message for every user whose birthday is today (29/02 birthdays are wished on 28/02 in other years). Every user is
+    wished once per day, even if Pheme restarts.
+
+            Parameters:
+                    now (date): Date to check (default: today in TIMEZONE).
+
+            Returns:
+                    messages (dict): Dictionary (server id, channel id) -> list of strings with birthday message(s).
+    '''
+    now = now or today()
+    calendar = _load()
+    days = [day_of_year(now.day,now.month)]
+    if now.month == 2 and now.day == 28 and not (now.year % 4 == 0 and (now.year % 100 != 0 or now.year % 400 == 0)):
+        days.append(day_of_year(29,2))
+    with _lock:
+        users = {user_id: user for day in days for (user_id, user) in calendar.get(day, {}).items()}
+    if not users:
+        return {}
+
+    # Skip the users that were already wished today
+    conn = storage.connect()
+    wished = {(row['GuildID'], row['UserID']) for row in conn.execute('SELECT GuildID, UserID FROM birthdays WHERE DayOfYear IN ('+
+                                                                      ','.join('?'*len(days))+') AND LastWished = ?', days + [now.isoformat()])}
+    messages = {}
+    with conn:
+        for ((guild_id, user_id), (name, channel_id)) in users.items():
+            if (guild_id, user_id) in wished:
+                continue
+            conn.execute('UPDATE birthdays SET LastWished = ? WHERE GuildID = ? AND UserID = ?', (now.isoformat(), guild_id, user_id))
+            messages.setdefault((guild_id, channel_id),[]).append('Happy Birthday, '+ name +'!')
+    return messages
+
+def adopt(guild_id,channel_id):
+    '''
+    Moves the birthdays saved without a server (see OLD_BIRTHDAYS) to the server Pheme was made for. Returns the number of birthdays moved
+    (a user who already saved a birthday in that server keeps it).
+    '''
+    global _calendar
+    _load()
+    conn = storage.connect()
+    with conn:
+        cur = conn.execute('UPDATE OR IGNORE birthdays SET GuildID = ?, ChannelID = ? WHERE GuildID = 0', (guild_id, channel_id))
+        conn.execute('DELETE FROM birthdays WHERE GuildID = 0')
+    if cur.rowcount:
+        # Loaded again from the database
+        with _lock:
+            _calendar = None
+        _load()
+    return cur.rowcount
+
+async def run(notify):
+    '''
+    Wishes today's birthdays, then sleeps until the next local midnight (see TIMEZONE) and does it again, once per day. An error (ex: a locked
+    database or a message that could not be sent) is logged, and the birthdays are wished again the next day.
+
+            Parameters:
+                    notify (function): Async function called as notify(messages) with the birthday messages of the day (see birthday).
+    '''
+    while True:
+        try:
+            messages = birthday()
+            await notify(messages)
+        except Exception:
+            logger.exception("Could not wish today's birthdays")
+        target = next_midnight().timestamp()
+        # asyncio.sleep may wake up slightly early (the event loop clock is not the wall clock), so sleep again until midnight has passed.
+        while time.time() < target:
+            await asyncio.sleep(max(1, target - time.time()))
@@ -0,0 +1,271 @@
+'''
+Local index of every card name of a trading card game, used to correct card names before Pheme searches the web for them.
+
+The names are downloaded from the bulk data of each game (see SOURCES), or loaded from a saved dump, and kept in the database. In memory,
+an index stores all the names in two long strings (instead of one Python string per name) plus a trigram table, so tens of thousands of
+names take a few MB and a lookup takes microseconds (exact names) to a few milliseconds (typos).
+
+Usage:
+        python card_index.py refresh <tcg> [dump file]
+        python card_index.py search <tcg> <card name>
+'''
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import heapq
+import json
+import sys
+import threading
+import unicodedata
+from array import array
+from collections import Counter
+import storage
+from http_client import fetch, run_sync, bypass_cache
+
+# VARIABLES -----------------------------------------------------------------------------------------------------------------
+
+# Bulk data with the names of every card of each game.
+SOURCES = {
+    'mtg': 'https://api.scryfall.com/catalog/card-names',
+    'ygo': 'https://db.ygoprodeck.com/api/v7/cardinfo.php',
+    'pkmn': 'https://api.pokemontcg.io/v2/cards?select=name&pageSize=250&page=',
+}
+GAME_NAMES = {'mtg': 'Magic the Gathering', 'ygo': 'Yu-Gi-Oh!', 'pkmn': 'Pokémon'}
+
+# A misspelled name is corrected when its best match has at least this similarity (0 to 1) and is clearly better than the second best.
+ACCEPT = 0.7
+MARGIN = 0.1
+# Matches below this similarity are not suggested.
+SUGGEST = 0.3
+
+# Loaded indexes: tcg -> (version, CardIndex). Every saved list of names gets a new version (table "card_index_versions"), so the
+# processes that loaded an older list (ex: the scraping workers, see workers.py) load the new one the next time they use the index.
+_indexes = {}
+_lock = threading.Lock()
+
+# HELPER FUNCTIONS ----------------------------------------------------------------------------------------------------------
+
+def normalize(name):
+    '''
+    Normalizes a card name for matching: lower case, no accents, punctuation replaced by spaces (ex: "Lim-Dûl's Vault" -> 'lim dul s vault').
+    '''
+    name = unicodedata.normalize('NFKD', name.lower())
+    name = ''.join(c if c.isalnum() else ' ' for c in name if not unicodedata.combining(c))
+    return ' '.join(name.split())
+
+def _trigrams(key):
+    # Set of the 3-letter sequences of a normalized name (with a space at each end, so the first and last letters count as much as the others).
+    padded = ' ' + key + ' '
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+def _names_from_json(data):
+    # Card names in a bulk data dump: a list of names/cards, or a dictionary with that list under 'data' (Scryfall, YGOPRODeck, Pokémon TCG API).
+    if isinstance(data, dict):
+        data = data.get('data', [])
+    return [card if isinstance(card, str) else card['name'] for card in data]
+
+# CARD INDEX ----------------------------------------------------------------------------------------------------------------
+
+class CardIndex:
+    '''
+    Memory-compact index of card names with exact and fuzzy (trigram) lookup.
+
+            Parameters:
+                    names (list): Card names (duplicates, including names that only differ in case/accents, are kept once).
+    '''
+    def __init__(self, names):
+        unique = {}
+        for name in names:
+            key = normalize(name)
+            if key and key not in unique:
+                unique[key] = name
+        keys = sorted(unique)
+
+        # Names sorted by their normalized key, joined in two strings. Name i is at [offsets[i], offsets[i+1]-1) of both strings.
+        self.keys = '\n'.join(keys) + '\n'
+        self.names = '\n'.join(unique[key] for key in keys) + '\n'
+        self.key_offsets = array('I', [0])
+        self.name_offsets = array('I', [0])
+        # Number of trigrams of every name, and trigram -> numbers of the names that contain it.
+        self.sizes = array('H')
+        self.postings = {}
+        for (i, key) in enumerate(keys):
+            self.key_offsets.append(self.key_offsets[-1] + len(key) + 1)
+            self.name_offsets.append(self.name_offsets[-1] + len(unique[key]) + 1)
+            grams = _trigrams(key)
+            self.sizes.append(min(len(grams), 65535))
+            for gram in grams:
+                postings = self.postings.get(gram)
+                if postings is None:
+                    postings = self.postings[gram] = array('I')
+                postings.append(i)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def key(self, i):
+        return self.keys[self.key_offsets[i]:self.key_offsets[i+1]-1]
+
+    def name(self, i):
+        return self.names[self.name_offsets[i]:self.name_offsets[i+1]-1]
+
+    def find(self, name):
+        '''
+        Returns the number of the card whose normalized name is the same as 'name' (binary search), or None.
+        '''
+        key = normalize(name)
+        (low, high) = (0, len(self))
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self.key(low) == key:
+            return low
+        return None
+
+    def search(self, name, limit=5):
+        '''
+        Finds the card names that are most similar to 'name'.
+
+                Parameters:
+                        name (str): Card name, possibly misspelled.
+                        limit (int): Maximum number of results.
+
+                Returns:
+                        matches (list): List of (card name, similarity) tuples, best first. The similarity goes from 0 to 1 (1 = same name).
+        '''
+        i = self.find(name)
+        if i is not None:
+            return [(self.name(i), 1.0)]
+        grams = _trigrams(normalize(name))
+        counts = Counter()
+        for gram in grams:
+            postings = self.postings.get(gram)
+            if postings is not None:
+                counts.update(postings)
+        # Dice coefficient: shared trigrams relative to the trigrams of both names
+        best = heapq.nlargest(limit, ((2 * shared / (len(grams) + self.sizes[i]), i) for (i, shared) in counts.items()))
+        return [(self.name(i), round(score, 3)) for (score, i) in best]
+
+# INDEX FUNCTIONS -----------------------------------------------------------------------------------------------------------
+
+def _version(conn,tcg):
+    # Version of the saved card names of a game (0 if they were never saved).
+    row = conn.execute('SELECT Version FROM card_index_versions WHERE TCG = ?', (tcg,)).fetchone()
+    return row['Version'] if row is not None else 0
+
+def get_index(tcg):
+    '''
+    Returns the card index of a game, loading it from the database the first time and again whenever its names were saved again (by this
+    process or another one). Returns None if the game's names were never downloaded.
+    '''
+    conn = storage.connect()
+    with _lock:
+        version = _version(conn, tcg)
+        if _indexes.get(tcg, (None,))[0] != version:
+            rows = conn.execute('SELECT Name FROM card_names WHERE TCG = ?', (tcg,)).fetchall()
+            _indexes[tcg] = (version, CardIndex([row['Name'] for row in rows]) if rows else None)
+        return _indexes[tcg][1]
+
+def save_names(tcg,names):
+    '''
+    Replaces the saved card names of a game and rebuilds its index. Returns the number of distinct names.
+    '''
+    index = CardIndex(names)
+    conn = storage.connect()
+    with conn:
+        conn.execute('DELETE FROM card_names WHERE TCG = ?', (tcg,))
+        conn.executemany('INSERT INTO card_names (TCG, Name) VALUES (?, ?)', ((tcg, index.name(i)) for i in range(len(index))))
+        version = _version(conn, tcg) + 1
+        conn.execute('INSERT OR REPLACE INTO card_index_versions (TCG, Version) VALUES (?, ?)', (tcg, version))
+    with _lock:
+        _indexes[tcg] = (version, index)
+    return len(index)
+
+def load_dump(path):
+    '''
+    Reads the card names of a saved bulk data dump: a JSON file (list of names/cards, or a dictionary with that list under 'data') or a text
+    file with one name per line.
+    '''
+    with open(path, encoding='utf-8') as file:
+        text = file.read()
+    try:
+        return _names_from_json(json.loads(text))
+    except ValueError:
+        return [line.strip() for line in text.splitlines() if line.strip()]
+
+async def download_names(tcg):
+    '''
+    Downloads the names of every card of a game from its bulk data source (SOURCES). Returns None if the download failed.
+    '''
+    names = []
+    with bypass_cache():
+        if tcg == 'pkmn':
+            # The Pokémon TCG API is paginated.
+            page = 1
+            while True:
+                (status, body) = await fetch(SOURCES[tcg] + str(page))
+                if status != 200:
+                    return None
+                data = json.loads(body)
+                names += _names_from_json(data)
+                if not data['data'] or len(names) >= data.get('totalCount', 0):
+                    break
+                page += 1
+        else:
+            (status, body) = await fetch(SOURCES[tcg])
+            if status != 200:
+                return None
+            names = _names_from_json(json.loads(body))
+    return names
+
+async def refresh_async(tcg,path=None):
+    '''
+    Downloads (or loads from a dump file) all the card names of a game, and saves them as its new card index.
+
+            Parameters:
+                    tcg (str): 'ygo', 'pkmn' or 'mtg'.
+                    path (str): Bulk data dump to load instead of downloading the names (optional).
+
+            Returns:
+                    msg (str): Log message.
+    '''
+    names = load_dump(path) if path else await download_names(tcg)
+    if not names:
+        return 'Could not get the list of '+GAME_NAMES[tcg]+' cards. Please try again later.'
+    return 'The '+GAME_NAMES[tcg]+' card index was refreshed: '+str(save_names(tcg, names))+' card names.'
+
+def resolve(tcg,name):
+    '''
+    Corrects a card name with the card index of its game, without any network call.
+
+            Parameters:
+                    tcg (str): 'ygo', 'pkmn' or 'mtg'.
+                    name (str): Card name typed by a user.
+
+            Returns:
+                    (name,msg) (tuple): Exact card name + None, or None + a message for the user (no match, or a list of suggestions) if the name
+                                        can't be corrected with certainty. If the game has no card index yet, 'name' is returned unchanged.
+    '''
+    index = get_index(tcg)
+    if index is None:
+        return (name, None)
+    matches = index.search(name)
+    if matches and matches[0][1] == 1.0:
+        return (matches[0][0], None)
+    if matches and matches[0][1] >= ACCEPT and (len(matches) == 1 or matches[0][1] - matches[1][1] >= MARGIN):
+        return (matches[0][0], None)
+    suggestions = [match for (match, score) in matches if score >= SUGGEST]
+    if not suggestions:
+        return (None, 'There is no '+GAME_NAMES[tcg]+' card named “'+name+'”.')
+    return (None, 'There is no '+GAME_NAMES[tcg]+' card named “'+name+'”. Did you mean: '+', '.join(suggestions)+'?')
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'refresh' and sys.argv[2] in SOURCES:
+        print(run_sync(refresh_async(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)))
+    elif len(sys.argv) >= 4 and sys.argv[1] == 'search' and sys.argv[2] in SOURCES:
+        index = get_index(sys.argv[2])
+        print(index.search(' '.join(sys.argv[3:])) if index else 'No card index for ' + sys.argv[2] + ' yet.')
+    else:
+        print(__doc__)
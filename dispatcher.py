@@ -0,0 +1,119 @@
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import asyncio
+import logging
+from http_client import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# VARIABLES -----------------------------------------------------------------------------------------------------------------
+
+# Maximum length of a Discord message (in characters).
+MAX_LENGTH = 2000
+
+# Messages sent per second to the same channel (Discord allows about 5 messages every 5 seconds per channel), and burst size.
+SEND_RATE = 1.0
+SEND_BURST = 5
+
+# HELPER FUNCTIONS ----------------------------------------------------------------------------------------------------------
+
+def pack(lines,limit=MAX_LENGTH):
+    '''
+    Joins lines of text (one per line) into as few messages as possible, each at most 'limit' characters long. Lines longer than 'limit' are
+    split. Empty lines are skipped (Discord doesn't accept empty messages).
+
+            Parameters:
+                    lines (list): Lines to send (non-str items are converted with str(), like channel.send does).
+                    limit (int): Maximum message length.
+
+            Returns:
+                    messages (list): List of messages (str).
+    '''
+    messages = []
+    current = ''
+    for line in lines:
+        line = str(line)
+        if not line:
+            continue
+        while len(line) > limit:
+            if current:
+                messages.append(current)
+                current = ''
+            messages.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            messages.append(current)
+            current = line
+        elif line:
+            current = current + '\n' + line if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+# DISPATCHER ----------------------------------------------------------------------------------------------------------------
+
+class Dispatcher:
+    '''
+    Outbound message queue. Every channel has its own queue, worker and rate limit (token bucket). When a worker wakes up, it packs all the
+    lines queued for its channel into as few messages as possible, so 50 price drops become one or two messages instead of 50 API calls.
+
+            Parameters:
+                    rate (float): Messages per second sent to the same channel.
+                    burst (int): Messages that can be sent at once before 'rate' applies.
+    '''
+    def __init__(self, rate=SEND_RATE, burst=SEND_BURST):
+        self.rate = rate
+        self.burst = burst
+        # channel id -> queue of (lines, future), worker task and token bucket
+        self.queues = {}
+        self.workers = {}
+        self.buckets = {}
+        # Counters: lines queued, lines waiting in the queues and messages actually sent
+        self.lines = 0
+        self.waiting = 0
+        self.messages = 0
+
+    def send(self, channel, lines):
+        '''
+        Queues lines of text to be sent to a channel and returns at once. The returned future can be awaited to wait until the lines are
+        delivered (ex: command replies); background notifications don't need to wait for it.
+
+                Parameters:
+                        channel (discord.abc.Messageable): Channel to send the lines to.
+                        lines (list): Lines to send.
+
+                Returns:
+                        done (asyncio.Future): Future set to True once the lines were sent (False if Discord refused a message).
+        '''
+        key = channel.id
+        if key not in self.queues:
+            self.queues[key] = asyncio.Queue()
+            self.buckets[key] = TokenBucket(self.rate, self.burst)
+            self.workers[key] = asyncio.ensure_future(self._work(channel, self.queues[key], self.buckets[key]))
+        done = asyncio.get_running_loop().create_future()
+        lines = list(lines)
+        self.lines += len(lines)
+        self.waiting += len(lines)
+        self.queues[key].put_nowait((lines, done))
+        return done
+
+    async def _work(self, channel, queue, bucket):
+        # Sends everything queued for one channel, packed, within the channel's rate limit.
+        while True:
+            batch = [await queue.get()]
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            lines = [line for (queued, _) in batch for line in queued]
+            self.waiting -= len(lines)
+            ok = True
+            for message in pack(lines):
+                await bucket.acquire()
+                try:
+                    await channel.send(message)
+                    self.messages += 1
+                except Exception:
+                    ok = False
+                    logger.exception('Could not send a message to channel %s', channel.id)
+            for (_, done) in batch:
+                if not done.done():
+                    done.set_result(ok)
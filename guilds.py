@@ -0,0 +1,121 @@
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import storage
+
+# VARIABLES -----------------------------------------------------------------------------------------------------------------
+
+# Categories that can have their own notification channel in every server ('birthday' is for the birthday messages).
+CATEGORIES = ['ygo','pkmn','mtg','physical','digital','anime','manga','birthday']
+
+# Every tracked item is stored (and scraped) once in the tables "prices"/"statuses", however many servers track it. The servers that track an
+# item are its subscribers (table "subscriptions"), so a price drop is checked once and then sent to every subscribed server.
+
+# HELPER FUNCTIONS ----------------------------------------------------------------------------------------------------------
+
+def partition(message):
+    '''
+    Returns the id of the partition a Discord message belongs to: its server (guild) id, or the channel id for direct messages.
+    '''
+    guild = getattr(message, 'guild', None)
+    return guild.id if guild is not None else message.channel.id
+
+# CONFIGURATION FUNCTIONS ---------------------------------------------------------------------------------------------------
+
+def set_channel(guild_id,category,channel_id):
+    '''
+    Sets the channel where a server receives the notifications of a category.
+
+            Parameters:
+                    guild_id (int): Server id.
+                    category (str): One of CATEGORIES, or 'all'.
+                    channel_id (int): Channel id.
+    '''
+    categories = CATEGORIES if category == 'all' else [category]
+    conn = storage.connect()
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO guild_channels (GuildID, Category, ChannelID) VALUES (?, ?, ?)',
+                         [(guild_id, c, channel_id) for c in categories])
+
+def channels(guild_id):
+    '''
+    Returns the configured notification channels of a server: dictionary category -> channel id.
+    '''
+    rows = storage.connect().execute('SELECT Category, ChannelID FROM guild_channels WHERE GuildID = ?', (guild_id,))
+    return {row['Category']: row['ChannelID'] for row in rows}
+
+def channel(guild_id,category,default=None):
+    '''
+    Returns the channel where a server receives the notifications of a category, or 'default' if the server didn't choose one.
+    '''
+    row = storage.connect().execute('SELECT ChannelID FROM guild_channels WHERE GuildID = ? AND Category = ?', (guild_id, category)).fetchone()
+    return row['ChannelID'] if row is not None else default
+
+# SUBSCRIPTION FUNCTIONS ----------------------------------------------------------------------------------------------------
+
+def subscribe(guild_id,channel_id,category,name):
+    '''
+    Adds a tracked item to a server's items.
+
+            Parameters:
+                    guild_id (int): Server id.
+                    channel_id (int): Channel where the item was tracked (its notifications are sent there if the server didn't choose a
+                                      channel for the category, see set_channel).
+                    category (str): Item category.
+                    name (str): Item name (exactly as it is in the database).
+    '''
+    conn = storage.connect()
+    with conn:
+        conn.execute('INSERT OR IGNORE INTO subscriptions (GuildID, Category, Name, ChannelID) VALUES (?, ?, ?, ?)',
+                     (guild_id, category, name, channel_id))
+
+def unsubscribe(guild_id,category,name):
+    '''
+    Removes an item from a server's items.
+
+            Returns:
+                    (removed,remaining) (tuple): True if the server was tracking the item + the number of servers still tracking it.
+    '''
+    conn = storage.connect()
+    with conn:
+        cur = conn.execute('DELETE FROM subscriptions WHERE GuildID = ? AND Category = ? AND Name = ?', (guild_id, category, name))
+        remaining = conn.execute('SELECT COUNT(*) FROM subscriptions WHERE Category = ? AND Name = ?', (category, name)).fetchone()[0]
+    return (cur.rowcount > 0, remaining)
+
+def items(guild_id,category):
+    '''
+    Returns the names of the items of a category tracked by a server.
+    '''
+    rows = storage.connect().execute('SELECT Name FROM subscriptions WHERE GuildID = ? AND Category = ?', (guild_id, category))
+    return {row['Name'] for row in rows}
+
+def subscribers(category,name):
+    '''
+    Returns the channels to notify about an item's changes: one channel id per server tracking the item (its configured channel for the
+    category, or else the channel where the item was tracked).
+    '''
+    rows = storage.connect().execute('SELECT COALESCE(g.ChannelID, s.ChannelID) AS ChannelID FROM subscriptions s '
+                                     'LEFT JOIN guild_channels g ON g.GuildID = s.GuildID AND g.Category = s.Category '
+                                     'WHERE s.Category = ? AND s.Name = ?', (category, name))
+    return sorted({row['ChannelID'] for row in rows})
+
+def adopt(guild_id,channel_ids):
+    '''
+    One-time migration to multi-server tracking: the items tracked before Pheme knew about servers (items without subscribers) become items of
+    'guild_id', and the server gets the channels Pheme used before as its notification channels (unless it already chose some).
+
+            Parameters:
+                    guild_id (int): Id of the server Pheme was made for.
+                    channel_ids (dict): Dictionary category -> channel id (see CATEGORIES).
+
+            Returns:
+                    adopted (int): Number of items added to the server.
+    '''
+    conn = storage.connect()
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO guild_channels (GuildID, Category, ChannelID) VALUES (?, ?, ?)',
+                         [(guild_id, category, channel_id) for (category, channel_id) in channel_ids.items()])
+        cur = conn.execute('INSERT INTO subscriptions (GuildID, Category, Name, ChannelID) '
+                           'SELECT DISTINCT ?, i.Category, i.Name, c.ChannelID FROM (SELECT Category, Name FROM prices UNION SELECT Category, Name FROM statuses) i '
+                           'JOIN guild_channels c ON c.GuildID = ? AND c.Category = i.Category '
+                           'WHERE NOT EXISTS (SELECT 1 FROM subscriptions s WHERE s.Category = i.Category AND s.Name = i.Name)', (guild_id, guild_id))
+    return cur.rowcount
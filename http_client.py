@@ -0,0 +1,573 @@
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import asyncio
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import aiohttp
+import metrics
+import storage
+
+logger = logging.getLogger(__name__)
+
+# CONFIGURATION -------------------------------------------------------------------------------------------------------------
+
+# Explicit timeouts (in seconds) for every outbound request, so a slow or dead webshop can never hang the bot.
+TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10, sock_read=20)
+
+# Deadline (in seconds) of a whole request, including its retries.
+DEADLINE = 45
+
+# Failed attempts (connection errors, timeouts, HTTP 5xx and 429) are retried up to RETRIES times, waiting BACKOFF seconds before the first
+# retry and twice as long before each next one (+/- 50% random jitter).
+RETRIES = 2
+BACKOFF = 0.5
+
+# Circuit breakers: after FAILURE_THRESHOLD failed attempts in a row, a host is skipped for COOLDOWN seconds (doubled every time a probe
+# request fails, up to MAX_COOLDOWN). Then one probe request is let through: if it succeeds, the host is used normally again.
+FAILURE_THRESHOLD = 5
+COOLDOWN = 60
+MAX_COOLDOWN = 3600
+
+# Connection pool limits: at most LIMIT open connections in total and LIMIT_PER_HOST open connections to the same webshop.
+LIMIT = 32
+LIMIT_PER_HOST = 4
+
+# How long (in seconds) an idle keep-alive connection is kept in the pool before it is closed.
+KEEPALIVE = 60
+
+HEADERS = {'User-Agent': 'Mozilla/5.0 (compatible; PhemeBot/1.0)'}
+
+# Token-bucket limits per webshop host: (requests per second, burst size). Hosts that are not listed are not rate limited.
+RATE_LIMITS = {
+    'www.nedgame.nl': (1.0, 3),
+    'store.steampowered.com': (2.0, 5),
+    'www.cardmarket.com': (0.5, 2),
+    'animebee.to': (1.0, 3),
+    'mangarock.herokuapp.com': (1.0, 3),
+}
+
+# Response cache: how long (in seconds) a response of each host is reused without asking the host again. Hosts that are not listed are
+# never cached. Card images and Scryfall card data change rarely; webshop prices are kept for a few minutes (enough for a 'search'
+# followed by a 'track', or several users searching the same card).
+CACHE_TTL = {
+    'www.nedgame.nl': 600,
+    'store.steampowered.com': 600,
+    'www.cardmarket.com': 600,
+    'animebee.to': 1800,
+    'mangarock.herokuapp.com': 1800,
+    'api.scryfall.com': 86400,
+    'yugiohprices.com': 86400,
+}
+
+# Maximum total size (in bytes) of the cached response bodies. The least recently used responses are evicted first.
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# If set (ex: 'http://127.0.0.1:8099'), every request is sent to this server instead, with the original host as the first part of the
+# path (https://www.nedgame.nl/zoek/... -> http://127.0.0.1:8099/www.nedgame.nl/zoek/...). Used by the offline benchmarks
+# (benchmarks/stub_server.py).
+REDIRECT = os.getenv('PHEME_HTTP_REDIRECT', '')
+
+# One pooled client session per event loop (the discord.py loop and the background loop used by the sync wrappers).
+_sessions = {}
+
+# Background event loop used to run the async functions from synchronous code.
+_sync_loop = None
+_sync_lock = threading.Lock()
+
+# True once the token buckets and circuit breakers are kept in the database, shared with the other processes (see share_state).
+_shared = False
+
+# URL FUNCTIONS -------------------------------------------------------------------------------------------------------------
+
+def _target(url):
+    # URL that is actually requested (see REDIRECT).
+    if not REDIRECT:
+        return url
+    parts = urlsplit(url)
+    return REDIRECT.rstrip('/') + '/' + parts.netloc + parts.path + ('?' + parts.query if parts.query else '')
+
+# RATE LIMITING -------------------------------------------------------------------------------------------------------------
+
+class TokenBucket:
+    '''
+    Token bucket shared by every event loop of the process: 'rate' tokens are added per second, up to 'capacity' tokens, and each request
+    consumes one token.
+    '''
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take(self):
+        # Refills the bucket and takes a token if there is one. Returns how long to wait (in seconds) before trying again.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        '''
+        Waits (without blocking the event loop) until a token is available and takes it.
+        '''
+        wait = self._take()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self._take()
+
+class SharedTokenBucket(TokenBucket):
+    '''
+    Token bucket kept in the database (table "rate_limits"), shared by every process that uses it (see share_state): together, the processes
+    send at most 'rate' requests per second to the host.
+    '''
+    def __init__(self, host, rate, capacity):
+        super().__init__(rate, capacity)
+        self.host = host
+
+    def _take(self):
+        # Same as TokenBucket._take, in one database transaction (with wall-clock times: processes don't share a monotonic clock)
+        with storage.immediate() as conn:
+            row = conn.execute('SELECT Tokens, Updated FROM rate_limits WHERE Host = ?', (self.host,)).fetchone()
+            now = time.time()
+            tokens = self.capacity if row is None else min(self.capacity, row['Tokens'] + max(0, now - row['Updated']) * self.rate)
+            if tokens < 1:
+                return (1 - tokens) / self.rate
+            conn.execute('INSERT OR REPLACE INTO rate_limits (Host, Tokens, Updated) VALUES (?, ?, ?)', (self.host, tokens - 1, now))
+            return 0
+
+    async def acquire(self):
+        # The transactions run in a thread, so a busy database never blocks the event loop
+        loop = asyncio.get_running_loop()
+        wait = await loop.run_in_executor(None, self._take)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = await loop.run_in_executor(None, self._take)
+
+_buckets = {host: TokenBucket(rate, burst) for host, (rate, burst) in RATE_LIMITS.items()}
+
+async def throttle(url):
+    '''
+    Waits for the token bucket of the url's host (if the host is rate limited).
+
+            Parameters:
+                    url (str): URL that is about to be requested.
+    '''
+    bucket = _buckets.get(urlsplit(url).hostname)
+    if bucket is not None:
+        await bucket.acquire()
+
+# CIRCUIT BREAKERS ----------------------------------------------------------------------------------------------------------
+
+class HostUnavailable(Exception):
+    '''
+    Raised instead of sending a request to a host whose circuit breaker is open (the host failed repeatedly and is skipped for a while).
+    '''
+    def __init__(self, host, retry_in):
+        super().__init__(host + ' is unavailable (retrying in ' + str(round(retry_in)) + 's)')
+        self.host = host
+        self.retry_in = retry_in
+
+class CircuitBreaker:
+    '''
+    Circuit breaker of one host, shared by every event loop of the process. States: 'closed' (requests are sent), 'open' (requests fail at
+    once with HostUnavailable) and 'half-open' (the cooldown is over: one probe request is sent to test the host).
+    '''
+    # Clock of the state's times (Opened, Probing)
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.opened = None
+        self.cooldown = COOLDOWN
+        # Time the probe request was sent (None if there is no probe in progress)
+        self.probing = None
+        # Counters: requests skipped while open, and the time they would have wasted (average duration of a failed attempt).
+        self.skipped = 0
+        self.saved_seconds = 0.0
+        self.failure_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def _peek(self):
+        # Reads the latest state (only needed by the breakers shared with other processes, see SharedCircuitBreaker)
+        pass
+
+    @contextmanager
+    def _change(self):
+        # Block that reads and changes the state atomically
+        with self.lock:
+            yield
+
+    def state(self):
+        if self.opened is None:
+            return 'closed'
+        return 'open' if self.clock() - self.opened < self.cooldown else 'half-open'
+
+    def before(self):
+        # Called before every attempt: raises HostUnavailable if the host must be skipped. Returns True if the attempt is the probe request.
+        self._peek()
+        if self.state() == 'closed':
+            return False
+        with self._change():
+            state = self.state()
+            if state == 'closed':
+                return False
+            now = self.clock()
+            # A probe that never reported back (ex: its worker process died) is replaced after DEADLINE seconds
+            if state == 'half-open' and (self.probing is None or now - self.probing > DEADLINE):
+                self.probing = now
+                logger.info('Circuit of %s is half-open: sending a probe request', self.host)
+                return True
+            self.skipped += 1
+            self.saved_seconds += self.failure_seconds
+            retry_in = max(0, self.opened + self.cooldown - now)
+        metrics.circuit_skipped.inc(host=self.host)
+        raise HostUnavailable(self.host, retry_in)
+
+    def release(self):
+        # Called when the probe request ended without an answer or a failure (ex: it was cancelled), so another request can be the probe.
+        with self._change():
+            self.probing = None
+
+    def success(self):
+        self._peek()
+        if self.failures == 0 and self.opened is None:
+            return
+        with self._change():
+            if self.opened is not None:
+                logger.warning('Circuit of %s closed: the host is answering again (%d requests skipped, %.0fs saved)', self.host,
+                               self.skipped, self.saved_seconds)
+                metrics.circuit_open.set(0, host=self.host)
+            (self.failures, self.opened, self.probing, self.cooldown) = (0, None, None, COOLDOWN)
+
+    def failure(self, seconds):
+        with self._change():
+            self.failures += 1
+            # Moving average of the duration of a failed attempt
+            self.failure_seconds = seconds if self.failures == 1 else 0.8 * self.failure_seconds + 0.2 * seconds
+            if self.probing is not None:
+                (self.probing, self.opened, self.cooldown) = (None, self.clock(), min(MAX_COOLDOWN, self.cooldown * 2))
+                logger.warning('Circuit of %s opened again: the probe request failed (next probe in %ds)', self.host, self.cooldown)
+            elif self.opened is None and self.failures >= FAILURE_THRESHOLD:
+                self.opened = self.clock()
+                logger.warning('Circuit of %s opened after %d failed attempts in a row (next probe in %ds)', self.host, self.failures,
+                               self.cooldown)
+                metrics.circuit_open.set(1, host=self.host)
+
+class SharedCircuitBreaker(CircuitBreaker):
+    '''
+    Circuit breaker kept in the database (table "circuit_breakers"), shared by every process that uses it (see share_state): a host that keeps
+    failing is skipped by all of them, and only one of them sends the probe request.
+    '''
+    # Wall-clock times, since processes don't share a monotonic clock
+    clock = staticmethod(time.time)
+
+    FIELDS = ('failures', 'opened', 'cooldown', 'probing', 'skipped', 'saved_seconds', 'failure_seconds')
+    COLUMNS = ('Failures', 'Opened', 'Cooldown', 'Probing', 'Skipped', 'SavedSeconds', 'FailureSeconds')
+
+    def _load(self, conn):
+        row = conn.execute('SELECT ' + ', '.join(self.COLUMNS) + ' FROM circuit_breakers WHERE Host = ?', (self.host,)).fetchone()
+        values = tuple(row) if row is not None else (0, None, COOLDOWN, None, 0, 0.0, 0.0)
+        for (field, value) in zip(self.FIELDS, values):
+            setattr(self, field, value)
+
+    def _peek(self):
+        self._load(storage.connect())
+
+    @contextmanager
+    def _change(self):
+        with self.lock, storage.immediate() as conn:
+            self._load(conn)
+            yield
+            conn.execute('INSERT OR REPLACE INTO circuit_breakers (Host, ' + ', '.join(self.COLUMNS) + ') VALUES (?' + ', ?' * len(self.COLUMNS)
+                         + ')', (self.host,) + tuple(getattr(self, field) for field in self.FIELDS))
+
+_breakers = {}
+
+def get_breaker(host):
+    '''
+    Returns the circuit breaker of a host (created the first time).
+    '''
+    breaker = _breakers.get(host)
+    if breaker is None:
+        breaker = _breakers.setdefault(host, SharedCircuitBreaker(host) if _shared else CircuitBreaker(host))
+    return breaker
+
+async def _call_breaker(method, *args):
+    # Calls a method of a circuit breaker. The shared breakers read and write the database: in a thread, so a busy database never blocks the
+    # event loop.
+    if not _shared:
+        return method(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, method, *args)
+
+def breaker_report(hosts=None):
+    '''
+    Describes the circuit breakers that are not closed (hosts being skipped or probed).
+
+            Parameters:
+                    hosts (set): Only describe the breakers of these hosts (None = every host).
+
+            Returns:
+                    msg_list (list): One message per host, ex: 'animebee.to: open, next probe in 45s (12 requests skipped, 96s saved)'.
+    '''
+    if _shared:
+        # Including the hosts that only the other processes requested
+        for row in storage.connect().execute('SELECT Host FROM circuit_breakers'):
+            get_breaker(row['Host'])._peek()
+    msg_list = []
+    for (host, breaker) in sorted(_breakers.items()):
+        if hosts is not None and host not in hosts:
+            continue
+        state = breaker.state()
+        if state == 'closed':
+            continue
+        msg = host+': '+state
+        if state == 'open':
+            msg = msg+', next probe in '+str(round(breaker.opened + breaker.cooldown - breaker.clock()))+'s'
+        msg_list.append(msg+' ('+str(breaker.skipped)+' requests skipped, '+str(round(breaker.saved_seconds))+'s saved)')
+    return msg_list
+
+def share_state():
+    '''
+    Moves the token buckets and the circuit breakers to the database, so that the bot process and its scraping workers (see workers.py) share
+    the request rates of every host and the hosts being skipped. Called once by each process, before its first request.
+    '''
+    global _shared
+    _shared = True
+    for (host, bucket) in list(_buckets.items()):
+        _buckets[host] = SharedTokenBucket(host, bucket.rate, bucket.capacity)
+    _breakers.clear()
+
+# RESPONSE CACHE ------------------------------------------------------------------------------------------------------------
+
+class ResponseCache:
+    '''
+    LRU cache of response bodies, bounded by their total size in bytes. Every entry keeps the validators (ETag/Last-Modified) sent by the
+    host, so an expired entry can be revalidated with a conditional GET instead of being downloaded again.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Counters: fresh hits, misses (downloads), revalidations answered with '304 Not Modified', and the download time saved by hits.
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.saved_seconds = 0.0
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+            return entry
+
+    def put(self, url, entry):
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old is not None:
+                self.size -= len(old['body'])
+            if len(entry['body']) > self.max_bytes:
+                return
+            self.entries[url] = entry
+            self.size += len(entry['body'])
+            while self.size > self.max_bytes:
+                (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted['body'])
+
+    def count(self, **amounts):
+        '''
+        Adds to the cache counters, ex: cache.count(hits=1, saved_seconds=0.4). The counters are read and written under the lock, since the
+        cache is used from several threads (see run_sync).
+        '''
+        with self.lock:
+            for (name, amount) in amounts.items():
+                setattr(self, name, getattr(self, name) + amount)
+
+    def stats(self):
+        '''
+        Returns the cache counters as a dictionary (hits, misses, revalidated, saved_seconds, entries, bytes).
+        '''
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'revalidated': self.revalidated, 'saved_seconds': round(self.saved_seconds, 2),
+                    'entries': len(self.entries), 'bytes': self.size}
+
+cache = ResponseCache(CACHE_MAX_BYTES)
+
+# When set (see bypass_cache), fresh cached responses are not reused: every request goes to the host (as a conditional GET if possible).
+_bypass = contextvars.ContextVar('bypass_cache', default=False)
+
+@contextmanager
+def bypass_cache():
+    '''
+    Context manager used by the sweeps: inside it (and inside every task created inside it), requests skip the fresh cached responses and
+    always ask the host for the latest version. Responses are still stored in the cache for the interactive commands.
+    '''
+    token = _bypass.set(True)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+# SESSION FUNCTIONS ---------------------------------------------------------------------------------------------------------
+
+def get_session():
+    '''
+    Returns the shared pooled client session of the running event loop, creating it the first time it is needed.
+
+            Returns:
+                    session (aiohttp.ClientSession): Client session with keep-alive, per-host connection limits and timeouts.
+    '''
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=LIMIT, limit_per_host=LIMIT_PER_HOST, keepalive_timeout=KEEPALIVE, ttl_dns_cache=300)
+        session = aiohttp.ClientSession(connector=connector, timeout=TIMEOUT, headers=HEADERS)
+        _sessions[loop] = session
+    return session
+
+async def close_session():
+    '''
+    Closes the client session of the running event loop (used when the bot shuts down).
+    '''
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+# FETCH FUNCTIONS -----------------------------------------------------------------------------------------------------------
+
+async def _send(url, headers):
+    # Sends one GET request and returns the response as a dictionary.
+    session = get_session()
+    start = time.monotonic()
+    async with session.get(_target(url), headers=headers) as response:
+        body = await response.read()
+        return {'status': response.status, 'body': body, 'charset': response.charset, 'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'), 'elapsed': time.monotonic() - start}
+
+async def _request(url):
+    # Returns the response to a GET request as a dictionary (status, body, charset), using the response cache for the hosts in CACHE_TTL.
+    # Failed attempts are retried with exponential backoff within DEADLINE seconds, and hosts that keep failing are skipped (circuit breaker).
+    host = urlsplit(url).hostname
+    ttl = CACHE_TTL.get(host)
+    entry = cache.get(url) if ttl else None
+    if entry is not None and not _bypass.get() and entry['expires'] > time.monotonic():
+        cache.count(hits=1, saved_seconds=entry['elapsed'])
+        return entry
+
+    headers = {}
+    if entry is not None:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    breaker = get_breaker(host)
+    deadline = time.monotonic() + DEADLINE
+    attempt = 0
+    while True:
+        probe = await _call_breaker(breaker.before)
+        try:
+            await throttle(url)
+            start = time.monotonic()
+            result = await asyncio.wait_for(_send(url, headers), max(0.1, deadline - start))
+            error = None if result['status'] < 500 and result['status'] != 429 else 'HTTP ' + str(result['status'])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+            (result, error) = (exception, repr(exception))
+        except BaseException:
+            # Cancelled (or an unexpected error): a probe that never finished must not keep the host skipped forever
+            if probe:
+                await asyncio.shield(_call_breaker(breaker.release))
+            raise
+        if error is None:
+            await _call_breaker(breaker.success)
+            break
+        await _call_breaker(breaker.failure, time.monotonic() - start)
+        delay = BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+        if attempt >= RETRIES or breaker.opened is not None or time.monotonic() + delay >= deadline:
+            logger.info('Request to %s failed after %d attempts: %s', url, attempt + 1, error)
+            if isinstance(result, Exception):
+                raise result
+            break
+        logger.info('Request to %s failed (%s), retrying in %.1fs', url, error, delay)
+        metrics.retries.inc(host=host)
+        attempt += 1
+        await asyncio.sleep(delay)
+
+    if result['status'] == 304 and entry is not None:
+        # Not modified: the cached body is still valid for another TTL.
+        cache.count(revalidated=1)
+        entry = dict(entry, expires=time.monotonic() + ttl)
+        cache.put(url, entry)
+        return entry
+    if ttl:
+        cache.count(misses=1)
+        if result['status'] == 200:
+            result['expires'] = time.monotonic() + ttl
+            cache.put(url, result)
+    return result
+
+async def fetch(url):
+    '''
+    Downloads a webpage/API response with the shared session (or takes it from the response cache).
+
+            Parameters:
+                    url (str): URL to request.
+
+            Returns:
+                    (status,body) (tuple): HTTP status code + raw response body (bytes).
+    '''
+    response = await _request(url)
+    return (response['status'], response['body'])
+
+async def fetch_text(url):
+    '''
+    Downloads a webpage (or takes it from the response cache) and returns its decoded text (the async equivalent of requests.get(url).text).
+
+            Parameters:
+                    url (str): URL to request.
+
+            Returns:
+                    text (str): Decoded response body.
+    '''
+    response = await _request(url)
+    return response['body'].decode(response['charset'] or 'utf-8', errors='replace')
+
+# SYNC WRAPPER --------------------------------------------------------------------------------------------------------------
+
+def _start_sync_loop():
+    # Starts (once) a daemon thread running an event loop dedicated to the synchronous wrappers.
+    global _sync_loop
+    with _sync_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_sync_loop.run_forever, name='pheme-http', daemon=True)
+            thread.start()
+    return _sync_loop
+
+def run_sync(coro):
+    '''
+    Runs a coroutine to completion from synchronous code and returns its result. The coroutine runs on a background event loop, so the
+    pooled session (and its keep-alive connections) is reused between calls.
+
+            Parameters:
+                    coro (coroutine): Coroutine to run, ex: gameprices_async('digital','portal',1).
+
+            Returns:
+                    result: Whatever the coroutine returns.
+    '''
+    loop = _start_sync_loop()
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
@@ -0,0 +1,142 @@
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import hashlib
+import os
+import time
+import storage
+
+# VARIABLES -----------------------------------------------------------------------------------------------------------------
+
+# Folder with the cached card images. Every image is saved once, in a file named after the hash of its content.
+CACHE_DIR = os.getenv('PHEME_IMAGE_CACHE', 'image_cache')
+
+# Maximum total size (in bytes) of the cached images. The least recently shown images are deleted first.
+MAX_BYTES = 200 * 1024 * 1024
+
+# In-memory copy of the card name -> image URL lookups (ex: Scryfall), so repeated lookups don't even touch the database.
+_urls = {}
+
+# HELPER FUNCTIONS ----------------------------------------------------------------------------------------------------------
+
+def normalize(name):
+    '''
+    Normalizes a card name so that 'Dark  Magician' and 'dark magician' share the same cache entry.
+    '''
+    return ' '.join(name.lower().split())
+
+def _extension(body):
+    # File extension of an image, from its first bytes.
+    if body.startswith(b'\x89PNG'):
+        return 'png'
+    if body.startswith(b'GIF8'):
+        return 'gif'
+    if body[8:12] == b'WEBP':
+        return 'webp'
+    return 'jpg'
+
+def _path(digest,ext):
+    return os.path.join(CACHE_DIR, digest + '.' + ext)
+
+# IMAGE FUNCTIONS -----------------------------------------------------------------------------------------------------------
+
+def get_image(tcg,name):
+    '''
+    Returns a cached card image exactly as it was downloaded (no decoding or re-encoding).
+
+            Parameters:
+                    tcg (str): Card game ('ygo', 'mtg', 'pkmn').
+                    name (str): Card name.
+
+            Returns:
+                    (body,filename) (tuple): Image bytes + file name to upload it with (ex: 'card.jpg'), or None if the image isn't cached.
+    '''
+    conn = storage.connect()
+    row = conn.execute('SELECT Digest, Ext FROM card_art WHERE TCG = ? AND Name = ? AND Digest IS NOT NULL', (tcg, normalize(name))).fetchone()
+    if row is None:
+        return None
+    try:
+        with open(_path(row['Digest'], row['Ext']), 'rb') as file:
+            body = file.read()
+    except OSError:
+        # The file was deleted by hand: forget it.
+        with conn:
+            conn.execute('UPDATE card_art SET Digest = NULL, Ext = NULL, Size = 0 WHERE TCG = ? AND Name = ?', (tcg, normalize(name)))
+        return None
+    with conn:
+        conn.execute('UPDATE card_art SET LastUsed = ? WHERE TCG = ? AND Name = ?', (time.time(), tcg, normalize(name)))
+    return (body, 'card.' + row['Ext'])
+
+def put_image(tcg,name,body):
+    '''
+    Saves a downloaded card image in the cache, then deletes the least recently used images if the cache is over MAX_BYTES.
+
+            Parameters:
+                    tcg (str): Card game ('ygo', 'mtg', 'pkmn').
+                    name (str): Card name.
+                    body (bytes): Image, exactly as downloaded.
+
+            Returns:
+                    filename (str): File name to upload the image with (ex: 'card.jpg').
+    '''
+    digest = hashlib.sha256(body).hexdigest()
+    ext = _extension(body)
+    path = _path(digest, ext)
+    if not os.path.exists(path):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first, so a crash never leaves half an image in the cache.
+        with open(path + '.tmp', 'wb') as file:
+            file.write(body)
+        os.replace(path + '.tmp', path)
+
+    conn = storage.connect()
+    with conn:
+        _upsert(conn, tcg, name, Digest=digest, Ext=ext, Size=len(body))
+    _evict(conn)
+    return 'card.' + ext
+
+def _upsert(conn,tcg,name,**values):
+    values.update({'TCG': tcg, 'Name': normalize(name), 'LastUsed': time.time()})
+    columns = ', '.join(c + ' = :' + c for c in values if c not in ('TCG', 'Name'))
+    cur = conn.execute('UPDATE card_art SET ' + columns + ' WHERE TCG = :TCG AND Name = :Name', values)
+    if cur.rowcount == 0:
+        conn.execute('INSERT INTO card_art (' + ', '.join(values) + ') VALUES (' + ', '.join(':' + c for c in values) + ')', values)
+
+def _evict(conn):
+    # Deletes the least recently used images until the cache fits in MAX_BYTES. An image file can be shared by several names, so it is
+    # only deleted when no name uses it anymore.
+    images = conn.execute('SELECT Digest, Ext, MAX(Size) AS Size, MAX(LastUsed) AS LastUsed FROM card_art WHERE Digest IS NOT NULL '
+                          'GROUP BY Digest, Ext ORDER BY LastUsed').fetchall()
+    total = sum(image['Size'] for image in images)
+    for image in images:
+        if total <= MAX_BYTES:
+            break
+        with conn:
+            conn.execute('UPDATE card_art SET Digest = NULL, Ext = NULL, Size = 0 WHERE Digest = ?', (image['Digest'],))
+        try:
+            os.remove(_path(image['Digest'], image['Ext']))
+        except OSError:
+            pass
+        total -= image['Size']
+
+# URL FUNCTIONS -------------------------------------------------------------------------------------------------------------
+
+def get_url(tcg,name):
+    '''
+    Returns the memoized image URL of a card (ex: the Scryfall image of an MTG card), or None if the card was never looked up.
+    '''
+    key = (tcg, normalize(name))
+    if key not in _urls:
+        row = storage.connect().execute('SELECT URL FROM card_art WHERE TCG = ? AND Name = ? AND URL IS NOT NULL', key).fetchone()
+        if row is None:
+            return None
+        _urls[key] = row['URL']
+    return _urls[key]
+
+def put_url(tcg,name,url):
+    '''
+    Memoizes the image URL of a card (in memory and in the database, so it survives restarts).
+    '''
+    _urls[(tcg, normalize(name))] = url
+    conn = storage.connect()
+    with conn:
+        _upsert(conn, tcg, name, URL=url)
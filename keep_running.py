@@ -1,15 +1,62 @@
-from flask import Flask
-from threading import Thread
+import math
+import os
+from aiohttp import web
+import metrics
 
-app = Flask('')
+# Port of the web server (the hosting service pings '/' to keep Pheme awake).
+PORT = int(os.getenv('PORT', '8080'))
 
-@app.route('/')
-def home():
-  return "Pheme is running!"
+class WebServer:
+  '''
+  Pheme's web server. It runs on the bot's own event loop (no extra thread or WSGI server) and serves '/' (uptime pings), '/metrics' (see
+  metrics.py) and '/health' (Discord connection state, latency and the last successful check of every category).
 
-def run():
-  app.run(host='0.0.0.0', port=8080)
+          Parameters:
+                  client (discord.Client): Pheme's Discord client.
+                  port (int): Port to listen on.
+  '''
+  def __init__(self, client, port=PORT):
+    self.client = client
+    self.port = port
+    self.runner = None
 
-def keep_running():
-  t = Thread(target=run)
-  t.start()
\ No newline at end of file
+  async def start(self):
+    # Starts listening (only once).
+    if self.runner is not None:
+      return
+    app = web.Application()
+    app.router.add_get('/', self.home)
+    app.router.add_get('/metrics', self.show_metrics)
+    app.router.add_get('/health', self.health)
+    self.runner = web.AppRunner(app, access_log=None)
+    await self.runner.setup()
+    await web.TCPSite(self.runner, '0.0.0.0', self.port).start()
+    print('Web server listening on port '+str(self.port)+'.')
+
+  async def stop(self):
+    # Closes the listening socket and the open connections.
+    if self.runner is not None:
+      await self.runner.cleanup()
+      self.runner = None
+
+  async def home(self, request):
+    return web.Response(text="Pheme is running!")
+
+  async def show_metrics(self, request):
+    # Counters and timings in the Prometheus text format (see metrics.py)
+    return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+  async def health(self, request):
+    # Discord connection state and latency + time of the last successful check of every category. HTTP 503 while Pheme is not connected.
+    report = metrics.health()
+    ready = self.client.is_ready() and not self.client.is_closed()
+    latency = self.client.latency
+    shards = getattr(self.client, 'latencies', [])
+    report['status'] = 'ok' if ready else ('closed' if self.client.is_closed() else 'connecting')
+    report['gateway'] = {
+      'ready': ready,
+      'latency_ms': round(latency * 1000, 1) if math.isfinite(latency) else None,
+      'shards': {str(shard): round(seconds * 1000, 1) if math.isfinite(seconds) else None for (shard, seconds) in shards},
+      'guilds': len(self.client.guilds),
+    }
+    return web.json_response(report, status=200 if ready else 503)
@@ -0,0 +1,219 @@
+'''
+Event loop watchdog and sampling profiler.
+
+The watchdog measures how late the event loop wakes up (loop lag). When the loop doesn't wake up for more than STALL_THRESHOLD seconds
+(some code is blocking it), a background thread logs the stack of the blocking code and counts the stall under the name of the task that
+was running (ex: 'command: search', see name_task).
+
+The profiler samples the stack of the event loop thread while the next N commands (or N scheduler checks) run, and saves the samples in the
+folded stack format ('frame;frame;frame count' per line), which flamegraph.pl, speedscope and most flame graph viewers can load. Start it
+with the admin command 'profile (commands|checks) (N)', or with the environment variable PHEME_PROFILE=commands:N (or checks:N).
+'''
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from datetime import datetime
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# VARIABLES -----------------------------------------------------------------------------------------------------------------
+
+# How often the loop is checked (in seconds), and the lag after which the loop is considered stalled.
+TICK = 0.1
+STALL_THRESHOLD = float(os.getenv('PHEME_STALL_THRESHOLD', '0.5'))
+
+# Time between two profiler samples (in seconds), and folder where the profiles are saved.
+SAMPLE_INTERVAL = 0.005
+PROFILE_DIR = os.getenv('PHEME_PROFILE_DIR', 'profiles')
+
+# HELPER FUNCTIONS ----------------------------------------------------------------------------------------------------------
+
+def name_task(name):
+    '''
+    Names the running task, so stalls and profiles can tell which command/job was running (ex: name_task('command: search')).
+    '''
+    task = asyncio.current_task()
+    if task is not None:
+        task.set_name(name)
+
+def _task_name(loop):
+    # Name of the task that the loop is running right now (read from another thread).
+    task = asyncio.current_task(loop)
+    if task is None:
+        return 'loop callbacks'
+    name = task.get_name()
+    return name if not name.startswith('Task-') else 'other task'
+
+def _folded(frame):
+    # Stack of a frame in the folded format, outermost frame first.
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(code.co_name + ' (' + os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+# WATCHDOG ------------------------------------------------------------------------------------------------------------------
+
+class Watchdog:
+    '''
+    Measures the lag of an event loop and reports the stack of the code that blocks it.
+    '''
+    def __init__(self):
+        self.loop = None
+        self.thread_id = None
+        self.last_tick = time.monotonic()
+        self.stalls = Counter()
+        self.task = None
+
+    def start(self):
+        '''
+        Starts the watchdog on the running event loop (only once).
+        '''
+        if self.task is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.task = asyncio.ensure_future(self._tick())
+        threading.Thread(target=self._watch, name='pheme-watchdog', daemon=True).start()
+
+    async def _tick(self):
+        # Runs on the event loop: wakes up every TICK seconds and measures how late it woke up.
+        name_task('watchdog')
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(TICK)
+            self.last_tick = time.monotonic()
+            metrics.loop_lag.observe(max(0.0, self.last_tick - start - TICK))
+
+    def _watch(self):
+        # Runs in its own thread: reports the stack of the event loop thread once per stall.
+        reported = None
+        while True:
+            time.sleep(TICK)
+            last_tick = self.last_tick
+            if time.monotonic() - last_tick < STALL_THRESHOLD or reported == last_tick:
+                continue
+            reported = last_tick
+            frame = sys._current_frames().get(self.thread_id)
+            task = _task_name(self.loop)
+            self.stalls[task] += 1
+            metrics.stalls.inc(task=task)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            logger.warning('Event loop blocked for more than %ss by "%s":\n%s', STALL_THRESHOLD, task, stack)
+
+watchdog = Watchdog()
+
+# PROFILER ------------------------------------------------------------------------------------------------------------------
+
+class Profiler:
+    '''
+    Sampling profiler of the event loop thread. It runs while one of the next N profiled units (commands or scheduler checks) is in progress,
+    and saves the samples as folded stacks (one file per profiling session).
+    '''
+    def __init__(self):
+        self.kind = None
+        self.remaining = 0
+        self.active = 0
+        self.samples = Counter()
+        self.sampling = None
+        self.lock = threading.Lock()
+        self.saved = []
+
+    def start(self, kind, n):
+        '''
+        Profiles the next 'n' units of a kind ('commands' or 'checks').
+
+                Returns:
+                        msg (str): Log message.
+        '''
+        with self.lock:
+            if self.kind is not None:
+                return 'The profiler is already running (' + str(self.remaining) + ' ' + self.kind + ' left).'
+            (self.kind, self.remaining, self.samples) = (kind, n, Counter())
+        return 'Profiling the next ' + str(n) + ' ' + kind + '. The flame graph data will be saved in the "' + PROFILE_DIR + '" folder.'
+
+    def enter(self, kind):
+        '''
+        Called when a unit (command or check) starts. Returns True if it is profiled (then exit must be called when it ends).
+        '''
+        with self.lock:
+            if self.kind != kind or self.remaining == 0:
+                return False
+            self.remaining -= 1
+            self.active += 1
+            if self.sampling is None:
+                self.sampling = threading.Event()
+                try:
+                    loop = asyncio.get_running_loop()
+                except RuntimeError:
+                    loop = None
+                threading.Thread(target=self._sample, args=(threading.get_ident(), loop, self.sampling), name='pheme-profiler', daemon=True).start()
+            return True
+
+    def exit(self, profiled):
+        '''
+        Called when a unit ends (with the value returned by enter). After the last profiled unit, the profile is saved (in a thread when
+        called from the event loop, so writing the file never blocks it).
+        '''
+        if not profiled:
+            return
+        with self.lock:
+            self.active -= 1
+            if self.active > 0 or self.remaining > 0:
+                return
+            self.sampling.set()
+            (kind, samples) = (self.kind, self.samples)
+            (self.kind, self.sampling) = (None, None)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._save(kind, samples)
+        else:
+            loop.run_in_executor(None, self._save, kind, samples)
+
+    def _sample(self, thread_id, loop, stop):
+        # Runs in its own thread: records the stack of the profiled thread (and the name of the running task) every SAMPLE_INTERVAL.
+        while not stop.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                task = _task_name(loop) if loop is not None else 'main'
+                self.samples[task + ';' + _folded(frame)] += 1
+
+    def _save(self, kind, samples):
+        # Writes the samples to a new file of PROFILE_DIR. Returns its path (None if it could not be written).
+        path = os.path.join(PROFILE_DIR, kind + '-' + datetime.now().strftime('%Y%m%d-%H%M%S') + '.folded')
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            with open(path, 'w') as file:
+                for (stack, count) in samples.most_common():
+                    file.write(stack + ' ' + str(count) + '\n')
+        except OSError:
+            logger.exception('Could not save the profile to %s', path)
+            return None
+        self.saved.append(path)
+        logger.info('Profile saved to %s (%d samples).', path, sum(samples.values()))
+        return path
+
+profiler = Profiler()
+
+def _profile_at_startup(value):
+    # Starts the profiling requested at startup, ex: PHEME_PROFILE=commands:20 (or 'commands' for the next 10). A malformed value is reported
+    # and ignored, so it can't stop Pheme from starting.
+    (kind, _, n) = value.strip().partition(':')
+    if kind not in ['commands', 'checks'] or not (n == '' or n.isdigit() and int(n) > 0):
+        logger.warning('Ignoring PHEME_PROFILE=%r: expected "commands:N" or "checks:N"', value)
+        return
+    profiler.start(kind, int(n or 10))
+
+if os.getenv('PHEME_PROFILE'):
+    _profile_at_startup(os.getenv('PHEME_PROFILE'))
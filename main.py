@@ -1,88 +1,160 @@
 # IMPORTS AND VARIABLES ---------------------------------------------------------------------------------------------------
 
-import discord
-from discord.ext import tasks, commands
+# Startup timing report (imported first, so it measures everything that comes after it)
+import startup
+import asyncio
+import logging
 import os #Import token (on .env file)
-from os import system
-system('pip install Pillow')
-# Custom functions:
-from birthday_tracker import birthday
-from tracking import track, price_decrease, status_change, mtg_art, ygo_art, cardprices, gameprices, manga_anime, show_items, stop_tracking
-# For ygo card art
-from PIL import Image
-from io import BytesIO
-from IPython import display
-# Keep the bot running
-from keep_running import keep_running
+import time
+import traceback
+with startup.step('import discord'):
+    import discord
+# Custom functions (the scrapers, their parsers and PIL are only imported when they are first used):
+with startup.step('import pheme modules'):
+    import birthday_tracker
+    from tracking import mtg_art_async, ygo_art_file_async, show_items, stop_tracking, show_history, show_lowest
+    # For ygo card art
+    from io import BytesIO
+    # Response cache counters and sweep statistics
+    import http_client
+    import tracking
+    # Local card name index
+    import card_index
+    # Per-item refresh scheduler
+    from scheduler import Scheduler
+    # Outbound message queue
+    from dispatcher import Dispatcher
+    # Counters and timings served on /metrics
+    import metrics
+    # Server configuration and the items tracked by every server
+    import guilds
+    # Scraping worker processes
+    import workers
+    # User-defined alert rules
+    import alerts
+    # Event loop watchdog and profiler
+    from loop_monitor import watchdog, profiler, name_task
+    # Web server for uptime pings, /metrics and /health
+    from keep_running import WebServer
+
+# Log messages of the pheme modules (retries, circuit breakers, sweeps). PHEME_LOG_LEVEL=DEBUG/INFO/WARNING.
+logging.basicConfig(level=os.getenv('PHEME_LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+class Pheme(discord.AutoShardedClient):
+    '''
+    Pheme's Discord client. The gateway connection is split in as many shards as Discord recommends for the number of servers. The web server
+    (see keep_running.py) runs on the same event loop: it starts before Pheme logs in and stops when she shuts down.
+    '''
+    async def login(self, *args, **kwargs):
+        await web_server.start()
+        return await super().login(*args, **kwargs)
+
+    async def close(self):
+        await web_server.stop()
+        await workers.pool.stop()
+        await super().close()
 
 # Create connection to Discord
-pheme = discord.Client()
+pheme = Pheme()
+web_server = WebServer(pheme)
 
 # Variable definition
 tcgs = ['ygo','pkmn','mtg']
 games = ['physical','digital']
 animanga = ['anime','manga']
 categories = tcgs + games + animanga
+scheduler = Scheduler()
+dispatcher = Dispatcher()
+birthday_task = None
+
+# Channels of the server Pheme was made for (its items, birthdays and channels are adopted by that server, see guilds.adopt)
+legacy_channels = {'series': 806121692266889226, 'tcg': 858715632965779526, 'main': 234416220705783808}
+
+# Commands measured in /metrics (first word of the message; 'show' is measured per card game)
+commands_list = ['info','stats','index','queue','track','stop','list','history','low','search','show','profile','bday','channel','alert']
+metrics.Callback('pheme_queue_items', 'Tracked items waiting in the scheduler queue.', lambda: len(scheduler.due))
+metrics.Callback('pheme_checks_in_flight', 'Tracked items being checked right now.', lambda: len(scheduler.checking))
+metrics.Callback('pheme_outbound_lines_waiting', 'Lines waiting to be sent to Discord.', lambda: dispatcher.waiting)
+metrics.Callback('pheme_outbound_messages_total', 'Messages sent to Discord by the outbound queue.', lambda: dispatcher.messages, 'counter')
+metrics.Callback('pheme_cache_hits_total', 'Web requests answered from the response cache.', lambda: http_client.cache.stats()['hits'], 'counter')
+metrics.Callback('pheme_cache_misses_total', 'Web requests downloaded again.', lambda: http_client.cache.stats()['misses'], 'counter')
+metrics.Callback('pheme_jobs_total', 'Jobs sent to the scraping workers.', lambda: workers.pool.jobs, 'counter')
+metrics.Callback('pheme_jobs_waiting', 'Jobs sent to the scraping workers and waiting for their result.', lambda: len(workers.pool.pending))
+metrics.Callback('pheme_jobs_retried_total', 'Jobs queued again because their worker died.', lambda: workers.pool.retried, 'counter')
+metrics.Callback('pheme_worker_restarts_total', 'Scraping workers restarted after they died.', lambda: workers.pool.restarts, 'counter')
+metrics.Callback('pheme_alert_rules', 'Saved alert rules (of every server).', alerts.count)
 
 # AUTOMATIC ACTIONS THAT REPEAT EVERY X HOURS ------------------------------------------------------------------------------
 @pheme.event
 async def on_ready():
     '''
-    Whenever Pheme is switched on, print a message saying that she is online. Also, get channel names from the channel ids. 
-    Then, run a birthday function every 20 hours, and run a status/price tracking function every 10 hours.
+    Whenever Pheme is switched on, print a message saying that she is online. Also, give the items tracked before Pheme supported several
+    servers to the server she was made for. Then, start the birthday calendar (wishes happy birthday at midnight), and start the scheduler that checks the status/price of every tracked item.
     
     '''
     # Print log message
     print('Pheme is online.')
+    # Print how long the startup took (only the first time, not after reconnections)
+    report = startup.report()
+    if report is not None:
+        print(report)
+    # Report whatever blocks the event loop (see loop_monitor.py)
+    watchdog.start()
+    # Scraping worker processes (see workers.py)
+    workers.pool.start()
 
     # Get channel names from ids
-    series_channel = pheme.get_channel(806121692266889226)
-    tcg_channel = pheme.get_channel(858715632965779526)
-    main_channel = pheme.get_channel(234416220705783808)
+    main_channel = pheme.get_channel(legacy_channels['main'])
+    if main_channel is not None:
+        channel_ids = {cat: legacy_channels['main'] for cat in games+['birthday']}
+        channel_ids.update({cat: legacy_channels['tcg'] for cat in tcgs})
+        channel_ids.update({cat: legacy_channels['series'] for cat in animanga})
+        adopted = guilds.adopt(main_channel.guild.id,channel_ids) + birthday_tracker.adopt(main_channel.guild.id,legacy_channels['main'])
+        if adopted:
+            print('Added '+str(adopted)+' items/birthdays to server '+main_channel.guild.name+'.')
+
+    def send(channel_id,m_list):
+        # Sent in the background, packed with the other messages for the same channel (see dispatcher.py)
+        channel = pheme.get_channel(channel_id)
+        if channel is not None:
+            dispatcher.send(channel,m_list)
     
     #Birthday tracker
-    @tasks.loop(hours=20)
-    async def birthday_loop():
+    async def birthday_messages(messages):
         '''
-        Every 20 hours, execute the birthday function to check if today is a user's birthday. Then, if it's someone's birthday, Pheme will
-        print out a birthday message for the user in the main channel of the server.
+        Called by the birthday calendar every day at midnight (see birthday_tracker.run). If it's someone's birthday, Pheme will print out a
+        birthday message for the user in the birthday channel of their server.
 
         '''
-        reply_list = birthday()
-        if len(reply_list) != 0:
-            for m in reply_list:
-                await main_channel.send(m)
-    birthday_loop.start()
-
-    @tasks.loop(hours=10)
-    async def trackers_and_checkers():
+        name_task('job: birthday')
+        metrics.loop_runs.inc(job='birthday')
+        metrics.last_success.set(time.time(), job='birthday')
+        for (guild_id,channel_id),reply_list in messages.items():
+            send(guilds.channel(guild_id,'birthday',channel_id),reply_list)
+    # Started only once (on_ready runs again after every reconnection)
+    global birthday_task
+    if birthday_task is None:
+        birthday_task = asyncio.ensure_future(birthday_tracker.run(birthday_messages))
+
+    async def trackers_and_checkers(cat,name,m_list):
         '''
-        Every 10 hours, execute the price_decrease and status_change functions to check if the price/status of an item changed. If changes are found,
-        print a message for every change/article to inform the users. If no changes are found, don't print anything. The message(s) will be printed
-        to different server channels depending on the type of item (ex: a changes in card prices will be printed to the tcg channel).
+        Called by the scheduler whenever the price/status of a tracked item changed: print a message for every change to inform the users. The
+        message(s) will be printed in every server that tracks the item, to the channel the server chose for the item's category (ex: a changes
+        in card prices will be printed to the tcg channel). Each item is checked once on its own schedule, however many servers track it, more
+        often if its price/status changes often (see scheduler.py).
         '''
-        for cat in games:
-            m_list = price_decrease(cat)
-            if len(m_list)==0:
-              continue
-            else:
-                for m in m_list:
-                    await main_channel.send(m)
-        for cat in tcgs:
-            m_list = price_decrease(cat)
-            if len(m_list)==0:
-              continue
-            else:
-                for m in m_list:
-                    await tcg_channel.send(m)
-        for cat in animanga:
-            m_list = status_change(cat)
-            if len(m_list)==0:
-              continue
-            else:
-                for m in m_list:
-                    await series_channel.send(m)
-    trackers_and_checkers.start()
+        for channel_id in guilds.subscribers(cat,name):
+            send(channel_id,m_list)
+
+    async def alert_messages(messages):
+        '''
+        Called after a batch of item checks with the alert rules that fired (see alerts.py): every alert is printed in the channel its server
+        chose for the item's category, or else in the channel where the rule was added.
+        '''
+        for (guild_id,cat,channel_id),m_list in messages.items():
+            send(guilds.channel(guild_id,cat,channel_id),m_list)
+    alerts.engine.start(alert_messages)
+    scheduler.start(trackers_and_checkers,alerts.engine.request)
 
 # ACTIONS UPON RECEIVING A USER COMMAND ---------------------------------------------------------------------------------
 # Observation: all commands were made to be case insensitive.
@@ -98,6 +170,8 @@ async def on_message(message):
     reply = message.channel
     msg = message.content
     member = message.author
+    # Server (or direct message channel) whose items the command is about
+    guild_id = guilds.partition(message)
 
     # If message is from Pheme (self), ignore.
     if member == pheme.user: 
@@ -112,99 +186,254 @@ async def on_message(message):
         return
     if member.id == bot_ids["Minerva"]:
         return
+
+    # Time the command (see metrics.py), and name it for the watchdog and the profiler (see loop_monitor.py)
+    words = msg.lower().split(" ")
+    command = " ".join(words[:2]) if words[0] == 'show' else words[0]
+    start = time.perf_counter()
+    profiled = False
+    if words[0] in commands_list:
+        name_task('command: '+command)
+        profiled = profiler.enter('commands')
     
-    # COMMAND: 'info pheme' prints information about Pheme.
-    if msg.lower().startswith('info pheme'):
-        await reply.send('Hello. I am Pheme, the Goddess of rumour, report and gossip! ヽ(>∀<☆)ノ I was reincarnated as a Discord bot on the 30th May 2022 to help you search and track all the juiciest news  (¬‿¬ )')
-    
-    # COMMAND: 'track (category) (search)' takes the string after 'track', expecting the first word to be a category, and the remaining words to be 
-    # the name of an item that the user wants to start tracking. Then, Pheme searches the web for the item's current price/status information, adds
-    # it to a tracking file and also prints a log message for the user.
-    if msg.lower().startswith('track'):
-        category = msg.lower().split(" ")[1]
-        if category not in categories:
-            m = 'Please choose a valid category between "ygo" (cards), "pkmn" (cards), "mtg" (cards), "physical" (games), "digital" (games), "anime" or "manga"'
-        else:
-            search = " ".join(msg.split(" ")[2:])
-            m = track(category,search,1)[0]
-        await reply.send(m)
+    # The command is timed and its profile closed even if it raises an error
+    try:
+        # COMMAND: 'info pheme' prints information about Pheme.
+        if msg.lower().startswith('info pheme'):
+            await reply.send('Hello. I am Pheme, the Goddess of rumour, report and gossip! ヽ(>∀<☆)ノ I was reincarnated as a Discord bot on the 30th May 2022 to help you search and track all the juiciest news  (¬‿¬ )')
     
-    # COMMAND: 'stop (category) (search)' takes the string after 'stop', expecting the first word to be a category, and the remaining words to be 
-    # the name of an item that is currently being tracked by Pheme. Then, Pheme tries to remove the item from the tracking file and prints a log 
-    # message.
-    if msg.lower().startswith('stop'):
-        category = msg.lower().split(" ")[1]
-        if category not in categories:
-            m = 'Please choose a valid category between "ygo" (cards), "pkmn" (cards), "mtg" (cards), "physical" (games), "digital" (games), "anime" or "manga"'
+        # COMMAND: 'stats pheme' prints the response cache counters (how many web requests were answered from the cache and the time saved), the
+        # outcome of the item checks and the websites that are being skipped because they keep failing (circuit breakers).
+        if msg.lower().startswith('stats pheme'):
+            stats = http_client.cache.stats()
+            m = ('Cache: '+str(stats['hits'])+' hits, '+str(stats['misses'])+' misses, '+str(stats['revalidated'])+' revalidated (304), '
+                 +str(stats['entries'])+' entries ('+str(round(stats['bytes']/1024))+' KB). Time saved: '+str(stats['saved_seconds'])+'s.')
+            # Shared searches of the last card sweeps (see tracking.cardprices_batch_async)
+            for tcg,sweep in tracking.sweep_stats.items():
+                m = m+'\nLast '+tcg+' sweep: '+str(sweep['cards'])+' cards, '+str(sweep['fetches'])+' pages downloaded ('+str(round(100*(1-sweep['fetches']/max(1,sweep['cards']))))+'% saved).'
+            for sweep in tracking.sweep_report():
+                m = m+'\n'+sweep
+            if workers.pool.processes:
+                m = m+'\nWorkers: '+str(len(workers.pool.processes))+' processes, '+str(workers.pool.queued())+' jobs queued, '+str(workers.pool.restarts)+' restarts.'
+            if alerts.engine.evaluations:
+                m = m+'\nAlerts: '+str(alerts.count())+' rules, last evaluated in '+str(round(alerts.engine.seconds*1000,1))+'ms, '+str(alerts.engine.fired)+' alerts sent.'
+            for breaker in http_client.breaker_report():
+                m = m+'\nCircuit '+breaker+'.'
             await reply.send(m)
-        else:
-            search = " ".join(msg.split(" ")[2:])
-            m = stop_tracking(category,search)
+
+        # COMMAND: 'index refresh (tcg)' downloads the names of every card of a trading card game, so that card names can be corrected before
+        # Pheme searches the web for them (see card_index.py).
+        if msg.lower().startswith('index refresh'):
+            tcg = (msg.lower().split(" ")+['',''])[2]
+            if tcg not in tcgs:
+                m = 'Please choose a valid category between "ygo" (cards), "pkmn" (cards) or "mtg" (cards)'
+            else:
+                m = await card_index.refresh_async(tcg)
             await reply.send(m)
-    
-    # COMMAND: 'list (category)' takes the word after 'list', expecting it to be a category. Then, it prints all the items being tracked by Pheme
-    # that belong to that category.
-    if msg.lower().startswith('list'):
-        category = msg.lower().split(" ")[1]
-        if category not in categories:
-            m = 'Please choose a valid category between "ygo" (cards), "pkmn" (cards), "mtg" (cards), "physical" (games), "digital" (games), "anime" or "manga"'
+
+        # COMMAND: 'queue' prints the next items that Pheme will check, how often each of them is checked and how often it changed.
+        if msg.lower().startswith('queue'):
+            await dispatcher.send(reply,scheduler.queue())
+
+        # COMMAND: 'profile (commands/checks) (N)' profiles the next N commands or item checks and saves them as flame graph data (see loop_monitor.py).
+        # Only server administrators can use it.
+        if msg.lower().startswith('profile'):
+            permissions = getattr(member, 'guild_permissions', None)
+            if permissions is None or not permissions.administrator:
+                m = 'Only server administrators can use this command.'
+            elif len(words) < 2 or words[1] not in ['commands','checks']:
+                m = 'Please choose what to profile: "commands" or "checks" (ex: "profile commands 10").'
+            else:
+                n = int(words[2]) if len(words) > 2 and words[2].isdigit() else 10
+                m = profiler.start(words[1],n)
             await reply.send(m)
-        else:
-            m_list = show_items(category)
-            if len(m_list) == 0:
-                m = 'No results found for this search.'
+
+        # COMMAND: 'bday add (dd/mm)' saves the birthday of the user (or of the mentioned user) in this server's calendar, 'bday remove' removes
+        # it and 'bday list' prints every saved birthday, starting with the next one. Pheme wishes happy birthday at midnight (see
+        # birthday_tracker.py). Only members who can manage the server can save or remove the birthday of someone else.
+        if words[0] == 'bday':
+            user = message.mentions[0] if message.mentions else member
+            name = getattr(user, 'display_name', user.name)
+            permissions = getattr(member, 'guild_permissions', None)
+            if len(words) > 1 and words[1] in ['add','remove'] and user.id != member.id and (permissions is None or not permissions.manage_guild):
+                await reply.send('Only members who can manage the server can save or remove the birthday of someone else.')
+            elif len(words) > 2 and words[1] == 'add':
+                m = birthday_tracker.add_birthday(user.id,name,words[2],guild_id,reply.id)
                 await reply.send(m)
+            elif len(words) > 1 and words[1] == 'remove':
+                m = birthday_tracker.remove_birthday(user.id,guild_id)
+                await reply.send(m)
+            elif len(words) > 1 and words[1] == 'list':
+                m_list = birthday_tracker.list_birthdays(guild_id)
+                if len(m_list) == 0:
+                    await reply.send('No birthdays saved yet.')
+                else:
+                    await dispatcher.send(reply,m_list)
+            else:
+                await reply.send('Please use "bday add (day/month)", "bday remove" or "bday list".')
+
+        # COMMAND: 'channel (category/birthday/all)' makes the current channel the one where Pheme prints the notifications of a category in this
+        # server, and 'channel list' prints the chosen channels. Only server administrators can choose channels.
+        if words[0] == 'channel':
+            category = (words+[''])[1]
+            permissions = getattr(member, 'guild_permissions', None)
+            if category == 'list':
+                chosen = guilds.channels(guild_id)
+                m = '\n'.join(cat+': <#'+str(chosen[cat])+'>' for cat in guilds.CATEGORIES if cat in chosen) or 'No channels chosen yet: notifications are printed where the items were tracked.'
+            elif permissions is None or not permissions.administrator:
+                m = 'Only server administrators can use this command.'
+            elif category not in guilds.CATEGORIES+['all']:
+                m = 'Please choose a valid category between "ygo", "pkmn", "mtg", "physical", "digital", "anime", "manga", "birthday" or "all"'
             else:
-                for m in m_list:
+                guilds.set_channel(guild_id,category,reply.id)
+                m = 'Pheme will print the '+('' if category == 'all' else category+' ')+'notifications of this server in this channel.'
+            await reply.send(m)
+
+        # COMMAND: 'alert add (category) (rule) (value) (item)' saves an alert rule on an item tracked in this server (ex: 'alert add ygo below 5
+        # Dark Magician'). Rules: 'below (price)', 'drop (percent)', 'low (days)', 'discount' (games, no value) and 'above (number)' (anime/manga).
+        # 'alert list' prints the server's rules and 'alert remove (number)' removes one. The rules are checked after every batch of item checks.
+        if words[0] == 'alert':
+            parts = msg.split(" ")
+            if len(words) > 4 and words[1] == 'add':
+                (category,kind) = (words[2],words[3])
+                (value,item) = ('', " ".join(parts[4:])) if kind == 'discount' else (words[4], " ".join(parts[5:]))
+                m = alerts.add_alert(guild_id,reply.id,category,kind,value,item)
+                alerts.engine.request()
+                await reply.send(m)
+            elif len(words) > 2 and words[1] == 'remove' and words[2].lstrip('#').isdigit():
+                await reply.send(alerts.remove_alert(guild_id,int(words[2].lstrip('#'))))
+            elif len(words) > 1 and words[1] == 'list':
+                m_list = alerts.list_alerts(guild_id)
+                if len(m_list) == 0:
+                    await reply.send('No alerts saved yet.')
+                else:
+                    await dispatcher.send(reply,m_list)
+            else:
+                await reply.send('Please use "alert add (category) (below/drop/low/discount/above) (value) (item)", "alert list" or "alert remove (number)".')
+
+        # COMMAND: 'track (category) (search)' takes the string after 'track', expecting the first word to be a category, and the remaining words to be 
+        # the name of an item that the user wants to start tracking. Then, Pheme searches the web for the item's current price/status information, adds
+        # it to a tracking file and also prints a log message for the user.
+        if msg.lower().startswith('track'):
+            category = msg.lower().split(" ")[1]
+            if category not in categories:
+                m = 'Please choose a valid category between "ygo" (cards), "pkmn" (cards), "mtg" (cards), "physical" (games), "digital" (games), "anime" or "manga"'
+            else:
+                search = " ".join(msg.split(" ")[2:])
+                try:
+                    m = (await workers.pool.run('track',category,search,(guild_id,reply.id)))[0]
+                except workers.JobFailed:
+                    m = 'Pheme could not finish this search. Please try again later.'
+                scheduler.sync()
+            await reply.send(m)
+    
+        # COMMAND: 'stop (category) (search)' takes the string after 'stop', expecting the first word to be a category, and the remaining words to be 
+        # the name of an item that is currently being tracked by Pheme. Then, Pheme tries to remove the item from the tracking file and prints a log 
+        # message.
+        if msg.lower().startswith('stop'):
+            category = msg.lower().split(" ")[1]
+            if category not in categories:
+                m = 'Please choose a valid category between "ygo" (cards), "pkmn" (cards), "mtg" (cards), "physical" (games), "digital" (games), "anime" or "manga"'
+                await reply.send(m)
+            else:
+                search = " ".join(msg.split(" ")[2:])
+                m = stop_tracking(category,search,guild_id)
+                alerts.forget(guild_id,category,search)
+                scheduler.sync()
+                await reply.send(m)
+    
+        # COMMAND: 'list (category)' takes the word after 'list', expecting it to be a category. Then, it prints all the items being tracked by Pheme
+        # that belong to that category.
+        if msg.lower().startswith('list'):
+            category = msg.lower().split(" ")[1]
+            if category not in categories:
+                m = 'Please choose a valid category between "ygo" (cards), "pkmn" (cards), "mtg" (cards), "physical" (games), "digital" (games), "anime" or "manga"'
+                await reply.send(m)
+            else:
+                m_list = show_items(category,guild_id)
+                if len(m_list) == 0:
+                    m = 'No results found for this search.'
                     await reply.send(m)
+                else:
+                    await dispatcher.send(reply,m_list)
     
-    # COMMAND: 'search (category) (search)' takes the string after 'search', expecting the first word to be a category, and the remaining words
-    # to be the name of the item. Then, if it found any results, it prints the name of the top most relevant products found and their prices/statuses.
-    if msg.lower().startswith('search'):
-        category = msg.lower().split(" ")[1]
-        if category not in categories:
-            m = 'Please choose a valid category between "ygo" (cards), "pkmn" (cards), "mtg" (cards), "physical" (games), "digital" (games), "anime" or "manga"'
-            await reply.send(m)
-        else:
-            search = " ".join(msg.split(" ")[2:])
-            if category in games:
-                m_list = gameprices(category,search,1)
-            elif category in tcgs:
-                m_list = cardprices(category,search)
+        # COMMAND: 'history (category) (search)' takes the string after 'history', expecting the first word to be a category, and the remaining words
+        # to be the name of an item that is being tracked in this server. Then, it prints the item's recorded prices/statuses and how often they changed.
+        if msg.lower().startswith('history'):
+            category = msg.lower().split(" ")[1]
+            if category not in categories:
+                m = 'Please choose a valid category between "ygo" (cards), "pkmn" (cards), "mtg" (cards), "physical" (games), "digital" (games), "anime" or "manga"'
+                await reply.send(m)
             else:
-                m_list = manga_anime(category,search)
-            if len(m_list) == 0:
-                m = 'No results found for this search.'
+                search = " ".join(msg.split(" ")[2:])
+                await dispatcher.send(reply,show_history(category,search,guild_id))
+
+        # COMMAND: 'low (category) (search)' takes the string after 'low', expecting the first word to be a card/game category, and the remaining words
+        # to be the name of an item that is being tracked in this server. Then, it prints the lowest price recorded for the item in the last 90 days.
+        if msg.lower().startswith('low '):
+            category = msg.lower().split(" ")[1]
+            if category not in tcgs+games:
+                m = 'Please choose a valid category between "ygo" (cards), "pkmn" (cards), "mtg" (cards), "physical" (games) or "digital" (games)'
+            else:
+                search = " ".join(msg.split(" ")[2:])
+                m = show_lowest(category,search,guild_id)
+            await reply.send(m)
+
+        # COMMAND: 'search (category) (search)' takes the string after 'search', expecting the first word to be a category, and the remaining words
+        # to be the name of the item. Then, if it found any results, it prints the name of the top most relevant products found and their prices/statuses.
+        if msg.lower().startswith('search'):
+            category = msg.lower().split(" ")[1]
+            if category not in categories:
+                m = 'Please choose a valid category between "ygo" (cards), "pkmn" (cards), "mtg" (cards), "physical" (games), "digital" (games), "anime" or "manga"'
                 await reply.send(m)
             else:
-                for m in m_list:
+                search = " ".join(msg.split(" ")[2:])
+                try:
+                    m_list = await workers.pool.run('search',category,search)
+                except workers.JobFailed:
+                    m_list = []
+                if len(m_list) == 0:
+                    m = 'No results found for this search.'
                     await reply.send(m)
+                else:
+                    await dispatcher.send(reply,m_list)
     
-    # COMMAND: 'show mtg (search)' takes the string after 'show mtg' and searches for an image of a Magic the Gathering card of the same name.
-    # Then, Pheme displays the image in the channel where the user requested it.
-    if msg.lower().startswith('show mtg'):
-        search = msg[9:]
-        img = mtg_art(search)
-        await reply.send(img)
-
-    # COMMAND: 'show ygo (search)' takes the string after 'show ygo' and searches for an image of a Yu-Gi-Oh! card of the same name. 
-    # Then, Pheme displays the image in the channel where the user requested it.
-    if msg.lower().startswith('show ygo'):
-        search = msg[9:]
-        img = ygo_art(search)
-        bytes = BytesIO()
-        img.save(bytes,format='PNG')
-        bytes.seek(0)
-        dfile = discord.File(bytes,filename='img.png')
-        await reply.send(file=dfile)
-        
+        # COMMAND: 'show mtg (search)' takes the string after 'show mtg' and searches for an image of a Magic the Gathering card of the same name.
+        # Then, Pheme displays the image in the channel where the user requested it.
+        if msg.lower().startswith('show mtg'):
+            search = msg[9:]
+            img = await mtg_art_async(search)
+            await reply.send(img)
+
+        # COMMAND: 'show ygo (search)' takes the string after 'show ygo' and searches for an image of a Yu-Gi-Oh! card of the same name. 
+        # Then, Pheme displays the image in the channel where the user requested it.
+        if msg.lower().startswith('show ygo'):
+            search = msg[9:]
+            img = await ygo_art_file_async(search)
+            if isinstance(img, str):
+                await reply.send(img)
+            else:
+                # The original image bytes are uploaded as they are (no decoding or re-encoding)
+                (body,filename) = img
+                dfile = discord.File(BytesIO(body),filename=filename)
+                await reply.send(file=dfile)
+    finally:
+        if words[0] in commands_list:
+            metrics.command_seconds.observe(time.perf_counter() - start, command=command)
+        profiler.exit(profiled)
+
     # COMMAND: 'terminate pheme' shuts the bot down (turns it off). This command was only used in development, and is commented in production.
     # if msg.lower().startswith('terminate pheme'):
     #     await reply.send('Going to sleep...')
     #     await pheme.logout()
       
-# Keep server running so the bot never times off.
-keep_running()
+@pheme.event
+async def on_error(event, *args, **kwargs):
+    '''
+    Whenever an event (ex: a command) raises an error, count it in /metrics and print the error.
+    '''
+    metrics.errors.inc(event=event)
+    traceback.print_exc()
 
-# Start Pheme
+# Start Pheme (and her web server, so the bot never times off)
 pheme.run(os.getenv('TOKEN'))
\ No newline at end of file
@@ -0,0 +1,260 @@
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import functools
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime
+
+# VARIABLES -----------------------------------------------------------------------------------------------------------------
+
+# Every metric, in the order they are printed by render().
+REGISTRY = []
+
+# Histogram buckets (in seconds) for web requests, commands and item checks.
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Website scraped by each category (label of the scrape metrics).
+SITES = {'physical': 'nedgame', 'digital': 'steam', 'ygo': 'cardmarket', 'pkmn': 'cardmarket', 'mtg': 'cardmarket', 'anime': 'animebee',
+         'manga': 'mangarock'}
+
+# HELPER FUNCTIONS ----------------------------------------------------------------------------------------------------------
+
+def _labels(names, values):
+    # Prometheus label set, ex: '{site="steam",outcome="ok"}'
+    if not names:
+        return ''
+    pairs = (n + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for (n, v) in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# METRIC TYPES --------------------------------------------------------------------------------------------------------------
+
+class Counter:
+    '''
+    Counter (a number that only goes up), with optional labels. Ex: scrapes.inc(site='steam', outcome='ok').
+
+            Parameters:
+                    name (str): Metric name.
+                    help (str): Description shown in /metrics.
+                    labels (list): Label names.
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, _labels(self.labels, key), value) for (key, value) in sorted(self.values.items())]
+
+class Gauge(Counter):
+    '''
+    Gauge (a number that goes up and down), with optional labels. Ex: last_success.set(time.time(), job='digital').
+    '''
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self.lock:
+            self.values[key] = value
+
+class Callback:
+    '''
+    Metric without labels whose value is read from a function when /metrics is requested (ex: the length of a queue).
+
+            Parameters:
+                    name (str): Metric name.
+                    help (str): Description shown in /metrics.
+                    function (function): Function without parameters that returns the current value.
+                    kind (str): 'gauge' or 'counter'.
+    '''
+    def __init__(self, name, help, function, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.kind = kind
+        REGISTRY.append(self)
+
+    def samples(self):
+        return [(self.name, '', self.function())]
+
+class Histogram:
+    '''
+    Histogram of durations (in seconds), with optional labels. Ex: scrape_seconds.observe(0.31, site='steam').
+
+            Parameters:
+                    name (str): Metric name.
+                    help (str): Description shown in /metrics.
+                    labels (list): Label names.
+                    buckets (tuple): Upper bounds of the buckets.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count of every bucket (not cumulative) + count above the last bucket, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            data[i] += 1
+            data[-1] += value
+
+    def samples(self):
+        result = []
+        with self.lock:
+            for (key, data) in sorted(self.values.items()):
+                total = 0
+                for (bound, count) in zip(self.buckets + (float('inf'),), data):
+                    total += count
+                    result.append((self.name + '_bucket', _labels(self.labels + ('le',), key + (_number(bound),)), total))
+                result.append((self.name + '_sum', _labels(self.labels, key), round(data[-1], 6)))
+                result.append((self.name + '_count', _labels(self.labels, key), total))
+        return result
+
+# PHEME METRICS -------------------------------------------------------------------------------------------------------------
+
+scrape_seconds = Histogram('pheme_scrape_seconds', 'Time to search/scrape a website (download + parsing).', ['site'])
+scrapes = Counter('pheme_scrapes_total', 'Scrapes per website and outcome (ok, empty = nothing found, error).', ['site', 'outcome'])
+command_seconds = Histogram('pheme_command_seconds', 'Time to handle a user command.', ['command'])
+check_seconds = Histogram('pheme_check_seconds', 'Time to check one tracked item (scheduler).', ['category'])
+sweep_seconds = Histogram('pheme_sweep_seconds', 'Time to check every tracked item of a category at once (sweep).', ['category'], BUCKETS + (120, 300, 600))
+sweep_fetches = Counter('pheme_sweep_fetches_total', 'Search pages downloaded by the card sweeps.', ['category'])
+sweep_fetches_saved = Counter('pheme_sweep_fetches_saved_total', 'Search pages the card sweeps did not need to download (shared searches).', ['category'])
+retries = Counter('pheme_http_retries_total', 'Web requests retried after a failed attempt, per host.', ['host'])
+circuit_skipped = Counter('pheme_circuit_skipped_total', 'Web requests skipped because the circuit breaker of their host was open.', ['host'])
+circuit_open = Gauge('pheme_circuit_open', '1 while the circuit breaker of a host is open (the host is being skipped).', ['host'])
+unchanged_skips = Counter('pheme_unchanged_skips_total', 'Item checks that skipped parsing and saving because the page (or API data) did not change.', ['category'])
+coalesced = Counter('pheme_coalesced_total', 'Lookups that joined an identical lookup already in progress instead of fetching again.', ['function'])
+alerts_fired = Counter('pheme_alerts_fired_total', 'Alert rules that fired, per kind of rule (see alerts.py).', ['kind'])
+alert_seconds = Histogram('pheme_alert_evaluation_seconds', 'Time to evaluate every alert rule at once.', buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+checks = Counter('pheme_checks_total', 'Item checks per category and outcome (changed, unchanged, failed).', ['category', 'outcome'])
+loop_runs = Counter('pheme_loop_runs_total', 'Runs of the background jobs.', ['job'])
+last_success = Gauge('pheme_last_success_timestamp_seconds', 'Time of the last successful check/sweep of each category (and of the other jobs).', ['job'])
+errors = Counter('pheme_errors_total', 'Unhandled errors per Discord event.', ['event'])
+loop_lag = Histogram('pheme_loop_lag_seconds', 'How late the event loop wakes up (see loop_monitor.py).', buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+stalls = Counter('pheme_loop_stalls_total', 'Times the event loop was blocked for too long, per running task (ex: "command: search").', ['task'])
+
+def scraper(function):
+    '''
+    Decorator for the async scrapers of tracking.py (their first parameter is the category). Measures the time and outcome of every call.
+    '''
+    @functools.wraps(function)
+    async def wrapper(category, *args, **kwargs):
+        site = SITES.get(category, category)
+        start = time.perf_counter()
+        try:
+            result = await function(category, *args, **kwargs)
+        except Exception:
+            scrapes.inc(site=site, outcome='error')
+            raise
+        finally:
+            scrape_seconds.observe(time.perf_counter() - start, site=site)
+        scrapes.inc(site=site, outcome='ok' if result else 'empty')
+        return result
+    return wrapper
+
+# EXPORT FUNCTIONS ----------------------------------------------------------------------------------------------------------
+
+def render():
+    '''
+    Returns every metric in the Prometheus text format (served on /metrics by keep_running.py).
+    '''
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP ' + metric.name + ' ' + metric.help)
+        lines.append('# TYPE ' + metric.name + ' ' + metric.kind)
+        for (name, labels, value) in metric.samples():
+            lines.append(name + labels + ' ' + _number(value))
+    return '\n'.join(lines) + '\n'
+
+def health():
+    '''
+    Returns Pheme's health report (served on /health by keep_running.py): the time of the last successful check of every category/job.
+    '''
+    with last_success.lock:
+        jobs = {key[0]: datetime.fromtimestamp(value).isoformat(timespec='seconds') for (key, value) in sorted(last_success.values.items())}
+    return {'status': 'ok', 'last_success': jobs}
+
+def snapshot():
+    '''
+    Returns a copy of the values of every counter, gauge and histogram (the callbacks are left out: their functions are read by render()).
+    '''
+    result = {}
+    for metric in REGISTRY:
+        if isinstance(metric, (Counter, Histogram)):
+            with metric.lock:
+                result[metric.name] = {key: list(value) if isinstance(value, list) else value for (key, value) in metric.values.items()}
+    return result
+
+def changes(previous):
+    '''
+    Returns the changes of the metrics since an earlier snapshot. Used by the scraping workers to send their metrics to the bot process, with
+    the result of every job (see workers.py and merge).
+
+            Parameters:
+                    previous (dict): Earlier result of snapshot().
+
+            Returns:
+                    (current,changed) (tuple): Current snapshot + the amounts added to the counters and histograms and the gauges that were
+                            set, as {metric name: {label values: amount/value}}.
+    '''
+    current = snapshot()
+    changed = {}
+    for metric in REGISTRY:
+        old = previous.get(metric.name, {})
+        values = {}
+        for (key, value) in current.get(metric.name, {}).items():
+            before = old.get(key)
+            if value == before:
+                continue
+            if metric.kind == 'counter':
+                values[key] = value - (before or 0)
+            elif metric.kind == 'histogram':
+                values[key] = [v - b for (v, b) in zip(value, before or [0] * len(value))]
+            else:
+                values[key] = value
+        if values:
+            changed[metric.name] = values
+    return (current, changed)
+
+def merge(changed):
+    '''
+    Adds the changes of another process's metrics (see changes) to the metrics of this process.
+    '''
+    for metric in REGISTRY:
+        for (key, value) in changed.get(metric.name, {}).items():
+            with metric.lock:
+                if metric.kind == 'gauge':
+                    metric.values[key] = value
+                elif metric.kind == 'counter':
+                    metric.values[key] = metric.values.get(key, 0) + value
+                else:
+                    data = metric.values.setdefault(key, [0] * (len(metric.buckets) + 1) + [0.0])
+                    for (i, amount) in enumerate(value):
+                        data[i] += amount
@@ -0,0 +1,275 @@
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import hashlib
+import re
+from bs4 import BeautifulSoup, SoupStrainer
+
+# Use the lxml backend (much faster than Python's html.parser) when it is installed.
+try:
+    import lxml
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+# STRAINERS -----------------------------------------------------------------------------------------------------------------
+
+def _classes(*wanted):
+    '''
+    Builds a class matcher for a SoupStrainer: only the elements whose class matches one of the 'wanted' classes (and their contents) are
+    parsed. A wanted value with spaces must match the whole class attribute, a single class name matches any element that has it, which
+    is the same rule soup.find_all uses.
+    '''
+    full = set(w for w in wanted if ' ' in w)
+    single = set(w for w in wanted if ' ' not in w)
+    def match(value):
+        if value is None:
+            return False
+        classes = value.split()
+        return ' '.join(classes) in full or any(c in single for c in classes)
+    return match
+
+# Each webpage only has a few parts that we need, so we parse only those parts (everything else is skipped by the parser).
+NEDGAME_SEARCH = SoupStrainer('div', attrs={'class': _classes('productShopHeader')})
+NEDGAME_PRODUCT = SoupStrainer('div', attrs={'class': _classes('productTitle show-for-mobile', 'buy')})
+STEAM_SEARCH = SoupStrainer(attrs={'class': _classes('search_result_row ds_collapse_flag', 'responsive_search_name_combined')})
+STEAM_PRODUCT = SoupStrainer(attrs={'class': _classes('apphub_AppName', 'game_purchase_price price', 'game_purchase_discount_countdown',
+                                                      'discount_final_price')})
+CARDMARKET = SoupStrainer('div', attrs={'class': _classes('col-10 col-md-8 px-2 flex-column align-items-start justify-content-center',
+                                                          'col-icon small', 'col-price pr-sm-2')})
+MANGA_SEARCH = SoupStrainer('div', attrs={'class': _classes('story_item')})
+ANIME_SEARCH = SoupStrainer('div', attrs={'class': _classes('flw-item flw-item-big')})
+
+# FINGERPRINTS --------------------------------------------------------------------------------------------------------------
+
+# Classes of the parts of each webpage that its extractor reads (the same classes as the strainers above).
+MARKERS = {
+    'nedgame_product': ('productTitle show-for-mobile', 'buy'),
+    'steam_product': ('apphub_AppName', 'game_purchase_price price', 'game_purchase_discount_countdown', 'discount_final_price'),
+    'cardmarket': ('col-10 col-md-8 px-2 flex-column align-items-start justify-content-center', 'col-icon small', 'col-price pr-sm-2'),
+    'manga_search': ('story_item',),
+    'anime_search': ('flw-item flw-item-big',),
+}
+
+# Elements without a closing tag.
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+def _marker_pattern(markers):
+    # Regular expression matching the class attribute of every marked element (same matching rule as _classes).
+    options = [re.escape(m) if ' ' in m else r'(?:[^"]*\s)?' + re.escape(m) + r'(?:\s[^"]*)?' for m in markers]
+    return re.compile(r'class="(?:' + '|'.join(options) + ')"')
+
+_MARKER_PATTERNS = {kind: _marker_pattern(markers) for (kind, markers) in MARKERS.items()}
+
+def _element_end(html,pos):
+    # Position right after the closing tag of the element whose start tag contains 'pos' (the nested elements of the same name are counted).
+    start = html.rfind('<', 0, pos)
+    name = re.match(r'<([A-Za-z][A-Za-z0-9]*)', html[start:pos]).group(1).lower()
+    depth = 0
+    for tag in re.compile(r'<(/?)' + name + r'\b[^>]*?(/?)>', re.IGNORECASE).finditer(html, start):
+        if tag.group(1):
+            depth -= 1
+        elif not tag.group(2) and name not in VOID_TAGS:
+            depth += 1
+        if depth <= 0:
+            return tag.end()
+    return len(html)
+
+def fingerprint(html,kind):
+    '''
+    Returns a fingerprint of the part of a webpage that an extractor reads (from the start of the first marked element to the closing tag of
+    the last one, see MARKERS), without parsing the page. If the fingerprint of a page didn't change, its extracted data didn't change either.
+
+            Parameters:
+                    html (str): Webpage.
+                    kind (str): Name of the extractor ('nedgame_product', 'steam_product', 'cardmarket', 'manga_search' or 'anime_search').
+
+            Returns:
+                    fingerprint (str): Hexadecimal hash, or None if the page has none of the marked elements.
+    '''
+    first = end = None
+    for match in _MARKER_PATTERNS[kind].finditer(html):
+        if first is None:
+            first = match.start()
+        # The marked elements inside an element that was already measured end before it
+        if end is None or match.start() >= end:
+            end = _element_end(html, match.start())
+    if first is None:
+        return None
+    return hashlib.blake2b(html[first:end].encode('utf-8', 'replace'), digest_size=16).hexdigest()
+
+def data_fingerprint(data):
+    '''
+    Returns a fingerprint of data that was already extracted (ex: a Steam API price or a card from a shared Cardmarket search).
+    '''
+    return hashlib.blake2b(repr(data).encode('utf-8', 'replace'), digest_size=16).hexdigest()
+
+def _soup(html,strainer):
+    return BeautifulSoup(html, PARSER, parse_only=strainer)
+
+def _line(text,n):
+    # Returns the n-th line of a text. lxml turns '\r\n' line breaks into '\n' and html.parser keeps them, so both are accepted.
+    return text.replace('\r\n', '\n').split('\n')[n]
+
+# EXTRACTORS ----------------------------------------------------------------------------------------------------------------
+
+def nedgame_search(html,limit=5):
+    '''
+    Extracts the top results of a nedgame.nl search page.
+
+            Parameters:
+                    html (str): Webpage.
+                    limit (int): Maximum number of results.
+
+            Returns:
+                    results (list): List of tuples (title, price_info, url, '').
+    '''
+    soup = _soup(html, NEDGAME_SEARCH)
+    results = []
+    for p in soup.find_all("div", attrs={"class": "productShopHeader"}, limit=limit):
+        title = p.find('div', attrs={'class':'title'}).text.split("\n\n")[1]
+        url = p.find('div', attrs={'class':'titlewrapper'}).find('a', attrs={'class':'productTitleLink'},href=True)['href']
+        all_prices = p.find('div', attrs={'class':'buy'})
+        (states,prices) = (all_prices.find_all('div', attrs={'class':'staat'}), all_prices.find_all("div", attrs={"class":"currentprice"}))
+        price_info = []
+        for s,pr in zip(states,prices):
+            state = (s.text.replace("Nieuw","New").replace("Gebruikt","Used")+': '+pr.text)
+            price_info.append(state)
+        results.append((title, price_info, url, ''))
+    return results
+
+def nedgame_product(html,url):
+    '''
+    Extracts the title and prices of a nedgame.nl product page.
+
+            Parameters:
+                    html (str): Webpage.
+                    url (str): URL of the webpage.
+
+            Returns:
+                    result (tuple): Tuple (title, price_info, url, '').
+    '''
+    soup = _soup(html, NEDGAME_PRODUCT)
+    title = soup.find('div', attrs={'class':'productTitle show-for-mobile'}).text.split("\n")[1]
+    all_prices = soup.find('div', attrs={'class':'buy'})
+    (states, prices) = (all_prices.find_all('div', attrs={'class':'staat'}),all_prices.find_all('div', attrs={'class':'currentprice'}))
+    price_info = []
+    for s,pr in zip(states,prices):
+        state = (s.text.replace("Nieuw","New").replace("Gebruikt","Used")+': '+pr.text)
+        price_info.append(state)
+    return (title, price_info, url, '')
+
+def steam_search(html,limit=5):
+    '''
+    Extracts the top results of a Steam search page.
+
+            Parameters:
+                    html (str): Webpage.
+                    limit (int): Maximum number of results.
+
+            Returns:
+                    results (list): List of tuples (title, price, url, discount_price).
+    '''
+    soup = _soup(html, STEAM_SEARCH)
+    products = soup.find_all("div", attrs={"class": "responsive_search_name_combined"})
+    # The result links are collected once (the i-th link belongs to the i-th product).
+    rows = soup.find_all("a",attrs={"class": "search_result_row ds_collapse_flag"},href=True)
+    results = []
+    for idx,p in enumerate(products):
+        if len(results) == limit:
+            break
+        title = p.find("span", attrs={"class": "title"}).text
+        url = rows[idx]['href']
+        price_div = p.find("div", attrs={"class": "col search_price responsive_secondrow"})
+        if price_div is not None:
+            try:
+                results.append((title, _line(price_div.text,1).strip(), url, ''))
+                continue
+            except IndexError:
+                pass
+        # If the game is on discount, the price on the webpage will be in a different class:
+        discount_div = p.find("div", attrs={"class": "col search_price discounted responsive_secondrow"})
+        try:
+            prices = _line(discount_div.text,1).strip().split("€")
+            results.append((title, prices[0]+'€', url, prices[1]+'€'))
+        except (AttributeError, IndexError):
+            pass
+    return results
+
+def steam_product(html,url):
+    '''
+    Extracts the title, price and discount price of a Steam store page.
+
+            Parameters:
+                    html (str): Webpage.
+                    url (str): URL of the webpage.
+
+            Returns:
+                    result (tuple): Tuple (title, price, url, discount_price). discount_price is '' if the game is not on discount.
+    '''
+    soup = _soup(html, STEAM_PRODUCT)
+    title = soup.find('div', attrs={'class':'apphub_AppName'}).text
+    price = _line(soup.find("div", attrs={"class": "game_purchase_price price"}).text,1).replace('\t','')
+    # If the game is on discount, there is a discount countdown and the discount price is in a different class:
+    countdown = soup.find("p", attrs={"class": "game_purchase_discount_countdown"})
+    discount = soup.find("div", attrs={"class": "discount_final_price"})
+    discount_price = discount.text if (countdown is not None and discount is not None) else ''
+    return (title, price, url, discount_price)
+
+def cardmarket(html):
+    '''
+    Extracts the card names, expansions and prices of a Cardmarket search page.
+
+            Parameters:
+                    html (str): Webpage.
+
+            Returns:
+                    results (list): List of tuples (name, expansion, price).
+    '''
+    soup = _soup(html, CARDMARKET)
+    (cardnames,expansions,prices) = (soup.find_all("div", attrs={"class": "col-10 col-md-8 px-2 flex-column align-items-start justify-content-center"}),
+                                     soup.find_all("div", attrs={"class": "col-icon small"}),
+                                     soup.find_all("div", attrs={"class": "col-price pr-sm-2"}))
+    results = []
+    for n,e,p in zip(cardnames,expansions,prices):
+        name = n.text
+        price = p.text
+        if (name != 'Name') and (price != "From"):
+            expansion = str(e).split('title=')[1].split('"')[1]
+            results.append((name,expansion,price))
+    return results
+
+def manga_search(html):
+    '''
+    Extracts the series and latest chapters of a manga search page.
+
+            Parameters:
+                    html (str): Webpage.
+
+            Returns:
+                    results (list): List of tuples (title, chpt).
+    '''
+    soup = _soup(html, MANGA_SEARCH)
+    results = []
+    for s in soup.find_all("div", attrs={"class": "story_item"}):
+        title = s.find("h3", attrs={"class": "story_name"}).text.split("\n")[1]
+        chpt = s.find("em", attrs={"class": "story_chapter"}).text.split('\n')[2].strip()
+        results.append((title, chpt))
+    return results
+
+def anime_search(html):
+    '''
+    Extracts the series and latest episodes of an animebee search page.
+
+            Parameters:
+                    html (str): Webpage.
+
+            Returns:
+                    results (list): List of tuples (title, ep).
+    '''
+    soup = _soup(html, ANIME_SEARCH)
+    results = []
+    for s in soup.find_all("div", attrs={"class": "flw-item flw-item-big"}):
+        title = s.find("h3", attrs={"class": "film-name"}).text.split("\n")[1]
+        ep = s.find("div", attrs={"class": "tick-item tick-eps"}).text
+        results.append((title, ep))
+    return results
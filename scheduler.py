@@ -0,0 +1,281 @@
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import asyncio
+import heapq
+import logging
+import os
+import random
+import time
+from datetime import datetime
+import metrics
+from loop_monitor import profiler, name_task
+import storage
+import workers
+from http_client import TokenBucket
+from singleflight import normalize
+from tracking import plan_card_queries, STEAM_BATCH
+
+logger = logging.getLogger(__name__)
+
+# VARIABLES -----------------------------------------------------------------------------------------------------------------
+
+HOUR = 3600
+
+# Time between two checks of a newly tracked item, per category (in seconds). Steam sale prices change more often than card prices.
+DEFAULT_INTERVALS = {
+    'digital': 4 * HOUR,
+    'physical': 8 * HOUR,
+    'ygo': 12 * HOUR,
+    'pkmn': 12 * HOUR,
+    'mtg': 12 * HOUR,
+    'anime': 6 * HOUR,
+    'manga': 6 * HOUR,
+}
+
+# The interval of an item is multiplied by FASTER when its price/status changed, and by SLOWER when it didn't, within these limits.
+MIN_INTERVAL = 1 * HOUR
+MAX_INTERVAL = 48 * HOUR
+FASTER = 0.5
+SLOWER = 1.5
+
+# Items that could not be refreshed are retried after at most RETRY_INTERVAL seconds.
+RETRY_INTERVAL = 1 * HOUR
+
+# Every next check is moved by up to +/- JITTER (fraction of the interval), so items tracked together don't stay together.
+JITTER = 0.1
+
+# Items of the same category that are due within BATCH_WINDOW seconds are checked together (at most BATCH_SIZE at a time), so they share
+# their downloads (see tracking.refresh_batch_async). The first item of a batch is checked on time, the others a little early.
+BATCH_WINDOW = 60
+BATCH_SIZE = 10
+
+# Steam prices are read from the storefront API, 50 games per request (see tracking.STEAM_BATCH): the digital games due within the next
+# 15 minutes are checked together.
+# Cards share their Cardmarket searches (see tracking.plan_card_queries): the cards due within the next 30 minutes are checked together, and
+# so are the cards due within CARD_LOOKAHEAD seconds whose search is covered by a search of the batch (they cost no extra download).
+BATCH_WINDOWS = {'digital': 15 * 60, 'ygo': 30 * 60, 'pkmn': 30 * 60, 'mtg': 30 * 60}
+BATCH_SIZES = {'digital': 50, 'ygo': 50, 'pkmn': 50, 'mtg': 50}
+CARD_LOOKAHEAD = 4 * HOUR
+
+# Global budget of web requests per minute for the item checks, on top of the per-host limits of http_client.py. A batch is charged for the
+# requests it sends (see Scheduler._requests), not for its items.
+REQUESTS_PER_MINUTE = int(os.getenv('PHEME_REQUESTS_PER_MINUTE', '30'))
+
+# SCHEDULER -----------------------------------------------------------------------------------------------------------------
+
+class Scheduler:
+    '''
+    Refreshes every tracked item on its own schedule. A priority queue (heap) holds the time of the next check of each item, and the time
+    between two checks adapts to how often the item actually changes. The schedule is saved in the database (table "schedule"), so it
+    survives restarts.
+
+            Parameters:
+                    rpm (int): Maximum number of web requests per minute sent by the item checks.
+    '''
+    def __init__(self, rpm=REQUESTS_PER_MINUTE):
+        self.rpm = rpm
+        self.budget = TokenBucket(rpm / 60, max(1, rpm // 6))
+        # Heap of (next check, category, name). When an item is rescheduled or removed, its old heap entry stays in the heap and is skipped
+        # (it no longer matches 'due').
+        self.heap = []
+        self.due = {}
+        self.notify = None
+        self.checked = None
+        self.task = None
+        # Items being checked right now: (category, name) -> task
+        self.checking = {}
+        self.checks = 0
+        self.wakeup = None
+
+    def _push(self, category, name, next_check):
+        self.due[(category, name)] = next_check
+        heapq.heappush(self.heap, (next_check, category, name))
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def sync(self, spread=False):
+        '''
+        Adds the newly tracked items to the queue and removes the items that are no longer tracked. Call it after 'track' and 'stop'.
+
+                Parameters:
+                        spread (bool): If True, new items without a saved schedule get their first check at a random time within their
+                                       interval (used at startup, so the first checks are spread out instead of all happening at once).
+        '''
+        conn = storage.connect()
+        items = {(row['Category'], row['Name']) for row in conn.execute('SELECT Category, Name FROM prices UNION SELECT Category, Name FROM statuses')}
+        saved = {(row['Category'], row['Name']): row for row in conn.execute('SELECT * FROM schedule')}
+        now = time.time()
+
+        for key in [key for key in self.due if key not in items]:
+            del self.due[key]
+        with conn:
+            conn.executemany('DELETE FROM schedule WHERE Category = ? AND Name = ?', [key for key in saved if key not in items])
+            for key in items:
+                if key in self.due or key in self.checking:
+                    continue
+                if key in saved:
+                    self._push(key[0], key[1], saved[key]['NextCheck'])
+                    continue
+                interval = DEFAULT_INTERVALS.get(key[0], MAX_INTERVAL)
+                next_check = now + interval * (random.random() if spread else 1 + random.uniform(-JITTER, JITTER))
+                conn.execute('INSERT INTO schedule (Category, Name, Interval, NextCheck, Checks, Changes) VALUES (?, ?, ?, ?, 0, 0)',
+                             (key[0], key[1], interval, next_check))
+                self._push(key[0], key[1], next_check)
+
+    def start(self, notify, checked=None):
+        '''
+        Starts the scheduler on the running event loop (only once; later calls only replace 'notify' and 'checked').
+
+                Parameters:
+                        notify (function): Async function called as notify(category, name, msg_list) with the messages about an item's changes.
+                        checked (function): Function called as checked(category, name) after every successful check (ex: alerts.AlertEngine.request).
+        '''
+        self.notify = notify
+        self.checked = checked
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.sync(spread=True)
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        # Waits for the next due item, adds the items of its category that are due soon (see BATCH_WINDOWS), takes a token from the global
+        # budget for every web request of the batch and checks them in the background.
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            (next_check, category, name) = self.heap[0]
+            if self.due.get((category, name)) != next_check:
+                heapq.heappop(self.heap)
+                continue
+            delay = next_check - time.time()
+            if delay > 0:
+                # Sleep until the item is due, or until an item is added to the queue
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.heap)
+            del self.due[(category, name)]
+            names = self._batch(category, name)
+            for _ in range(self._requests(category, names)):
+                await self.budget.acquire()
+            task = asyncio.ensure_future(self.check(category, names))
+            keys = [(category, name) for name in names]
+            for key in keys:
+                self.checking[key] = task
+            task.add_done_callback(lambda _, keys=keys: [self.checking.pop(key, None) for key in keys])
+
+    def _batch(self, category, name):
+        # Returns the names of the items checked together with a due item (taken from the queue), the item first
+        now = time.time()
+        size = BATCH_SIZES.get(category, BATCH_SIZE)
+        names = [name] + self._take_due(category, now + BATCH_WINDOWS.get(category, BATCH_WINDOW), size - 1)
+        if category in ['ygo','pkmn','mtg']:
+            (groups, parents) = plan_card_queries(names)
+            roots = [key for key in groups if key not in parents]
+            names += self._take_due(category, now + CARD_LOOKAHEAD, size - len(names), lambda n: any(root in normalize(n) for root in roots))
+        return names
+
+    @staticmethod
+    def _requests(category, names):
+        # Number of web requests of a batch: one per STEAM_BATCH digital games (storefront API), one per distinct Cardmarket search that is
+        # not covered by a shorter one (see tracking.plan_card_queries) and one per item otherwise
+        if category == 'digital':
+            return -(-len(names) // STEAM_BATCH)
+        if category in ['ygo','pkmn','mtg']:
+            (groups, parents) = plan_card_queries(names)
+            return len(groups) - len(parents)
+        return len(names)
+
+    def _take_due(self, category, until, limit, match=None):
+        # Removes from the queue (and returns the names of) up to 'limit' items of a category that are due before 'until' (and for which
+        # match(name) is True, if given), the earliest first
+        due = heapq.nsmallest(limit, ((next_check, key) for (key, next_check) in self.due.items()
+                                      if key[0] == category and next_check <= until and (match is None or match(key[1]))))
+        for (next_check, key) in due:
+            del self.due[key]
+        return [key[1] for (next_check, key) in due]
+
+    async def check(self, category, names):
+        '''
+        Refreshes a batch of items of one category, reschedules them and sends the messages about their changes.
+        '''
+        # The items are refreshed together by a worker process (see workers.py). Whatever happens, they are rescheduled (in RETRY_INTERVAL at
+        # most if the check failed or was cancelled).
+        name_task('check: '+category)
+        profiled = profiler.enter('checks')
+        start = time.perf_counter()
+        results = None
+        try:
+            results = dict(await workers.pool.run('refresh', category, tuple(names)))
+        except workers.JobFailed:
+            pass
+        except Exception:
+            logger.exception('Check of %d %s items failed', len(names), category)
+        finally:
+            profiler.exit(profiled)
+            seconds = (time.perf_counter() - start) / len(names)
+            for name in names:
+                # The items missing from the results are no longer tracked (or were renamed, see storage._rename_item)
+                if results is None or name in results:
+                    self._reschedule(category, name, None if results is None else results[name], seconds)
+            if results is not None and len(results) < len(names):
+                self.sync()
+
+        for (name, result) in (results or {}).items():
+            if result is not None and result[0] and self.notify is not None:
+                await self.notify(category, name, result[0])
+
+    def _reschedule(self, category, name, result, seconds):
+        # Records the check of an item (result: None if it failed, seconds: its share of the batch's time) and schedules the next one: sooner
+        # if the item changed, later if it didn't.
+        self.checks += 1
+        metrics.check_seconds.observe(seconds, category=category)
+        if result is None:
+            metrics.checks.inc(category=category, outcome='failed')
+        else:
+            metrics.checks.inc(category=category, outcome='changed' if result[1] else 'unchanged')
+            metrics.last_success.set(time.time(), job=category)
+
+        conn = storage.connect()
+        saved = conn.execute('SELECT * FROM schedule WHERE Category = ? AND Name = ?', (category, name)).fetchone()
+        interval = saved['Interval'] if saved else DEFAULT_INTERVALS.get(category, MAX_INTERVAL)
+        changed = result is not None and result[1]
+        if result is None:
+            wait = min(interval, RETRY_INTERVAL)
+        else:
+            interval = min(MAX_INTERVAL, max(MIN_INTERVAL, interval * (FASTER if changed else SLOWER)))
+            wait = interval
+        next_check = time.time() + wait * (1 + random.uniform(-JITTER, JITTER))
+        # In the queue first, so the item is checked again even if the database can't be written right now
+        if (category, name) not in self.due:
+            self._push(category, name, next_check)
+        with conn:
+            conn.execute('UPDATE schedule SET Interval = ?, NextCheck = ?, Checks = Checks + ?, Changes = Changes + ? WHERE Category = ? AND Name = ?',
+                         (interval, next_check, int(result is not None), int(changed), category, name))
+        if result is not None and self.checked is not None:
+            self.checked(category, name)
+
+    def queue(self, limit=10):
+        '''
+        Describes the queue: the next items to be checked, their check interval and how often they changed.
+
+                Parameters:
+                        limit (int): Number of items to show.
+
+                Returns:
+                        msg_list (list): List of messages (a summary + one message per item).
+        '''
+        saved = {(row['Category'], row['Name']): row for row in storage.connect().execute('SELECT * FROM schedule')}
+        upcoming = heapq.nsmallest(limit, ((next_check, key) for (key, next_check) in self.due.items()))
+        msg_list = [str(len(self.due))+' items in the queue, '+str(len(self.checking))+' being checked. Budget: '+str(self.rpm)+' requests per minute.']
+        for (next_check, (category, name)) in upcoming:
+            row = saved.get((category, name))
+            msg = datetime.fromtimestamp(next_check).strftime("%m/%d/%Y, %H:%M")+': '+name+' ('+category+')'
+            if row is not None:
+                msg = msg+', checked every '+str(round(row['Interval'] / HOUR, 1))+'h, changed '+str(row['Changes'])+' times in '+str(row['Checks'])+' checks'
+            msg_list.append(msg+'.')
+        return msg_list
@@ -0,0 +1,42 @@
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import asyncio
+import copy
+import functools
+import metrics
+
+# VARIABLES -----------------------------------------------------------------------------------------------------------------
+
+# Calls in progress: (event loop, function, normalized arguments) -> task
+_inflight = {}
+
+# HELPER FUNCTIONS ----------------------------------------------------------------------------------------------------------
+
+def normalize(value):
+    '''
+    Normalizes a text argument so that 'Dark  Magician' and 'dark magician' are the same lookup. Other values are kept as they are.
+    '''
+    if isinstance(value, str):
+        return ' '.join(value.lower().split())
+    return value
+
+# DECORATOR -----------------------------------------------------------------------------------------------------------------
+
+def coalesce(function):
+    '''
+    Decorator for async lookups (ex: cardprices_async): concurrent calls with the same (normalized) arguments share one call in progress
+    instead of each downloading and parsing the same page. The first caller runs the lookup; the others wait for it and receive a copy of its
+    result (or its error). If the first caller is cancelled, the lookup still finishes for the others.
+    '''
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        key = (asyncio.get_running_loop(), function.__qualname__) + tuple(normalize(a) for a in args) + tuple(sorted(kwargs.items()))
+        task = _inflight.get(key)
+        if task is not None:
+            metrics.coalesced.inc(function=function.__name__)
+            return copy.deepcopy(await asyncio.shield(task))
+        task = asyncio.ensure_future(function(*args, **kwargs))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+        return await asyncio.shield(task)
+    return wrapper
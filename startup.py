@@ -0,0 +1,62 @@
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# VARIABLES -----------------------------------------------------------------------------------------------------------------
+
+# Time when this module was imported (main.py imports it first, so this is the start of Pheme's startup).
+START = time.perf_counter()
+
+# File where every startup report is appended (one JSON object per line), to follow cold-start times between versions.
+LOG_PATH = os.getenv('PHEME_STARTUP_LOG', 'startup_times.log')
+
+# Startup steps in order: list of (step name, duration in seconds).
+steps = []
+_reported = False
+
+# TIMING FUNCTIONS ----------------------------------------------------------------------------------------------------------
+
+@contextmanager
+def step(name):
+    '''
+    Context manager that measures one startup step, ex: 'with step("import discord"): import discord'.
+
+            Parameters:
+                    name (str): Name of the step in the startup report.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        steps.append((name, time.perf_counter() - start))
+
+def report(name='gateway ready'):
+    '''
+    Builds the startup report the first time Pheme is ready (later calls, ex: after a reconnection, return None). The time between the last
+    measured step and now is reported as 'name'. The report is also appended to LOG_PATH.
+
+            Parameters:
+                    name (str): Name of the last step.
+
+            Returns:
+                    msg (str): Startup report, ex: 'Startup took 2.31s: import discord 0.52s, import pheme modules 0.08s, gateway ready 1.71s.'
+    '''
+    global _reported
+    if _reported:
+        return None
+    _reported = True
+    total = time.perf_counter() - START
+    steps.append((name, total - sum(seconds for (_, seconds) in steps)))
+
+    try:
+        with open(LOG_PATH, 'a') as file:
+            file.write(json.dumps({'date': datetime.now().isoformat(timespec='seconds'), 'total': round(total, 3),
+                                   'steps': {n: round(seconds, 3) for (n, seconds) in steps}}) + '\n')
+    except OSError:
+        pass
+
+    return 'Startup took '+str(round(total, 2))+'s: '+', '.join(n+' '+str(round(seconds, 2))+'s' for (n, seconds) in steps)+'.'
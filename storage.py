@@ -0,0 +1,587 @@
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import csv
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from os.path import exists
+
+# VARIABLES -----------------------------------------------------------------------------------------------------------------
+
+# Database file with all the tracked items (replaces "price_tracker.csv" and "status_tracker.csv").
+DB_PATH = os.getenv('PHEME_DB', 'pheme.db')
+
+# Old tracking files, imported once into the database by migrate_csv.
+PRICE_CSV = 'price_tracker.csv'
+STATUS_CSV = 'status_tracker.csv'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS prices (
+    Name TEXT NOT NULL,
+    Category TEXT NOT NULL,
+    Lowest_Price REAL NOT NULL,
+    Expansion TEXT NOT NULL DEFAULT '',
+    DateChecked TEXT NOT NULL,
+    URL TEXT NOT NULL DEFAULT '',
+    Fingerprint TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS prices_url ON prices (URL);
+
+CREATE TABLE IF NOT EXISTS statuses (
+    Name TEXT NOT NULL,
+    Category TEXT NOT NULL,
+    Status TEXT NOT NULL,
+    DateChecked TEXT NOT NULL,
+    Fingerprint TEXT NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS card_art (
+    TCG TEXT NOT NULL,
+    Name TEXT NOT NULL,
+    URL TEXT,
+    Digest TEXT,
+    Ext TEXT,
+    Size INTEGER NOT NULL DEFAULT 0,
+    LastUsed REAL NOT NULL,
+    PRIMARY KEY (TCG, Name)
+);
+CREATE INDEX IF NOT EXISTS card_art_digest ON card_art (Digest);
+
+CREATE TABLE IF NOT EXISTS card_names (
+    TCG TEXT NOT NULL,
+    Name TEXT NOT NULL,
+    PRIMARY KEY (TCG, Name)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS card_index_versions (
+    TCG TEXT PRIMARY KEY,
+    Version INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS schedule (
+    Category TEXT NOT NULL,
+    Name TEXT NOT NULL,
+    Interval REAL NOT NULL,
+    NextCheck REAL NOT NULL,
+    Checks INTEGER NOT NULL DEFAULT 0,
+    Changes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (Category, Name)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS guild_channels (
+    GuildID INTEGER NOT NULL,
+    Category TEXT NOT NULL,
+    ChannelID INTEGER NOT NULL,
+    PRIMARY KEY (GuildID, Category)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS subscriptions (
+    GuildID INTEGER NOT NULL,
+    Category TEXT NOT NULL,
+    Name TEXT NOT NULL,
+    ChannelID INTEGER NOT NULL,
+    PRIMARY KEY (GuildID, Category, Name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS subscriptions_item ON subscriptions (Category, Name);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    ID INTEGER PRIMARY KEY AUTOINCREMENT,
+    Kind TEXT NOT NULL,
+    Args TEXT NOT NULL,
+    State TEXT NOT NULL DEFAULT 'queued',
+    Worker INTEGER,
+    Attempts INTEGER NOT NULL DEFAULT 0,
+    Result BLOB,
+    Error TEXT,
+    Created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (State, ID);
+
+CREATE TABLE IF NOT EXISTS alerts (
+    ID INTEGER PRIMARY KEY AUTOINCREMENT,
+    GuildID INTEGER NOT NULL,
+    ChannelID INTEGER NOT NULL,
+    Category TEXT NOT NULL,
+    Name TEXT NOT NULL,
+    Kind TEXT NOT NULL,
+    Value REAL NOT NULL DEFAULT 0,
+    Active INTEGER NOT NULL DEFAULT 0,
+    LastFired REAL
+);
+CREATE INDEX IF NOT EXISTS alerts_guild ON alerts (GuildID);
+
+CREATE TABLE IF NOT EXISTS rate_limits (
+    Host TEXT PRIMARY KEY,
+    Tokens REAL NOT NULL,
+    Updated REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS circuit_breakers (
+    Host TEXT PRIMARY KEY,
+    Failures INTEGER NOT NULL,
+    Opened REAL,
+    Cooldown REAL NOT NULL,
+    Probing REAL,
+    Skipped INTEGER NOT NULL,
+    SavedSeconds REAL NOT NULL,
+    FailureSeconds REAL NOT NULL
+) WITHOUT ROWID;
+'''
+
+# Unique indexes of the tracked items (created by migrate_indexes): a card/game/series is tracked once per category by name, and a game
+# once by URL.
+UNIQUE_INDEXES = {
+    'prices_item': 'prices (Category, Name)',
+    'prices_game': "prices (Category, URL) WHERE URL != ''",
+    'statuses_item': 'statuses (Category, Name)',
+}
+
+# Number of days covered by the history queries when no other value is given.
+HISTORY_DAYS = 90
+
+# Every thread gets its own connection (sqlite3 connections can't be shared between threads).
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = False
+
+# CONNECTION FUNCTIONS ------------------------------------------------------------------------------------------------------
+
+def connect():
+    '''
+    Returns this thread's connection to the tracking database. The first call creates the tables and imports the old CSV tracking files.
+
+            Returns:
+                    conn (sqlite3.Connection): Database connection in WAL mode (rows can be accessed by column name).
+    '''
+    global _initialized
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        conn.row_factory = sqlite3.Row
+        # WAL: readers never block the writer and a crash in the middle of a write can't corrupt the database.
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _local.conn = conn
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                conn.executescript(SCHEMA)
+                migrate_columns(conn)
+                migrate_csv(conn)
+                migrate_indexes(conn)
+                _initialized = True
+    return conn
+
+@contextmanager
+def immediate():
+    '''
+    Context manager: a transaction that takes the database's write lock at once (BEGIN IMMEDIATE), for the read-modify-write changes of the
+    state shared by several processes (see http_client.share_state). Committed at the end, rolled back if an error is raised.
+
+            Returns:
+                    conn (sqlite3.Connection): This thread's database connection.
+    '''
+    conn = connect()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+def migrate_columns(conn):
+    '''
+    Adds the columns that were added to the tables after the database was created.
+
+            Parameters:
+                    conn (sqlite3.Connection): Database connection.
+    '''
+    for table in ['prices', 'statuses']:
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(' + table + ')')}
+        if 'Fingerprint' not in columns:
+            with conn:
+                conn.execute('ALTER TABLE ' + table + " ADD COLUMN Fingerprint TEXT NOT NULL DEFAULT ''")
+
+def migrate_indexes(conn):
+    '''
+    Creates the unique indexes of the tracked items (see UNIQUE_INDEXES). Older databases only had plain indexes and could hold the same
+    item twice: the duplicates are removed first (the row tracked first is kept).
+
+            Parameters:
+                    conn (sqlite3.Connection): Database connection.
+    '''
+    existing = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    if all(name in existing for name in UNIQUE_INDEXES):
+        return
+    with conn:
+        conn.execute("DELETE FROM prices WHERE URL != '' AND rowid NOT IN "
+                     "(SELECT MIN(rowid) FROM prices WHERE URL != '' GROUP BY Category, URL)")
+        conn.execute('DELETE FROM prices WHERE rowid NOT IN (SELECT MIN(rowid) FROM prices GROUP BY Category, Name)')
+        conn.execute('DELETE FROM statuses WHERE rowid NOT IN (SELECT MIN(rowid) FROM statuses GROUP BY Category, Name)')
+        conn.execute('DROP INDEX IF EXISTS prices_category_name')
+        conn.execute('DROP INDEX IF EXISTS statuses_category_name')
+        for (name, target) in UNIQUE_INDEXES.items():
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS ' + name + ' ON ' + target)
+
+def migrate_csv(conn):
+    '''
+    One-time migration: copies the rows of the old pipe-delimited tracking files into the database, then renames the files to
+    "<file>.migrated" so they are never imported twice.
+
+            Parameters:
+                    conn (sqlite3.Connection): Database connection.
+    '''
+    if exists(PRICE_CSV):
+        with open(PRICE_CSV, newline='', encoding='utf-8') as file:
+            rows = [(r['Name'], r['Category'], float(r['Lowest_Price']), r['Expansion'] or '', r['DateChecked'], r['URL'] or '')
+                    for r in csv.DictReader(file, delimiter='|')]
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO prices (Name, Category, Lowest_Price, Expansion, DateChecked, URL) '
+                             'VALUES (?,?,?,?,?,?)', rows)
+        os.replace(PRICE_CSV, PRICE_CSV + '.migrated')
+        print('Migrated ' + str(len(rows)) + ' items from ' + PRICE_CSV + '.')
+
+    if exists(STATUS_CSV):
+        with open(STATUS_CSV, newline='', encoding='utf-8') as file:
+            rows = [(r['Name'], r['Category'], r['Status'], r['DateChecked']) for r in csv.DictReader(file, delimiter='|')]
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO statuses (Name, Category, Status, DateChecked) VALUES (?,?,?,?)', rows)
+        os.replace(STATUS_CSV, STATUS_CSV + '.migrated')
+        print('Migrated ' + str(len(rows)) + ' items from ' + STATUS_CSV + '.')
+
+# PRICE FUNCTIONS -----------------------------------------------------------------------------------------------------------
+
+def get_price(category,name='',url=''):
+    '''
+    Looks up a tracked card/game. Games are identified by their URL and cards by their name.
+
+            Parameters:
+                    category (str): Item category ('ygo','pkmn','mtg','physical','digital').
+                    name (str): Card name (only used if url is empty).
+                    url (str): Game URL.
+
+            Returns:
+                    row (sqlite3.Row): Row with the item's data, or None if the item is not being tracked.
+    '''
+    conn = connect()
+    if url:
+        return conn.execute('SELECT * FROM prices WHERE URL = ? AND Category = ?', (url, category)).fetchone()
+    return conn.execute('SELECT * FROM prices WHERE Category = ? AND Name = ?', (category, name)).fetchone()
+
+def upsert_price(row):
+    '''
+    Inserts a tracked card/game, or updates it if it is already in the database, in a single transaction.
+
+            Parameters:
+                    row (dict): Dictionary with the keys Name, Category, Lowest_Price, Expansion, DateChecked and URL.
+    '''
+    conn = connect()
+    with conn:
+        _upsert_price(conn, row)
+
+def _upsert_price(conn,row):
+    # Games are found by their URL (their title can change) and cards by their name. A single statement against the unique indexes (see
+    # UNIQUE_INDEXES), so two processes tracking the same item at the same time can't both insert it.
+    row.setdefault('Fingerprint', '')
+    if row['URL']:
+        old = conn.execute('SELECT Name FROM prices WHERE URL = :URL AND Category = :Category', row).fetchone()
+        if old is not None and old['Name'] != row['Name']:
+            # The new title replaces any other game tracked under it
+            conn.execute('DELETE FROM prices WHERE Category = :Category AND Name = :Name AND URL != :URL', row)
+            _rename_item(conn, row['Category'], old['Name'], row['Name'])
+    conn.execute('INSERT INTO prices (Name, Category, Lowest_Price, Expansion, DateChecked, URL, Fingerprint) '
+                 'VALUES (:Name, :Category, :Lowest_Price, :Expansion, :DateChecked, :URL, :Fingerprint) '
+                 "ON CONFLICT (Category, URL) WHERE URL != '' DO UPDATE SET Name = excluded.Name, Lowest_Price = excluded.Lowest_Price, "
+                 'Expansion = excluded.Expansion, DateChecked = excluded.DateChecked, Fingerprint = excluded.Fingerprint '
+                 'ON CONFLICT (Category, Name) DO UPDATE SET Lowest_Price = excluded.Lowest_Price, Expansion = excluded.Expansion, '
+                 'DateChecked = excluded.DateChecked, URL = excluded.URL, Fingerprint = excluded.Fingerprint', row)
+    _record_history(conn, row)
+
+def _rename_item(conn,category,old,new):
+    # The title of a game changed on its store page (games are identified by their URL): the rows that refer to the game by name follow it,
+    # inside the caller's transaction, so its subscriptions, alert rules, schedule and history are kept.
+    tables = ['subscriptions', 'alerts', 'schedule'] + [t['name'] for t in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                                                                         "AND name GLOB 'history_[0-9]*'")]
+    for table in tables:
+        conn.execute('UPDATE OR REPLACE ' + table + ' SET Name = ? WHERE Category = ? AND Name = ?', (new, category, old))
+
+def list_prices(category):
+    '''
+    Returns every tracked card/game of a category, in the order they started being tracked.
+
+            Parameters:
+                    category (str): Item category ('ygo','pkmn','mtg','physical','digital').
+
+            Returns:
+                    rows (list): List of sqlite3.Row.
+    '''
+    return connect().execute('SELECT * FROM prices WHERE Category = ? ORDER BY rowid', (category,)).fetchall()
+
+# STATUS FUNCTIONS ----------------------------------------------------------------------------------------------------------
+
+def get_status(category,name):
+    '''
+    Looks up a tracked series.
+
+            Parameters:
+                    category (str): Series type ('anime' or 'manga').
+                    name (str): Series name.
+
+            Returns:
+                    row (sqlite3.Row): Row with the series' data, or None if the series is not being tracked.
+    '''
+    return connect().execute('SELECT * FROM statuses WHERE Category = ? AND Name = ?', (category, name)).fetchone()
+
+def upsert_status(row):
+    '''
+    Inserts a tracked series, or updates it if it is already in the database, in a single transaction.
+
+            Parameters:
+                    row (dict): Dictionary with the keys Name, Category, Status and DateChecked.
+    '''
+    conn = connect()
+    with conn:
+        _upsert_status(conn, row)
+
+def _upsert_status(conn,row):
+    row.setdefault('Fingerprint', '')
+    conn.execute('INSERT INTO statuses (Name, Category, Status, DateChecked, Fingerprint) '
+                 'VALUES (:Name, :Category, :Status, :DateChecked, :Fingerprint) '
+                 'ON CONFLICT (Category, Name) DO UPDATE SET Status = excluded.Status, DateChecked = excluded.DateChecked, '
+                 'Fingerprint = excluded.Fingerprint', row)
+    _record_history(conn, row)
+
+def list_statuses(category):
+    '''
+    Returns every tracked series of a category, in the order they started being tracked.
+
+            Parameters:
+                    category (str): Series type ('anime' or 'manga').
+
+            Returns:
+                    rows (list): List of sqlite3.Row.
+    '''
+    return connect().execute('SELECT * FROM statuses WHERE Category = ? ORDER BY rowid', (category,)).fetchall()
+
+# WORKING SET ---------------------------------------------------------------------------------------------------------------
+
+# Number of updated items written per transaction during a sweep.
+BATCH_SIZE = 50
+
+class WorkingSet:
+    '''
+    In-memory copy of every tracked item of a category, used by the sweeps: the items are read once, updated in memory, and written back
+    to the database in transactions of BATCH_SIZE items. Use it as a context manager ('with WorkingSet(...) as ws:'), so the remaining
+    updates are written when the sweep ends, even if it ends with an error.
+
+            Parameters:
+                    table (str): 'prices' or 'statuses'.
+                    category (str): Item category.
+                    batch_size (int): Number of updates per transaction.
+                    names (list): Names of the items to load (None = every item of the category).
+    '''
+    def __init__(self, table, category, batch_size=BATCH_SIZE, names=None):
+        self.table = table
+        self.batch_size = batch_size
+        self.pending = []
+        # Items whose page didn't change since their last refresh (only their observation is recorded, see tracking.refresh_item_async)
+        self.skipped = 0
+        self.unchanged_rows = []
+        rows = list_prices(category) if table == 'prices' else list_statuses(category)
+        if names is not None:
+            names = set(names)
+            rows = [row for row in rows if row['Name'] in names]
+        # Items are keyed by URL (games) or by name (cards and series), in the order they started being tracked.
+        self.rows = {}
+        for row in rows:
+            row = dict(row)
+            self.rows[self.key(row.get('Name', ''), row.get('URL', ''))] = row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        return False
+
+    @staticmethod
+    def key(name='', url=''):
+        return url if url else name
+
+    def get(self, name='', url=''):
+        '''
+        Returns the item's row (dict), or None if the item is not being tracked.
+        '''
+        return self.rows.get(self.key(name, url))
+
+    def put(self, row):
+        '''
+        Updates the item in memory and queues it for the next transaction.
+        '''
+        row.setdefault('Observed', time.time())
+        self.rows[self.key(row['Name'], row.get('URL', ''))] = row
+        self.pending.append(row)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def unchanged(self, row):
+        '''
+        Queues the observation of an item that was checked and didn't change (see record_unchanged) for the next transaction.
+        '''
+        self.skipped += 1
+        self.unchanged_rows.append(dict(row, Observed=time.time()))
+        if len(self.pending) + len(self.unchanged_rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the queued updates to the database in one transaction.
+        '''
+        if not self.pending and not self.unchanged_rows:
+            return
+        upsert = _upsert_price if self.table == 'prices' else _upsert_status
+        conn = connect()
+        with conn:
+            for row in self.pending:
+                upsert(conn, row)
+            for row in self.unchanged_rows:
+                _record_unchanged(conn, row)
+        (self.pending, self.unchanged_rows) = ([], [])
+
+# HISTORY FUNCTIONS ---------------------------------------------------------------------------------------------------------
+
+# Every price/status observation is appended to a monthly partition (table "history_YYYYMM"). Each partition is clustered by
+# (Category, Name, Timestamp), so the history of one item is stored contiguously and a query only reads the partitions of the months
+# it covers and the rows of the item it asks for.
+
+def _partition(timestamp):
+    # Name of the partition of a unix timestamp (UTC month).
+    return 'history_' + time.strftime('%Y%m', time.gmtime(timestamp))
+
+def _record_history(conn,row):
+    # Appends one observation of the item in 'row' to its monthly partition (inside the caller's transaction). The partition is created
+    # every time if needed (not remembered): the caller's transaction may still be rolled back, and the table with it.
+    timestamp = int(row.get('Observed') or time.time())
+    table = _partition(timestamp)
+    conn.execute('CREATE TABLE IF NOT EXISTS ' + table + ' (Category TEXT NOT NULL, Name TEXT NOT NULL, Timestamp INTEGER NOT NULL, '
+                 'Price REAL, Status TEXT, Discount TEXT, PRIMARY KEY (Category, Name, Timestamp)) WITHOUT ROWID')
+    conn.execute('INSERT OR REPLACE INTO ' + table + ' (Category, Name, Timestamp, Price, Status, Discount) VALUES (?,?,?,?,?,?)',
+                 (row['Category'], row['Name'], timestamp, row.get('Lowest_Price'), row.get('Status'), row.get('Discount', '')))
+
+def _record_unchanged(conn,row):
+    # Appends an observation of an item that was checked and didn't change: a copy of its latest observation (or of 'row', the item's
+    # tracked data, if it has none), at the time of the check.
+    latest = None
+    for table in reversed(_partitions_since(conn, 0)):
+        latest = conn.execute('SELECT Price, Status, Discount FROM ' + table + ' WHERE Category = ? AND Name = ? ORDER BY Timestamp DESC LIMIT 1',
+                              (row['Category'], row['Name'])).fetchone()
+        if latest is not None:
+            break
+    observation = {'Category': row['Category'], 'Name': row['Name'], 'Observed': row.get('Observed')}
+    if latest is not None:
+        observation.update(Lowest_Price=latest['Price'], Status=latest['Status'], Discount=latest['Discount'] or '')
+    else:
+        observation.update(Lowest_Price=row.get('Lowest_Price'), Status=row.get('Status'))
+    _record_history(conn, observation)
+
+def record_unchanged(row):
+    '''
+    Records that an item was checked and didn't change (its page had the fingerprint of its last refresh), so the history shows every
+    check, with or without a change (see history and alerts.py).
+
+            Parameters:
+                    row (sqlite3.Row or dict): Row of the item in the tracking database (table "prices" or "statuses").
+    '''
+    conn = connect()
+    with conn:
+        _record_unchanged(conn, dict(row))
+
+def _partitions_since(conn,since):
+    # Names of the existing partitions that may contain observations newer than 'since', oldest first.
+    first = _partition(since)
+    tables = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'history_[0-9]*'").fetchall()
+    return sorted(t['name'] for t in tables if t['name'] >= first)
+
+def history(category,name,days=HISTORY_DAYS):
+    '''
+    Returns every recorded observation of an item in the last 'days' days.
+
+            Parameters:
+                    category (str): Item category.
+                    name (str): Item name (exactly as it is in the database).
+                    days (int): Number of days to look back.
+
+            Returns:
+                    rows (list): List of sqlite3.Row with the columns Timestamp (unix time), Price, Status and Discount, oldest first.
+    '''
+    conn = connect()
+    since = time.time() - days*86400
+    rows = []
+    for table in _partitions_since(conn, since):
+        rows += conn.execute('SELECT Timestamp, Price, Status, Discount FROM ' + table + ' WHERE Category = ? AND Name = ? AND Timestamp >= ? '
+                             'ORDER BY Timestamp', (category, name, since)).fetchall()
+    return rows
+
+def lowest_price(category,name,days=HISTORY_DAYS):
+    '''
+    Returns the lowest recorded price of a card/game in the last 'days' days.
+
+            Parameters:
+                    category (str): Item category.
+                    name (str): Item name (exactly as it is in the database).
+                    days (int): Number of days to look back.
+
+            Returns:
+                    (price,timestamp) (tuple): Lowest price + unix time of the (first) observation with that price, or None if the item has no
+                                                recorded prices in that period.
+    '''
+    conn = connect()
+    since = time.time() - days*86400
+    lowest = None
+    for table in _partitions_since(conn, since):
+        row = conn.execute('SELECT MIN(Price) AS Price, Timestamp FROM ' + table + ' WHERE Category = ? AND Name = ? AND Timestamp >= ?',
+                           (category, name, since)).fetchone()
+        if row['Price'] is not None and (lowest is None or row['Price'] < lowest[0]):
+            lowest = (row['Price'], row['Timestamp'])
+    return lowest
+
+def observations(days=HISTORY_DAYS):
+    '''
+    Returns every recorded price of every card/game in the last 'days' days (used to build the snapshot of the alert rules, see alerts.py).
+
+            Returns:
+                    rows (list): List of sqlite3.Row with the columns Category, Name, Timestamp, Price and Discount, in no particular order.
+    '''
+    conn = connect()
+    since = time.time() - days*86400
+    rows = []
+    for table in _partitions_since(conn, since):
+        rows += conn.execute('SELECT Category, Name, Timestamp, Price, Discount FROM ' + table + ' WHERE Timestamp >= ? AND Price IS NOT NULL',
+                             (since,)).fetchall()
+    return rows
+
+# DELETE FUNCTIONS ----------------------------------------------------------------------------------------------------------
+
+def delete_item(table,category,name):
+    '''
+    Stops tracking an item.
+
+            Parameters:
+                    table (str): 'prices' or 'statuses'.
+                    category (str): Item category.
+                    name (str): Item name (exactly as it is in the database).
+
+            Returns:
+                    deleted (bool): True if the item was found and deleted.
+    '''
+    conn = connect()
+    with conn:
+        cur = conn.execute('DELETE FROM ' + table + ' WHERE Category = ? AND Name = ?', (category, name))
+    return cur.rowcount > 0
+
+if __name__ == '__main__':
+    # Running this file directly creates the database and imports the old CSV tracking files.
+    connect()
@@ -1,18 +1,73 @@
 # IMPORTS -------------------------------------------------------------------------------------------------------------------
 
-from bs4 import BeautifulSoup
-import requests
-from os.path import exists
-import pandas as pd
+import asyncio
 from datetime import datetime
 import json
-from PIL import Image
+import logging
 from io import BytesIO
-from IPython import display
+import time
+from http_client import fetch, fetch_text, run_sync, bypass_cache, breaker_report, HostUnavailable
+import storage
+import image_cache
+import card_index
+import guilds
+import metrics
+from singleflight import coalesce
+
+logger = logging.getLogger(__name__)
 
 # SEARCH FUNCTIONS ----------------------------------------------------------------------------------------------------------
 
-def gameprices(type,search,t):
+# Extractor (see parsers.py) of the webpage each category's tracked items are refreshed from.
+EXTRACTORS = {'physical': 'nedgame_product', 'digital': 'steam_product', 'ygo': 'cardmarket', 'pkmn': 'cardmarket', 'mtg': 'cardmarket',
+              'manga': 'manga_search', 'anime': 'anime_search'}
+
+def page_url(cat,search):
+    '''
+    Returns the URL of the search page of a card (Cardmarket) or series (mangarock/animebee). Games are refreshed from their own URL.
+    '''
+    if cat == 'mtg':
+        return 'https://www.cardmarket.com/en/Magic/Products/Singles?idCategory=1&idExpansion=0&searchString='+search.replace(" ","+")+'&onlyAvailable=on&idRarity=0&sortBy=price_asc&perSite=20'
+    elif cat == 'ygo':
+        return 'https://www.cardmarket.com/en/YuGiOh/Products/Singles?idCategory=5&idExpansion=0&searchString='+search.replace(" ","+")+'&onlyAvailable=on&idRarity=0&sortBy=price_asc&perSite=20'
+    elif cat == 'pkmn':
+        return 'https://www.cardmarket.com/en/Pokemon/Products/Singles?idExpansion=0&searchString='+search.replace(" ","+")+'&onlyAvailable=on&idRarity=0&sortBy=price_asc&perSite=30'
+    elif cat == 'manga':
+        return 'https://mangarock.herokuapp.com/search/story/'+search.replace(" ","_")
+    elif cat == 'anime':
+        return 'https://animebee.to/search?keyword='+search.replace(" ","+")
+    return search
+
+@coalesce
+@metrics.scraper
+async def item_page_async(cat,search,known=''):
+    '''
+    Downloads the webpage a tracked item is refreshed from (the product page of a game, the search page of a card or series) and extracts it,
+    unless the fingerprint of the part of the page that the extractor reads is still 'known' (then the page is not parsed at all).
+
+            Parameters:
+                    cat (str): Category the item belongs to.
+                    search (str): URL of the game, or name of the card/series.
+                    known (str): Fingerprint saved at the item's last refresh ('' if none).
+
+            Returns:
+                    (fingerprint,results) (tuple): Fingerprint of the page (None if the page has none of the parts the extractor reads) + list of
+                                                   results like gameprices_async (t=2), cardprices_async or manga_anime_async, or None if the
+                                                   fingerprint is 'known'.
+    '''
+    import parsers # Imported on first use, to keep Pheme's startup fast
+    html = await fetch_text(page_url(cat,search))
+    extractor = EXTRACTORS[cat]
+    fingerprint = parsers.fingerprint(html,extractor)
+    if fingerprint is not None and fingerprint == known:
+        return (fingerprint,None)
+    if cat in ['physical','digital']:
+        return (fingerprint,[getattr(parsers,extractor)(html,search)])
+    return (fingerprint,getattr(parsers,extractor)(html))
+
+@coalesce
+@metrics.scraper
+async def gameprices_async(type,search,t):
     '''
     This function takes in a game's name or url and returns information about the game's price.
             
@@ -35,83 +90,123 @@ def gameprices(type,search,t):
                                     (top 5 results). If we are searching for a game that we are already tracking, then the result list will have 
                                     1 item only. Discounted prices are only collected for 'digital' games (steam discounts).
     '''
+    import parsers # Imported on first use, to keep Pheme's startup fast
     if t==1:
         if type == 'physical':
             # NEDGAME: Search for the top 5 most relevant results, return a list of tuples with name, price and url information.
             search_url = 'https://www.nedgame.nl/zoek/zoek:' + search.replace(" ","_") + '/&sorteer=relevantie'
-            html_search = requests.get(search_url).text
-            soup = BeautifulSoup(html_search,'html.parser')
-            products = soup.find_all("div", attrs={"class": "productShopHeader"})
-            results = []  
-            for p in products:  
-                title = p.find('div', attrs={'class':'title'}).text.split("\n\n")[1]
-                url = p.find('div', attrs={'class':'titlewrapper'}).find('a', attrs={'class':'productTitleLink'},href=True)['href']
-                all_prices = p.find('div', attrs={'class':'buy'})
-                (states,prices) = (all_prices.find_all('div', attrs={'class':'staat'}), all_prices.find_all("div", attrs={"class":"currentprice"}))
-                price_info = []
-                for s,pr in zip(states,prices):
-                    state = (s.text.replace("Nieuw","New").replace("Gebruikt","Used")+': '+pr.text)
-                    price_info.append(state)
-                results.append((title, price_info, url, ''))
-
-            return results[:5]
+            html_search = await fetch_text(search_url)
+            return parsers.nedgame_search(html_search,5)
 
         elif type == 'digital':
             # STEAM: Search for the top 5 most relevant results, return a list of tuples with name, price and url information.
             search_url = 'https://store.steampowered.com/search/?term=' + search.replace(" ","+") 
-            html_search = requests.get(search_url).text
-            soup = BeautifulSoup(html_search,'html.parser')
-            products = soup.find_all("div", attrs={"class": "responsive_search_name_combined"})
-            results = []  
-            for idx,p in enumerate(products):
-                title = p.find("span", attrs={"class": "title"}).text
-                url = soup.find_all("a",attrs={"class": "search_result_row ds_collapse_flag"},href=True)[idx]['href']
-                try:
-                    price = p.find("div", attrs={"class": "col search_price responsive_secondrow"}).text.split("\r\n")[1].strip()
-                    results.append((title, price, url, ''))
-                except: # If the game is on discount, the price on the webpage will be in a different class:
-                    try:
-                        price = p.find("div", attrs={"class": "col search_price discounted responsive_secondrow"}).text.split("\n")[1].strip().split("€")[0]+'€'
-                        discount_price = p.find("div", attrs={"class": "col search_price discounted responsive_secondrow"}).text.split("\n")[1].strip().split("€")[1]+'€'
-                        results.append((title, price, url, discount_price))
-                    except:
-                        pass
-
-            return results[:5]
+            html_search = await fetch_text(search_url)
+            return parsers.steam_search(html_search,5)
     elif t==2:
         if type == 'physical': 
             # NEDGAME: Using the URL of a game which we saved in the tracking file previously, search the webpage to get updated price information.
             search_url = search
-            html_search = requests.get(search_url).text
-            soup = BeautifulSoup(html_search,'html.parser')
-            title = soup.find('div', attrs={'class':'productTitle show-for-mobile'}).text.split("\n")[1]
-            all_prices = soup.find('div', attrs={'class':'buy'})
-            (states, prices) = (all_prices.find_all('div', attrs={'class':'staat'}),all_prices.find_all('div', attrs={'class':'currentprice'}))
-            price_info = []
-            for s,pr in zip(states,prices):
-                state = (s.text.replace("Nieuw","New").replace("Gebruikt","Used")+': '+pr.text)
-                price_info.append(state)
-            result = [(title, price_info, search_url, '')]
+            html_search = await fetch_text(search_url)
+            result = [parsers.nedgame_product(html_search,search_url)]
             return result
 
         elif type == 'digital':
             # STEAM: Using the URL of a game which we saved in the tracking file previously, search the webpage to get updated price information.
             search_url = search
-            html_search = requests.get(search_url).text
-            soup = BeautifulSoup(html_search,'html.parser')
-            title = soup.find('div', attrs={'class':'apphub_AppName'}).text
-            price = soup.find("div", attrs={"class": "game_purchase_price price"}).text.split("\r\n")[1].replace('\t','')
+            html_search = await fetch_text(search_url)
+            result = [parsers.steam_product(html_search,search_url)]
+            return result
 
-            try: # If the game is on discount, the discount price on the webpage will be in a different class:
-                discount = soup.find("p", attrs={"class": "game_purchase_discount_countdown"}).text
-                discount_price = soup.find("div", attrs={"class": "discount_final_price"}).text
-            except: # If discount returns an error (there is no discount class in the webpage), then the game is not on discount and:
-                discount_price = ''
+def gameprices(type,search,t):
+    '''
+    Synchronous version of gameprices_async (same parameters and return value).
+    '''
+    return run_sync(gameprices_async(type,search,t))
 
-            result = [(title, price, search_url, discount_price)]
-            return result            
+# Steam storefront API: number of games per request, and country of the prices (euros).
+STEAM_BATCH = 50
+STEAM_COUNTRY = 'nl'
 
-def cardprices(tcg,search):
+def steam_app_id(url):
+    '''
+    Returns the app id of a Steam store URL (ex: 'https://store.steampowered.com/app/620/Portal_2/' -> '620'), or None.
+    '''
+    parts = url.split('/app/')
+    if len(parts) < 2:
+        return None
+    app_id = parts[1].split('/')[0]
+    return app_id if app_id.isdigit() else None
+
+@metrics.scraper
+async def gameprices_batch_async(type,games):
+    '''
+    Batched version of gameprices_async(type,url,2) for many tracked games. Steam prices and discounts are read from the storefront JSON API
+    ('appdetails' with the 'price_overview' filter), which accepts up to STEAM_BATCH app ids per request, so no store page is downloaded or
+    parsed. Only 'digital' games are supported (for 'physical' games, the result is always empty).
+            
+            Parameters:
+                    type (str): game format ('physical' or 'digital').
+                    games (list): List of (name, url) tuples of tracked games.
+
+            Returns:
+                    results (dict): Dictionary url -> (title, price, url, discount_price), like the tuples returned by gameprices_async. Games
+                                    whose price couldn't be read from the API (ex: the app is not sold in the Netherlands) are left out, so
+                                    they can be refreshed from their store page instead.
+    '''
+    results = {}
+    if type != 'digital':
+        return results
+    apps = {}
+    for (name,url) in games:
+        app_id = steam_app_id(url)
+        if app_id is not None:
+            apps.setdefault(app_id,[]).append((name,url))
+    app_ids = list(apps)
+
+    async def get_batch(batch):
+        call_url = 'https://store.steampowered.com/api/appdetails?appids='+','.join(batch)+'&filters=price_overview&cc='+STEAM_COUNTRY
+        try:
+            (status,body) = await fetch(call_url)
+        except Exception as error:
+            # The games of this batch are refreshed from their store pages instead
+            logger.info('Steam batch of %d games failed: %r', len(batch), error)
+            return
+        if status != 200:
+            return
+        try:
+            data = json.loads(body)
+            for app_id in batch:
+                app = data.get(app_id) or {}
+                if not app.get('success'):
+                    continue
+                # Free games have no price overview (their 'data' is an empty list)
+                overview = app['data'].get('price_overview') if isinstance(app['data'], dict) else None
+                if overview is None:
+                    (price,discount_price) = ('Free','')
+                elif overview.get('discount_percent'):
+                    (price,discount_price) = (overview['initial_formatted'],overview['final_formatted'])
+                else:
+                    (price,discount_price) = (overview['final_formatted'],'')
+                for (name,url) in apps[app_id]:
+                    results[url] = (name,price,url,discount_price)
+        except (ValueError,KeyError,TypeError,AttributeError) as error:
+            # Not the expected JSON (ex: an HTML error page, a truncated body or a missing price): the remaining games of this batch are
+            # refreshed from their store pages instead
+            logger.info('Steam batch of %d games could not be read: %r', len(batch), error)
+
+    await asyncio.gather(*[get_batch(app_ids[i:i+STEAM_BATCH]) for i in range(0,len(app_ids),STEAM_BATCH)])
+    return results
+
+def gameprices_batch(type,games):
+    '''
+    Synchronous version of gameprices_batch_async (same parameters and return value).
+    '''
+    return run_sync(gameprices_batch_async(type,games))
+
+@coalesce
+@metrics.scraper
+async def cardprices_async(tcg,search):
     '''
     Takes in a card game name and a card name. Returns the lowest average price found for the card, the card version and expansion. 
             
@@ -122,30 +217,110 @@ def cardprices(tcg,search):
             Returns: 
                     results (list): List of tuples in the format (name,expansion,price).
     '''
-    results = []
+    import parsers # Imported on first use, to keep Pheme's startup fast
     #CARDMARKET top results
-    if tcg == 'mtg': 
-        search_url = 'https://www.cardmarket.com/en/Magic/Products/Singles?idCategory=1&idExpansion=0&searchString='+search.replace(" ","+")+'&onlyAvailable=on&idRarity=0&sortBy=price_asc&perSite=20'
-    elif tcg == 'ygo':
-        tcg_search = 'YuGiOh'
-        search_url = 'https://www.cardmarket.com/en/YuGiOh/Products/Singles?idCategory=5&idExpansion=0&searchString='+search.replace(" ","+")+'&onlyAvailable=on&idRarity=0&sortBy=price_asc&perSite=20'
-    elif tcg == 'pkmn':
-        search_url = 'https://www.cardmarket.com/en/Pokemon/Products/Singles?idExpansion=0&searchString='+search.replace(" ","+")+'&onlyAvailable=on&idRarity=0&sortBy=price_asc&perSite=30'
-
-    html_search = requests.get(search_url).text
-    soup = BeautifulSoup(html_search,'html.parser')
-    (cardnames,expansions,prices) = (soup.find_all("div", attrs={"class": "col-10 col-md-8 px-2 flex-column align-items-start justify-content-center"}),soup.find_all("div", attrs={"class": "col-icon small"}),soup.find_all("div", attrs={"class": "col-price pr-sm-2"}) )
-
-    for n,e,p in zip(cardnames,expansions,prices):
-        name = n.text
-        price = p.text
-        if (name != 'Name') and (price != "From"):
-            expansion = str(e).split('title=')[1].split('"')[1]
-            results.append((name,expansion,price))
+    html_search = await fetch_text(page_url(tcg,search))
+    return parsers.cardmarket(html_search)
+
+def cardprices(tcg,search):
+    '''
+    Synchronous version of cardprices_async (same parameters and return value).
+    '''
+    return run_sync(cardprices_async(tcg,search))
+
+# Statistics of the last card sweep of each tcg: tcg -> {'cards', 'queries', 'fetches'} (see cardprices_batch_async)
+sweep_stats = {}
+
+def plan_card_queries(names):
+    '''
+    Plans the Cardmarket searches of a sweep. Names are grouped by normalized search key (case and spaces don't matter), and a key that
+    contains a shorter key (ex: 'dark magician girl' contains 'dark magician') is first looked up in the results of the shorter one.
+            
+            Parameters:
+                    names (list): Tracked card names.
+
+            Returns: 
+                    (groups,parents) (tuple): Dictionary key -> names with that key + dictionary key -> key of the search whose results are
+                                              tried first (only for the keys that are covered by a shorter search).
+    '''
+    groups = {}
+    for name in names:
+        groups.setdefault(' '.join(name.lower().split()),[]).append(name)
+    (roots,parents) = ([],{})
+    for key in sorted(groups, key=len):
+        root = next((r for r in roots if r in key), None)
+        if root is None:
+            roots.append(key)
+        else:
+            parents[key] = root
+    return (groups,parents)
+
+async def cardprices_batch_async(tcg,names):
+    '''
+    Batched version of cardprices_async for the sweeps: every distinct Cardmarket search page is downloaded once and every tracked card is
+    resolved from the shared results (see plan_card_queries). Results are sorted by price, so the first result with a card's exact name is its
+    cheapest printing in any page that contains it. Cards missing from a shared page are searched on their own page.
+            
+            Parameters:
+                    tcg (str): Card game name. Accepted values: 'ygo' (Yu-Gi-Oh!), 'mtg' (Magic the Gathering), 'pkmn' (Pokemon)
+                    names (list): Tracked card names.
 
+            Returns: 
+                    results (dict): Dictionary name -> (name,expansion,price) tuple of the card's cheapest result, or None if the card is not in
+                                    the results of its own search. Cards whose search page couldn't be downloaded are left out.
+    '''
+    (groups,parents) = plan_card_queries(names)
+    pages = {}
+    results = {}
+
+    async def search(key):
+        pages[key] = await cardprices_async(tcg,groups[key][0])
+
+    def resolve(key,page):
+        # Finds the cheapest result of every name of a group in a page. Returns False if some name is not in the page.
+        found = True
+        for name in groups[key]:
+            match = next((r for r in page if r[0] == name), None)
+            if match is None:
+                found = False
+            else:
+                results[name] = match
+        return found
+
+    # 1st round: the searches that are not covered by a shorter one
+    roots = [key for key in groups if key not in parents]
+    await sweep(roots, search)
+    missing = []
+    for key in groups:
+        page = pages.get(parents.get(key, key))
+        if page is not None and not resolve(key,page):
+            missing.append(key)
+        elif page is None and key in parents:
+            missing.append(key)
+    # 2nd round: the cards that were not in the results of the shorter search get their own search
+    second = [key for key in missing if key in parents]
+    await sweep(second, search)
+    for key in missing:
+        if key in pages and not resolve(key,pages[key]):
+            for name in groups[key]:
+                results.setdefault(name,None)
+
+    fetches = len(roots) + len(second)
+    sweep_stats[tcg] = {'cards': len(names), 'queries': len(groups), 'fetches': fetches}
+    metrics.sweep_fetches.inc(fetches, category=tcg)
+    metrics.sweep_fetches_saved.inc(len(names) - fetches, category=tcg)
+    logger.info('%s sweep: %d cards, %d distinct searches, %d pages downloaded.', tcg, len(names), len(groups), fetches)
     return results
 
-def manga_anime(type,search):
+def cardprices_batch(tcg,names):
+    '''
+    Synchronous version of cardprices_batch_async (same parameters and return value).
+    '''
+    return run_sync(cardprices_batch_async(tcg,names))
+
+@coalesce
+@metrics.scraper
+async def manga_anime_async(type,search):
     '''
     Takes in a series' type and name. Returns the status of the series (number of the latest episode/chapter).
             
@@ -157,35 +332,26 @@ def manga_anime(type,search):
                     results (list): List of tuples in the format (title, chpt) or (title, ep) depending on whether we requested a manga or anime
                                     series, respectively.
     '''
+    import parsers # Imported on first use, to keep Pheme's startup fast
     if type == 'manga':
-        search_url = 'https://mangarock.herokuapp.com/search/story/'+search.replace(" ","_")
-        html_search = requests.get(search_url).text
-        soup = BeautifulSoup(html_search,'html.parser')
-        series = soup.find_all("div", attrs={"class": "story_item"})
-        results = [] 
-        for s in series:
-            title = s.find("h3", attrs={"class": "story_name"}).text.split("\n")[1]
-            chpt = s.find("em", attrs={"class": "story_chapter"}).text.split('\n')[2].strip()
-            results.append((title, chpt))
-        return results
+        html_search = await fetch_text(page_url(type,search))
+        return parsers.manga_search(html_search)
 
     if type == 'anime': #top 4 results
-        search_url = 'https://animebee.to/search?keyword='+search.replace(" ","+")
-        html_search = requests.get(search_url).text
-        soup = BeautifulSoup(html_search,'html.parser')
-        series = soup.find_all("div", attrs={"class": "flw-item flw-item-big"})
-        results = [] 
-        for s in series:
-            title = s.find("h3", attrs={"class": "film-name"}).text.split("\n")[1]
-            ep = s.find("div", attrs={"class": "tick-item tick-eps"}).text
-            results.append((title, ep))
-        return results
+        html_search = await fetch_text(page_url(type,search))
+        return parsers.anime_search(html_search)
+
+def manga_anime(type,search):
+    '''
+    Synchronous version of manga_anime_async (same parameters and return value).
+    '''
+    return run_sync(manga_anime_async(type,search))
 
 # SAVE FUNCTIONS ------------------------------------------------------------------------------------------------------------
 
-def save_price(data,category):
+def save_price(data,category,working_set=None,fingerprint=''):
     '''
-    This function takes in information about an item's price and inserts or updates the data inside a tracking file ("price_tracker.csv") 
+    This function takes in information about an item's price and inserts or updates the data inside the tracking database (table "prices") 
     with this new information.
             
             Parameters:
@@ -193,6 +359,9 @@ def save_price(data,category):
                                     the item is a GAME.
                     category (str): Can be any of the following strings: 'ygo'/'pkmn'/'mtg' for CARDS; and 'physical'/'digital' for GAMES.
                                     Depending on the category, the data will be saved to the tracking file differently.                                 
+                    working_set (storage.WorkingSet): Used by the sweeps. If given, the previous price is read from (and the update is
+                                    written to) the sweep's in-memory working set instead of the database.
+                    fingerprint (str): Fingerprint of the page/data the price was extracted from (see item_page_async).
 
             Returns: 
                     (msg,lowest_price,previous) (tuple): Returns a log message to be shown to the user + the current lowest price of the item 
@@ -235,53 +404,34 @@ def save_price(data,category):
             # Else, the price string, we will remove only the price data as float.
                 lowest_price = float(data[1].split('€')[0].replace(',','.'))
     
-    # Create file for the first time if it doesnt exist.
-    if exists("price_tracker.csv") == False:
-        file = open("price_tracker.csv","w") 
-        file.write("Name|Category|Lowest_Price|Expansion|DateChecked|URL")
-        file.close()
-
-    # Open file as pandas dataframe.
-    df_prices = pd.read_csv("price_tracker.csv",delimiter="|")
-
-    # Check if card/game item already exists in file
-    if category in games:
-        # If its a game, check by URL
-        df_check = df_prices[df_prices['URL']==url]
+    # Check if card/game item is already being tracked (games are checked by URL, cards by name)
+    if working_set is None:
+        row = storage.get_price(category,name,url)
     else:
-        # If its a card, check by name
-        df_check = df_prices[df_prices['Name']==name]
+        row = working_set.get(name,url)
 
-    if df_check.empty:
-        # If the item isnt in the file:
+    if row is None:
+        # If the item isnt in the database:
         previous = 999999
         date_time_previous = ''
     else:
-        # Else, get this information from the file:
-        previous = df_check['Lowest_Price'].iloc[0]
-        date_time_previous = df_check['DateChecked'].iloc[0]
+        # Else, get this information from the database:
+        previous = row['Lowest_Price']
+        date_time_previous = row['DateChecked']
 
     # Get current datetime
     now = datetime.now()
     date_time = now.strftime("%m/%d/%Y, %H:%M:%S")
 
-    # Create new dataframe with update (new row)
-    update =  {'Name': name, 'Category': category, 'Lowest_Price': lowest_price, 'Expansion': expansion, 'DateChecked':date_time, 'URL':url}
-    df_update = pd.DataFrame(update, index=[0])
-
-    # Update the file with the most recent data
-    if previous == 999999: 
-        # If its a new item, concatenate df_update with df_prices
-        df_prices = pd.concat([df_prices, df_update])
-    else: 
-        # If the item was already in the file, replace the old row in df_prices with the new row from df_update
-        if category in games:
-            df_prices.update(df_prices[['URL']].merge(df_update, 'left'))
-        else:
-            df_prices.update(df_prices[['Name']].merge(df_update, 'left'))
-
-    # Save changes to file
-    df_prices.to_csv("price_tracker.csv","|",index=False)
+    # Insert the item, or replace its old row with the most recent data
+    update =  {'Name': name, 'Category': category, 'Lowest_Price': lowest_price, 'Expansion': expansion, 'DateChecked':date_time, 'URL':url,
+               'Fingerprint': fingerprint}
+    # The discount price is not kept in the tracking table, only in the price history
+    update['Discount'] = data[3] if category in games else ''
+    if working_set is None:
+        storage.upsert_price(update)
+    else:
+        working_set.put(update)
 
     # Print log messages
     if category in tcgs:
@@ -298,14 +448,17 @@ def save_price(data,category):
 
     return (msg,lowest_price,previous)
 
-def save_status(data,category):
+def save_status(data,category,working_set=None,fingerprint=''):
     '''
-    This function takes in information about a series' status and inserts or updates the data inside a tracking file ("status_tracker.csv") 
+    This function takes in information about a series' status and inserts or updates the data inside the tracking database (table "statuses") 
     with this new information.
             
             Parameters:
                     data (tuple): Tuple with (title, chpt) data if the series is a manga or (title, ep) if it's an anime.
                     category (str): Type of series. Can be 'manga' or 'anime'.                                 
+                    working_set (storage.WorkingSet): Used by the sweeps. If given, the previous status is read from (and the update is
+                                    written to) the sweep's in-memory working set instead of the database.
+                    fingerprint (str): Fingerprint of the page the status was extracted from (see item_page_async).
 
             Returns: 
                     (msg,status,previous) (tuple): Returns a log message to be shown to the user + the current status of the series 
@@ -315,45 +468,31 @@ def save_status(data,category):
     name = data[0]
     status = data[1]
 
-    # Create file for the first time if it doesnt exist
-    if exists("status_tracker.csv") == False:
-        file = open("status_tracker.csv","w") 
-        file.write("Name|Category|Status|DateChecked")
-        file.close()
-
-    # Open file as pandas dataframe
-    df_status = pd.read_csv("status_tracker.csv",delimiter="|")
-
-    # Check if series name exists in file
-    df_check = df_status[df_status['Name']==name]
+    # Check if series is already being tracked
+    if working_set is None:
+        row = storage.get_status(category,name)
+    else:
+        row = working_set.get(name)
 
-    if df_check.empty:
-        # If the series isnt in the file:
+    if row is None:
+        # If the series isnt in the database:
         previous = 'N/A'
         date_time_previous = ''
     else:
-        # Else, get this information from the file:
-        previous = df_check['Status'].iloc[0]
-        date_time_previous = df_check['DateChecked'].iloc[0]
+        # Else, get this information from the database:
+        previous = row['Status']
+        date_time_previous = row['DateChecked']
 
     # Get current datetime
     now = datetime.now()
     date_time = now.strftime("%m/%d/%Y, %H:%M:%S")
 
-    # Create new dataframe with update (new row)
-    update =  {'Name': name, 'Category': category, 'Status': status, 'DateChecked':date_time}
-    df_update = pd.DataFrame(update, index=[0])
-
-    # Update the file with the most recent data
-    if previous == 'N/A':
-        # If its a new series, concatenate df_update with df_status
-        df_status = pd.concat([df_status, df_update])
-    else: 
-        # If the series was already in the file, replace the old row in df_status with the new row from df_update
-        df_status.update(df_status[['Name']].merge(df_update, 'left'))
-
-    # Save changes to file
-    df_status.to_csv("status_tracker.csv","|",index=False)
+    # Insert the series, or replace its old row with the most recent data
+    update =  {'Name': name, 'Category': category, 'Status': status, 'DateChecked':date_time, 'Fingerprint': fingerprint}
+    if working_set is None:
+        storage.upsert_status(update)
+    else:
+        working_set.put(update)
 
     # Print log messages
     if previous == 'N/A':
@@ -365,7 +504,7 @@ def save_status(data,category):
 
 # TRACKING FUNCTIONS ---------------------------------------------------------------------------------------------------------
 
-def track(cat,name,t):
+async def track_async(cat,name,t,working_set=None,data=None,subscriber=None,fingerprint=''):
     '''
     This function searches an item with name/url 'name' and from category 'cat', collects data about the item's status or price, then saves 
     this data to a tracking file. To this end, this function calls all the functions defined previously: gameprices, cardprices, manga_anime,
@@ -375,8 +514,13 @@ def track(cat,name,t):
                     cat (str): Category the item belongs to. Accepted values are:  'ygo','pkmn','mtg'; 'physical','digital'; 'anime','manga'
                     name (str): Name of the item we wish to track.
                     t (int): t=1 if we are adding the item to the tracking file for the first time and t=2 if the item is already being tracked.
-                            This variable is only relevant if our item is a game (categories 'physical' and 'digital') and is not used in any other
-                            circumstance.
+                            For games (categories 'physical' and 'digital'), it chooses between a search and a product page. For cards, the name of a
+                            new item (t=1) is corrected with the local card index (see card_index.py).
+                    working_set (storage.WorkingSet): In-memory working set of the sweep that is refreshing the item (None for the 'track'
+                            command). See save_price and save_status.
+                    data (tuple): Item data already downloaded by gameprices_batch_async/cardprices_batch_async (optional, only for t=2).
+                    subscriber (tuple): (server id, channel id) of the 'track' command: the item is added to the server's items (see guilds.py).
+                    fingerprint (str): Fingerprint of the page/data in 'data', saved with the item (see item_page_async).
 
             Returns: 
                     (log,current,previous,discount) (tuple): Tuple with a message log + current status/price of the item + previous status/price of
@@ -386,40 +530,59 @@ def track(cat,name,t):
     games = ['physical','digital']
     animanga = ['anime','manga']
 
+    if cat in tcgs and t == 1:
+        # New cards: correct the name with the local card index before searching the web for it
+        (name,msg) = card_index.resolve(cat,name)
+        if name is None:
+            return (msg,0,0)
+
     try:
         if cat in tcgs: 
-            results = cardprices(cat,name)
-            data = []
-            for r in results:
-                if r[0] == name:
-                    data.append(r)
+            if data is None:
+                results = await cardprices_async(cat,name)
+                data = [r for r in results if r[0] == name][0]
             discount = ''
-            (log,current,previous) = save_price(data[0],cat)
+            (log,current,previous) = save_price(data,cat,working_set,fingerprint)
 
         elif cat in games: #gets first result from search function, saves it to file
-            results = gameprices(cat,name,t)
-            data = results[0]
+            if data is None:
+                results = await gameprices_async(cat,name,t)
+                data = results[0]
             discount = data[3]
-            (log,current,previous) = save_price(data,cat)
+            (log,current,previous) = save_price(data,cat,working_set,fingerprint)
 
         elif cat in animanga:
-            results = manga_anime(cat,name)
-            data = results[0]
+            if data is None:
+                results = await manga_anime_async(cat,name)
+                data = results[0]
             discount = ''
-            (log,current,previous) = save_status(data,cat)
-            
+            (log,current,previous) = save_status(data,cat,working_set,fingerprint)
+
+        if subscriber is not None:
+            guilds.subscribe(subscriber[0],subscriber[1],cat,data[0])
         return (log,current,previous,discount)
 
-    except:
+    except HostUnavailable as error:
+        return ('The website is not responding right now ('+error.host+'). Please try again later.',0,0)
+    except Exception as error:
+        logger.info('Could not track %s (%s): %r', name, cat, error)
         return ('Your search is too ambiguous. If you are trying to track a card, you must match the name on the card exactly.',0,0)
 
-def stop_tracking(cat,item):
+def track(cat,name,t,working_set=None,data=None,subscriber=None,fingerprint=''):
+    '''
+    Synchronous version of track_async (same parameters and return value).
+    '''
+    return run_sync(track_async(cat,name,t,working_set,data,subscriber,fingerprint))
+
+def stop_tracking(cat,item,guild_id=None):
     '''
     Removes an item from the tracking file.
             
             Parameters:
                     cat (str): Category the item belongs to. Accepted values are:  'ygo','pkmn','mtg'; 'physical','digital'; 'anime','manga'
                     item (str): Name of the item to be removed (exactly as is in the tracking file).
+                    guild_id (int): If given, the item is only removed from this server's items, and it stays in the tracking file while other
+                                    servers are still tracking it (see guilds.py).
 
             Returns: 
                     msg (str): Log message.
@@ -427,23 +590,22 @@ def stop_tracking(cat,item):
     tcgs = ['ygo','pkmn','mtg']
     games = ['physical','digital']
     animanga = ['anime','manga']
+
+    if guild_id is not None:
+        (removed,remaining) = guilds.unsubscribe(guild_id,cat,item)
+        if not removed:
+            return 'Item name is ambiguous. It should perfectly match the name of an item tracked in this server.'
+        if remaining > 0:
+            return 'Item '+item+' is no longer being tracked in this server.'
     
     if cat in tcgs+games:
-        df = pd.read_csv("price_tracker.csv",delimiter="|")
-        if item in list(df[df['Category'] == cat]['Name']):
-            df_delete = df[(df['Name'] == item) & (df['Category'] == cat)]
-            df.drop(df_delete.index, axis=0,inplace=True)
-            df.to_csv("price_tracker.csv","|",index=False)
+        if storage.delete_item('prices',cat,item):
             msg = 'Item '+item+' was deleted from the price tracking file and is no longer being tracked.' 
         else: 
             msg = 'Item name is ambiguous. It should perfectly match the name on the file.'
     
     elif cat in animanga:
-        df = pd.read_csv("status_tracker.csv",delimiter="|")
-        if item in list(df[df['Category'] == cat]['Name']):
-            df_delete = df[(df['Name'] == item) & (df['Category'] == cat)]
-            df.drop(df_delete.index, axis=0,inplace=True)
-            df.to_csv("status_tracker.csv","|",index=False)
+        if storage.delete_item('statuses',cat,item):
             msg = 'Item '+item+' was deleted from the status tracking file and is no longer being tracked.' 
         else: 
             msg = 'Item name is ambiguous. It should perfectly match the name on the file.'
@@ -452,49 +614,228 @@ def stop_tracking(cat,item):
 
 # AUTOMATICALLY CHECK FOR CHANGE FUNCTIONS ------------------------------------------------------------------------------------
 
-def price_decrease(cat):
+# Maximum number of items refreshed at the same time during a sweep (shared by all categories). The per-host request rates are limited
+# separately by the token buckets in http_client.py.
+SWEEP_CONCURRENCY = 8
+_sweep_semaphores = {}
+
+# Outcome of the item checks of each category since Pheme started (sweeps and scheduler batches, see report_sweep): cat -> {'checks',
+# 'items', 'refreshed', 'skipped', 'failed', 'unavailable', 'seconds', 'breakers'}. Every counter is added up, 'breakers' is the one of the
+# last check.
+sweep_results = {}
+SWEEP_COUNTERS = ('checks', 'items', 'refreshed', 'skipped', 'failed', 'unavailable', 'seconds')
+
+async def sweep(items,refresh,unavailable=None):
     '''
-    Searches for price changes/discounts in every item listed in the tracking file "price_tracker.csv" that belongs to a certain category.
+    Refreshes many tracked items concurrently, with at most SWEEP_CONCURRENCY refreshes in flight across every running sweep.
             
             Parameters:
-                    cat (str): Category the item belongs to. Accepted values are:  'ygo','pkmn','mtg'; 'physical','digital'.
+                    items (list): Items to refresh (any object 'refresh' accepts).
+                    refresh (function): Async function called once per item.
+                    unavailable (list): If given, the host of every item that was skipped by its circuit breaker is added to it.
 
             Returns: 
-                    msg_list (list): List of log messages.
+                    results (list): Results of 'refresh', in the same order as 'items'. If a refresh fails, its result is None.
+    '''
+    loop = asyncio.get_running_loop()
+    if loop not in _sweep_semaphores:
+        _sweep_semaphores[loop] = asyncio.Semaphore(SWEEP_CONCURRENCY)
+    semaphore = _sweep_semaphores[loop]
+
+    async def run(item):
+        async with semaphore:
+            try:
+                return await refresh(item)
+            except HostUnavailable as error:
+                if unavailable is not None:
+                    unavailable.append(error.host)
+                return None
+            except Exception as error:
+                logger.info('Could not refresh %s: %r', item['Name'] if hasattr(item, 'keys') else item, error)
+                return None
+
+    return await asyncio.gather(*[run(item) for item in items])
+
+def report_sweep(cat,results,start,skipped=0,unavailable=()):
+    '''
+    Records the outcome of a check of items of a category (a sweep or a batch of the scheduler) in the metrics, the log and sweep_results:
+    how many items were refreshed, unchanged (skipped by their fingerprint) or failed, how long it took, and the state of the circuit
+    breakers that skipped some of its items, with the time they saved (see http_client.CircuitBreaker).
+
+            Parameters:
+                    cat (str): Category of the items.
+                    results (list): Results of sweep (None for the items that failed).
+                    start (float): time.perf_counter() at the start of the check.
+                    skipped (int): Number of items whose page/data didn't change (see refresh_item_async).
+                    unavailable (list): Hosts of the items skipped by their circuit breaker (see sweep).
+    '''
+    seconds = time.perf_counter() - start
+    metrics.sweep_seconds.observe(seconds, category=cat)
+    refreshed = sum(resultn is not None for resultn in results)
+    if refreshed:
+        metrics.last_success.set(time.time(), job=cat)
+    breakers = breaker_report(set(unavailable)) if unavailable else []
+    add_sweep(cat,{'checks': 1, 'items': len(results), 'refreshed': refreshed, 'skipped': skipped, 'failed': len(results) - refreshed,
+                   'unavailable': len(unavailable), 'seconds': seconds, 'breakers': breakers})
+    logger.info('%s check: %d of %d items refreshed (%d unchanged, %d skipped by open circuits) in %.1fs.%s', cat, refreshed, len(results),
+                skipped, len(unavailable), seconds, ''.join(' Circuit '+msg+'.' for msg in breakers))
+
+def add_sweep(cat,outcome):
+    '''
+    Adds the outcome of a check (see report_sweep) to the totals of its category in sweep_results. The bot process also adds the checks run
+    by the worker processes (see workers.absorb).
+    '''
+    total = sweep_results.get(cat, {})
+    # A new dict every time, so workers.py can tell which categories were checked since its last report
+    sweep_results[cat] = dict({name: total.get(name, 0) + outcome[name] for name in SWEEP_COUNTERS}, breakers=outcome['breakers'])
+
+def sweep_report():
+    '''
+    Describes the item checks of every category since Pheme started (see report_sweep).
+
+            Returns:
+                    msg_list (list): One message per category, ex: 'anime checks: 120/130 items refreshed (80 unchanged, 10 failed, 8
+                                     skipped by open circuits) in 52 batches, 80.3s. Last check: circuit animebee.to: open, next probe in
+                                     45s (12 requests skipped, 96s saved).'
     '''
-    df_prices = pd.read_csv("price_tracker.csv",delimiter="|")
-    df_cat = df_prices[df_prices['Category']==cat]
-    (names,urls) = (list(df_cat['Name']),list(df_cat['URL']))
     msg_list = []
+    for (cat,total) in sweep_results.items():
+        msg = (cat+' checks: '+str(total['refreshed'])+'/'+str(total['items'])+' items refreshed ('+str(total['skipped'])+' unchanged, '
+               +str(total['failed'])+' failed, '+str(total['unavailable'])+' skipped by open circuits) in '+str(total['checks'])
+               +' batches, '+str(round(total['seconds'],1))+'s.')
+        if total['breakers']:
+            msg = msg+' Last check: '+', '.join('circuit '+breaker for breaker in total['breakers'])+'.'
+        msg_list.append(msg)
+    return msg_list
+
+async def refresh_item_async(cat,row,working_set=None,data=None):
+    '''
+    Refreshes one tracked item and builds the messages about its price decrease/discount or status change (used by refresh_batch_async). If
+    the fingerprint of the page (or of the downloaded data) is the one saved at the item's last refresh, nothing is parsed or saved (only the
+    check is recorded in the item's history) and the item is reported as unchanged.
+            
+            Parameters:
+                    cat (str): Category the item belongs to. Accepted values are:  'ygo','pkmn','mtg'; 'physical','digital'; 'anime','manga'
+                    row (sqlite3.Row or dict): Row of the item in the tracking database (table "prices" or "statuses").
+                    working_set (storage.WorkingSet): In-memory working set of the sweep that is refreshing the item (None to read and write
+                            the database directly).
+                    data (tuple): Item data already downloaded by gameprices_batch_async/cardprices_batch_async (optional).
+
+            Returns: 
+                    (msg_list,changed) (tuple): List of log messages + True if the item's price/status is different from the saved one.
+                                                Returns None if the item could not be refreshed.
+    '''
+    import parsers # Imported on first use, to keep Pheme's startup fast
+    n = row['Name']
+    known = row['Fingerprint']
+    if data is not None:
+        fingerprint = parsers.data_fingerprint(data)
+    else:
+        # Games are refreshed from their product page, cards and series from their search page
+        (fingerprint,results) = await item_page_async(cat,row['URL'] if cat in ['physical','digital'] else n,known)
+        if results is not None:
+            matches = [r for r in results if r[0] == n] if cat in ['ygo','pkmn','mtg'] else results
+            if not matches:
+                return None
+            data = matches[0]
+    if fingerprint is not None and fingerprint == known:
+        # Nothing to parse or save, but the check is recorded in the item's history
+        metrics.unchanged_skips.inc(category=cat)
+        if working_set is not None:
+            working_set.unchanged(row)
+        else:
+            storage.record_unchanged(row)
+        return ([], False)
 
     if cat in ['physical','digital']:
-        for n,u in zip(names,urls):
-            try:
-                resultn = track(cat,u,2) 
-                if resultn[1] < resultn[2]:
-                    msg = "The price of "+n+" DECREASED from "+ str(resultn[2]) + "€ to "+str(resultn[1])+'€.'
-                    msg_list.append(msg)
-                if resultn[3] != '':
-                    msg2 = 'The game "'+n+'" is currently on discount! The discount price is '+resultn[3]+'.'
-                    msg_list.append(msg2)
-            except:
-                pass
+        resultn = await track_async(cat,row['URL'],2,working_set,data,fingerprint=fingerprint or '')
+    else:
+        resultn = await track_async(cat,n,2,working_set,data,fingerprint=fingerprint or '')
+    if len(resultn) < 4:
+        return None
 
+    msg_list = []
+    if cat in ['anime','manga']:
+        type = 'episode' if cat == 'anime' else 'chapter'
+        if resultn[1] != resultn[2]:
+            msg = "There is a new "+type+" of "+n+"! The status CHANGED from "+ str(resultn[2]) + " to "+str(resultn[1])+'.'
+            msg_list.append(msg)
     else:
-        for n in names:
-            try:
-                resultn = track(cat,n,1)
-                if resultn[1] < resultn[2]:
-                    msg = "The price of "+n+" DECREASED from "+ str(resultn[2]) + "€ to "+str(resultn[1])+'€.'
-                    msg_list.append(msg)
-            except:
-                pass
+        if resultn[1] < resultn[2]:
+            msg = "The price of "+n+" DECREASED from "+ str(resultn[2]) + "€ to "+str(resultn[1])+'€.'
+            msg_list.append(msg)
+        if cat in ['physical','digital'] and resultn[3] != '':
+            msg2 = 'The game "'+n+'" is currently on discount! The discount price is '+resultn[3]+'.'
+            msg_list.append(msg2)
+
+    return (msg_list, resultn[1] != resultn[2])
+
+async def refresh_batch_async(cat,names=None):
+    '''
+    Refreshes many tracked items of a category at once, concurrently (see sweep). The items are read once into a working set and the updates
+    are written back in batches (see storage.WorkingSet). Steam prices are downloaded in batches (see gameprices_batch_async) and every
+    distinct Cardmarket search once (see cardprices_batch_async). Used by the sweeps of every item of a category and by the scheduler, which
+    refreshes the items that are due together (see scheduler.py).
+            
+            Parameters:
+                    cat (str): Category the items belong to. Accepted values are:  'ygo','pkmn','mtg'; 'physical','digital'; 'anime','manga'
+                    names (list): Names of the items to refresh (None = every tracked item of the category).
+
+            Returns: 
+                    results (list): List of (name, result) tuples, where result is the result of refresh_item_async ((msg_list,changed) tuple,
+                                    or None if the item could not be refreshed). Items that are not tracked are left out.
+    '''
+    # Sweeps always ask the websites for the latest data (see http_client.bypass_cache).
+    start = time.perf_counter()
+    unavailable = []
+    with storage.WorkingSet('statuses' if cat in ['anime','manga'] else 'prices',cat,names=names) as ws, bypass_cache():
+        rows = list(ws.rows.values())
+        if cat in ['physical','digital']:
+            # The games missing from the Steam batches use their store page.
+            prefetched = await gameprices_batch_async(cat,[(row['Name'],row['URL']) for row in rows])
+            results = await sweep(rows, lambda row: refresh_item_async(cat,row,ws,prefetched.get(row['URL'])), unavailable)
+        elif cat in ['ygo','pkmn','mtg']:
+            # Cards that are not in the results of their own search are skipped (they can't be refreshed); cards whose search failed are
+            # searched again.
+            prefetched = await cardprices_batch_async(cat,[row['Name'] for row in rows])
+            async def refresh(row):
+                if row['Name'] in prefetched and prefetched[row['Name']] is None:
+                    return None
+                return await refresh_item_async(cat,row,ws,prefetched.get(row['Name']))
+            results = await sweep(rows, refresh, unavailable)
+        else:
+            results = await sweep(rows, lambda row: refresh_item_async(cat,row,ws), unavailable)
+    report_sweep(cat,results,start,ws.skipped,unavailable)
+    return [(row['Name'],resultn) for (row,resultn) in zip(rows,results)]
+
+async def price_decrease_async(cat):
+    '''
+    Searches for price changes/discounts in every item listed in the tracking database (table "prices") that belongs to a certain category
+    (see refresh_batch_async).
+            
+            Parameters:
+                    cat (str): Category the item belongs to. Accepted values are:  'ygo','pkmn','mtg'; 'physical','digital'.
+
+            Returns: 
+                    msg_list (list): List of log messages.
+    '''
+    msg_list = []
+    for (n,resultn) in await refresh_batch_async(cat):
+        if resultn is not None:
+            msg_list += resultn[0]
 
     return msg_list
 
-def status_change(cat):
+def price_decrease(cat):
+    '''
+    Synchronous version of price_decrease_async (same parameters and return value).
+    '''
+    return run_sync(price_decrease_async(cat))
+
+async def status_change_async(cat):
     '''
-    Searches for status changes in every item listed in the tracking file "status_tracker.csv" that belongs to a certain category.
+    Searches for status changes in every item listed in the tracking database (table "statuses") that belongs to a certain category (see
+    refresh_batch_async).
             
             Parameters:
                     cat (str): Category the item belongs to. Accepted values are: 'anime', 'manga'.
@@ -502,30 +843,28 @@ def status_change(cat):
             Returns: 
                     msg_list (list): List of log messages.
     '''
-    type = 'episode' if cat == 'anime' else 'chapter'
-    df_prices = pd.read_csv("status_tracker.csv",delimiter="|")
-    df_cat = df_prices[df_prices['Category']==cat]
-    names = list(df_cat['Name'].unique())
     msg_list = []
-    for n in names:
-        try:
-            resultn = track(cat,n)
-            if resultn[1] != resultn[2]:
-                msg = "There is a new "+type+" of "+n+"! The status CHANGED from "+ str(resultn[2]) + " to "+str(resultn[1])+'.'
-                msg_list.append(msg)
-        except:
-            pass
+    for (n,resultn) in await refresh_batch_async(cat):
+        if resultn is not None:
+            msg_list += resultn[0]
 
     return msg_list
 
+def status_change(cat):
+    '''
+    Synchronous version of status_change_async (same parameters and return value).
+    '''
+    return run_sync(status_change_async(cat))
+
 # SHOW FUNCTIONS --------------------------------------------------------------------------------------------------------------
 
-def show_items(cat):
+def show_items(cat,guild_id=None):
     '''
     Shows all items registered in the tracking files that belong to a certain category.
             
             Parameters:
                     cat (str): Category the item belongs to. Accepted values are:  'ygo','pkmn','mtg'; 'physical','digital'; 'anime','manga'
+                    guild_id (int): If given, only the items tracked by this server are shown.
 
             Returns: 
                     msg_list (list): List of item names present in the tracking file.
@@ -534,17 +873,81 @@ def show_items(cat):
     games = ['physical','digital']
     animanga = ['anime','manga']
     if cat in tcgs+games:
-        df = pd.read_csv("price_tracker.csv",delimiter="|")
-        msg_list = list(df[df['Category'] == cat]['Name'])
+        msg_list = [row['Name'] for row in storage.list_prices(cat)]
     elif cat in animanga:
-        df = pd.read_csv("status_tracker.csv",delimiter="|")
-        msg_list = list(df[df['Category'] == cat]['Name'])
+        msg_list = [row['Name'] for row in storage.list_statuses(cat)]
+    if guild_id is not None:
+        tracked = guilds.items(guild_id,cat)
+        msg_list = [name for name in msg_list if name in tracked]
     
     return msg_list
+
+def show_history(cat,item,guild_id=None):
+    '''
+    Shows the recorded prices/statuses of a tracked item over the last storage.HISTORY_DAYS days.
+            
+            Parameters:
+                    cat (str): Category the item belongs to. Accepted values are:  'ygo','pkmn','mtg'; 'physical','digital'; 'anime','manga'
+                    item (str): Name of the item (exactly as is in the tracking file).
+                    guild_id (int): If given, only the items tracked by this server are shown.
+
+            Returns: 
+                    msg_list (list): List of messages: one per observation (at most the last 10) + a summary.
+    '''
+    animanga = ['anime','manga']
+    if guild_id is not None and item not in guilds.items(guild_id,cat):
+        return ['Item name is ambiguous. It should perfectly match the name of an item tracked in this server.']
+    rows = storage.history(cat,item)
+    if len(rows) == 0:
+        return ['No history found for '+item+'. It should perfectly match the name on the file.']
+
+    msg_list = []
+    for row in rows[-10:]:
+        date = datetime.fromtimestamp(row['Timestamp']).strftime("%m/%d/%Y, %H:%M")
+        if cat in animanga:
+            msg = date+': '+row['Status']
+        else:
+            msg = date+': '+str(row['Price'])+'€'
+            if row['Discount']:
+                msg = msg+' (on discount for '+row['Discount']+')'
+        msg_list.append(msg)
+
+    if cat in animanga:
+        values = [row['Status'] for row in rows]
+        changes = sum(1 for old,new in zip(values,values[1:]) if new != old)
+        msg_list.append(item+' was checked '+str(len(rows))+' times in the last '+str(storage.HISTORY_DAYS)+' days and its status changed '+str(changes)+' times.')
+    else:
+        values = [row['Price'] for row in rows]
+        drops = sum(1 for old,new in zip(values,values[1:]) if new < old)
+        msg_list.append(item+' was checked '+str(len(rows))+' times in the last '+str(storage.HISTORY_DAYS)+' days and its price dropped '+str(drops)+' times.')
+    return msg_list
+
+def show_lowest(cat,item,guild_id=None):
+    '''
+    Shows the lowest recorded price of a tracked card/game over the last storage.HISTORY_DAYS days.
+            
+            Parameters:
+                    cat (str): Category the item belongs to. Accepted values are:  'ygo','pkmn','mtg'; 'physical','digital'.
+                    item (str): Name of the item (exactly as is in the tracking file).
+                    guild_id (int): If given, only the items tracked by this server are shown.
+
+            Returns: 
+                    msg (str): Log message.
+    '''
+    if guild_id is not None and item not in guilds.items(guild_id,cat):
+        return 'Item name is ambiguous. It should perfectly match the name of an item tracked in this server.'
+    lowest = storage.lowest_price(cat,item)
+    if lowest is None:
+        return 'No prices found for '+item+'. It should perfectly match the name on the file.'
+    date = datetime.fromtimestamp(lowest[1]).strftime("%m/%d/%Y")
+    return 'The lowest price of '+item+' in the last '+str(storage.HISTORY_DAYS)+' days was '+str(lowest[0])+'€, on '+date+'.'
   
-def mtg_art(search):
+@coalesce
+async def mtg_art_async(search):
     '''
     Calls the Scryfall API to get card image data of a Magic the Gathering (MTG) card with name 'search'. Fuzzy search is allowed.
+    The name is first corrected with the local card index (see card_index.py), and the image URL of every card is memoized (see image_cache.py),
+    so repeated searches don't call the API again.
             
             Parameters:
                     search (str): Card name.
@@ -552,33 +955,85 @@ def mtg_art(search):
             Returns: 
                     img (str): URL to the card's image.
     '''
+    (name,msg) = card_index.resolve('mtg',search)
+    if name is None:
+        return msg
+    search = name
+    img = image_cache.get_url('mtg',search)
+    if img is not None:
+        return img
+
     call_url = "https://api.scryfall.com/cards/named?fuzzy="+search.replace(" ","+")
-    call_card = requests.get(call_url)
-    card_dict = json.loads(call_card.text)
+    (status,body) = await fetch(call_url)
 
-    if call_card.status_code == 404:
+    if status == 404:
         img = 'Ambiguous name “'+search+'”. Add more words to refine your search.'
     else:
+        card_dict = json.loads(body)
         img = card_dict['image_uris']['normal']
+        image_cache.put_url('mtg',search,img)
 
     return img
 
-def ygo_art(search):
+def mtg_art(search):
     '''
-    Calls the Yugiohprices API to get card image data of a Yu-Gi-Oh! (YGO) card with name 'search' (must match the name of the card exactly).
+    Synchronous version of mtg_art_async (same parameters and return value).
+    '''
+    return run_sync(mtg_art_async(search))
+
+@coalesce
+async def ygo_art_file_async(search):
+    '''
+    Calls the Yugiohprices API to get the image of a Yu-Gi-Oh! (YGO) card with name 'search' (must match the name of the card exactly, unless
+    the local card index can correct it - see card_index.py). The image is returned exactly as downloaded (it is never decoded or re-encoded) and is kept in the on-disk image cache, so repeated
+    searches are served without any network call (see image_cache.py).
             
             Parameters:
                     search (str): Card name.
 
             Returns: 
-                    img (JpegImageFile): Image byte data.
+                    img (tuple or str): (image bytes, file name) tuple, or an error message (str) if the card wasn't found.
     '''
+    (name,msg) = card_index.resolve('ygo',search)
+    if name is None:
+        return msg
+    search = name
+    img = image_cache.get_image('ygo',search)
+    if img is not None:
+        return img
+
     call_url = "http://yugiohprices.com/api/card_image/"+search
-    call_card = requests.get(call_url)
+    (status,body) = await fetch(call_url)
 
-    if call_card.status_code == 404:
+    if status == 404:
         img = 'Ambiguous name “'+search+'”. Add more words to refine your search.'
+    elif status != 200:
+        img = 'The image of “'+search+'” is not available right now. Please try again later.'
     else: 
-        img = Image.open(BytesIO(call_card.content))
+        img = (body, image_cache.put_image('ygo',search,body))
+
+    return img
+
+async def ygo_art_async(search):
+    '''
+    Calls the Yugiohprices API to get card image data of a Yu-Gi-Oh! (YGO) card with name 'search' (must match the name of the card exactly).
+    Use ygo_art_file_async to send the image to Discord without decoding it.
+            
+            Parameters:
+                    search (str): Card name.
+
+            Returns: 
+                    img (JpegImageFile): Image byte data (or an error message (str) if the card wasn't found).
+    '''
+    img = await ygo_art_file_async(search)
+    if isinstance(img, tuple):
+        from PIL import Image # Imported on first use, to keep Pheme's startup fast
+        img = Image.open(BytesIO(img[0]))
+
+    return img
 
-    return img
\ No newline at end of file
+def ygo_art(search):
+    '''
+    Synchronous version of ygo_art_async (same parameters and return value).
+    '''
+    return run_sync(ygo_art_async(search))
@@ -0,0 +1,404 @@
+'''
+Scraping worker processes. The 'track' and 'search' commands and the item checks of the scheduler are jobs: the bot process writes them to
+a queue in the database (table "jobs") and a pool of worker processes downloads and parses the pages, so that heavy scrapes never compete
+with the Discord gateway (heartbeats, commands) for the bot's event loop and CPU.
+
+A crashed worker is restarted, and the jobs it was running are queued again (at most MAX_ATTEMPTS times). With PHEME_WORKERS=0, the jobs
+run inside the bot process, as before.
+
+The processes share the per-host request rates and circuit breakers through the database (see http_client.share_state), and every job
+result carries the worker's metrics, response cache counters and sweep outcomes, which the bot process adds to its own (for /metrics,
+/health and 'stats pheme'). Each worker keeps its own response cache: identical jobs waiting at the same time are run once instead.
+
+The bot process and its workers talk through pipes: a line on a worker's stdin announces a new job, and a line on its stdout announces a
+result, so nobody polls the database.
+
+Usage (main.py starts the workers itself):
+        python workers.py
+'''
+# IMPORTS -------------------------------------------------------------------------------------------------------------------
+
+import asyncio
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import time
+import http_client
+import metrics
+import storage
+from singleflight import coalesce
+
+logger = logging.getLogger(__name__)
+
+# VARIABLES -----------------------------------------------------------------------------------------------------------------
+
+# Number of worker processes (0 = run the jobs in the bot process), and jobs run at the same time by each worker (the jobs are mostly
+# waiting for websites).
+WORKERS = int(os.getenv('PHEME_WORKERS', '2'))
+WORKER_CONCURRENCY = 8
+
+# A job is tried at most MAX_ATTEMPTS times if its worker dies while running it.
+MAX_ATTEMPTS = 3
+
+# Idle workers wake up when the bot process announces a job, or every IDLE_INTERVAL seconds. The bot process collects the results when a
+# worker announces them, or every SUPERVISE_INTERVAL seconds. Stopped workers are killed if they didn't exit after STOP_TIMEOUT seconds.
+IDLE_INTERVAL = 5.0
+SUPERVISE_INTERVAL = 5.0
+STOP_TIMEOUT = 5.0
+
+# A worker that can't save a job result because the database is busy tries again every BUSY_INTERVAL seconds.
+BUSY_INTERVAL = 1.0
+
+class JobFailed(Exception):
+    '''
+    Raised by WorkerPool.run when a job raised an error or its worker died MAX_ATTEMPTS times while running it.
+    '''
+
+# JOBS ----------------------------------------------------------------------------------------------------------------------
+
+async def run_job(kind,args):
+    '''
+    Runs one job (in a worker process, or in the bot process if there are no workers).
+
+            Parameters:
+                    kind (str): 'track' (args: category, search, subscriber), 'search' (args: category, search) or 'refresh' (args: category,
+                                item names).
+                    args (list): Arguments of the job.
+
+            Returns:
+                    result: Result of tracking.track_async, of the category's search function, or of tracking.refresh_batch_async.
+    '''
+    # Imported here, so the bot process doesn't import the scrapers when the jobs run in the workers
+    import tracking
+    if kind == 'track':
+        (category,search,subscriber) = args
+        return await tracking.track_async(category,search,1,subscriber=tuple(subscriber) if subscriber else None)
+    if kind == 'search':
+        (category,search) = args
+        if category in ['physical','digital']:
+            return await tracking.gameprices_async(category,search,1)
+        if category in ['ygo','pkmn','mtg']:
+            return await tracking.cardprices_async(category,search)
+        return await tracking.manga_anime_async(category,search)
+    if kind == 'refresh':
+        (category,names) = args
+        return await tracking.refresh_batch_async(category,names)
+    raise ValueError('Unknown job: '+kind)
+
+# REPORTS -------------------------------------------------------------------------------------------------------------------
+
+# Response cache counters sent with the reports
+CACHE_COUNTERS = ('hits', 'misses', 'revalidated', 'saved_seconds')
+
+def _report(last):
+    # What changed in this worker since its last report: metrics, response cache counters and the outcome of the sweeps. 'last' holds the
+    # values of the last report, and is updated.
+    (last['metrics'], changed) = metrics.changes(last.get('metrics', {}))
+    cache = http_client.cache
+    with cache.lock:
+        counters = {name: getattr(cache, name) for name in CACHE_COUNTERS}
+    report = {'metrics': changed, 'cache': {name: counters[name] - last.get('cache', {}).get(name, 0) for name in CACHE_COUNTERS}}
+    last['cache'] = counters
+    tracking = sys.modules.get('tracking')
+    if tracking is not None:
+        # cardprices_batch_async replaces the entries of the sweeps that ran, so only those are sent
+        sweeps = tracking.sweep_stats
+        report['sweep_stats'] = {tcg: sweep for (tcg, sweep) in sweeps.items() if last.get('sweep_stats', {}).get(tcg) is not sweep}
+        last['sweep_stats'] = dict(sweeps)
+        # report_sweep adds up the checks of each category (see tracking.add_sweep): what they added since the last report is sent
+        totals = tracking.sweep_results
+        before = last.get('sweep_results', {})
+        report['sweep_results'] = {cat: dict({name: total[name] - before.get(cat, {}).get(name, 0) for name in tracking.SWEEP_COUNTERS},
+                                             breakers=total['breakers']) for (cat, total) in totals.items() if before.get(cat) is not total}
+        last['sweep_results'] = dict(totals)
+    return report
+
+def absorb(report):
+    '''
+    Adds the report sent by a worker with a job result (see _report) to the metrics and counters of the bot process.
+    '''
+    metrics.merge(report['metrics'])
+    http_client.cache.count(**report['cache'])
+    if report.get('sweep_stats') or report.get('sweep_results'):
+        import tracking
+        tracking.sweep_stats.update(report['sweep_stats'])
+        for (cat, outcome) in report['sweep_results'].items():
+            tracking.add_sweep(cat, outcome)
+
+# QUEUE FUNCTIONS -----------------------------------------------------------------------------------------------------------
+# The bot process runs these in a thread (run_in_executor), so a busy database never blocks its event loop.
+
+def _queue(kind,args):
+    # Queues a job. Returns its id.
+    conn = storage.connect()
+    with conn:
+        return conn.execute('INSERT INTO jobs (Kind, Args, Created) VALUES (?, ?, ?)', (kind, json.dumps(args), time.time())).lastrowid
+
+def _take_finished():
+    # Removes the finished jobs from the queue (atomically, so every result is handed over once). Returns their rows.
+    conn = storage.connect()
+    with conn:
+        return conn.execute("DELETE FROM jobs WHERE State IN ('done', 'failed') RETURNING ID, State, Result, Error").fetchall()
+
+def _requeue(worker):
+    # Queues the jobs of a dead worker again, or fails them if they were tried MAX_ATTEMPTS times. Returns the number of jobs queued again.
+    conn = storage.connect()
+    with conn:
+        retried = conn.execute("UPDATE jobs SET State = 'queued' WHERE State = 'running' AND Worker = ? AND Attempts < ?",
+                               (worker, MAX_ATTEMPTS)).rowcount
+        conn.execute("UPDATE jobs SET State = 'failed', Error = 'the worker died ' || Attempts || ' times while running this job' "
+                     "WHERE State = 'running' AND Worker = ?", (worker,))
+    return retried
+
+# WORKER PROCESS ------------------------------------------------------------------------------------------------------------
+
+def _claim(conn,worker):
+    # Takes the oldest queued job (atomically, so two workers never take the same job). Returns its row or None. The cheap read comes first,
+    # so an idle worker doesn't write to the database.
+    if conn.execute("SELECT 1 FROM jobs WHERE State = 'queued' LIMIT 1").fetchone() is None:
+        return None
+    with conn:
+        return conn.execute("UPDATE jobs SET State = 'running', Worker = ?, Attempts = Attempts + 1 WHERE ID = "
+                            "(SELECT ID FROM jobs WHERE State = 'queued' ORDER BY ID LIMIT 1) RETURNING ID, Kind, Args", (worker,)).fetchone()
+
+async def _finish(conn,job_id,state,blob,error):
+    # Saves the outcome of a job in the queue, trying again while the database is busy (the caller would wait forever for a job that stays
+    # 'running' under a live worker).
+    while True:
+        try:
+            with conn:
+                conn.execute('UPDATE jobs SET State = ?, Result = ?, Error = ? WHERE ID = ?', (state, blob, error, job_id))
+            return
+        except sqlite3.OperationalError as exception:
+            if 'locked' not in str(exception) and 'busy' not in str(exception):
+                raise
+            logger.warning('Could not save the result of job %d (%s), retrying in %.0fs', job_id, exception, BUSY_INTERVAL)
+            await asyncio.sleep(BUSY_INTERVAL)
+
+async def _listen(wake):
+    # Sets 'wake' every time the bot process announces a new job (a line on stdin). Returns when the bot process is gone (end of stdin).
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    while await reader.readline():
+        wake.set()
+    wake.set()
+
+async def _serve(out):
+    # Main loop of a worker: runs up to WORKER_CONCURRENCY jobs at a time, writes their results to the queue and announces them on 'out'.
+    # Stops when the bot process that started it is gone.
+    conn = storage.connect()
+    worker = os.getpid()
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    wake = asyncio.Event()
+    listener = asyncio.ensure_future(_listen(wake))
+    last = {}
+
+    async def work(job):
+        try:
+            result = await run_job(job['Kind'], json.loads(job['Args']))
+            (state, error) = ('done', None)
+        except Exception as exception:
+            logger.exception('Job %d (%s) failed', job['ID'], job['Kind'])
+            (state, result, error) = ('failed', None, repr(exception))
+        finally:
+            slots.release()
+        try:
+            report = _report(last)
+            try:
+                blob = pickle.dumps((result, report))
+            except Exception as exception:
+                logger.exception('Result of job %d (%s) could not be saved', job['ID'], job['Kind'])
+                (state, blob, error) = ('failed', pickle.dumps((None, report)), repr(exception))
+            await _finish(conn, job['ID'], state, blob, error)
+        except Exception as exception:
+            logger.exception('Result of job %d (%s) could not be saved', job['ID'], job['Kind'])
+            await _finish(conn, job['ID'], 'failed', None, repr(exception))
+        finally:
+            # Always announced, so the bot process looks at the queue (and its caller never waits forever)
+            out.write(b'\n')
+
+    while not listener.done():
+        await slots.acquire()
+        # Cleared before looking at the queue, so a job announced in the meantime is not missed
+        wake.clear()
+        job = _claim(conn, worker)
+        if job is None:
+            slots.release()
+            try:
+                await asyncio.wait_for(wake.wait(), IDLE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        asyncio.ensure_future(work(job))
+
+def worker_main():
+    '''
+    Entry point of a worker process. The bot process writes a line to the worker's stdin when it queues a job, and the worker writes a line
+    to its stdout when a result is ready (anything else printed goes to stderr). The worker stops at the end of its stdin.
+    '''
+    logging.basicConfig(level=os.getenv('PHEME_LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s[%(process)d]: %(message)s')
+    out = os.fdopen(os.dup(1), 'wb', buffering=0)
+    os.dup2(2, 1)
+    http_client.share_state()
+    asyncio.run(_serve(out))
+
+# WORKER POOL ---------------------------------------------------------------------------------------------------------------
+
+class WorkerPool:
+    '''
+    Runs the jobs in worker processes: queues them in the database, restarts the workers that die and hands the results back to the callers.
+
+            Parameters:
+                    workers (int): Number of worker processes (0 = run the jobs in the bot process).
+    '''
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        # Worker process of every slot (None while it is being started)
+        self.processes = []
+        # Jobs waiting for their result: job id -> future
+        self.pending = {}
+        # One task per slot, watching its worker (see _watch)
+        self.tasks = []
+        # Held while a job is queued and while the results are handed over, so a result never arrives before its future is registered
+        self.lock = asyncio.Lock()
+        # Counters: jobs queued, jobs queued again after their worker died, and workers restarted
+        self.jobs = 0
+        self.retried = 0
+        self.restarts = 0
+
+    def start(self):
+        '''
+        Starts the workers and their supervision on the running event loop (only once). The jobs that were running when Pheme stopped are
+        queued again.
+        '''
+        if self.tasks or self.workers <= 0:
+            return
+        conn = storage.connect()
+        with conn:
+            conn.execute("UPDATE jobs SET State = 'queued' WHERE State = 'running'")
+            # Results that nobody is waiting for anymore
+            conn.execute("DELETE FROM jobs WHERE State IN ('done', 'failed')")
+        http_client.share_state()
+        self.processes = [None] * self.workers
+        self.tasks = [asyncio.ensure_future(self._watch(slot)) for slot in range(self.workers)]
+
+    @staticmethod
+    async def _spawn():
+        # A fresh interpreter (not a fork of the bot process, with its Discord connection and threads)
+        return await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.PIPE)
+
+    async def stop(self):
+        '''
+        Stops the workers and waits until they exited (they are killed after STOP_TIMEOUT seconds). Their running jobs are queued again the
+        next time the pool starts.
+        '''
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        processes = [process for process in self.processes if process is not None and process.returncode is None]
+        self.processes = []
+        for process in processes:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+        for process in processes:
+            try:
+                await asyncio.wait_for(process.wait(), STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning('Worker %d did not stop within %ds: killing it', process.pid, STOP_TIMEOUT)
+                process.kill()
+                await process.wait()
+
+    @coalesce
+    async def run(self, kind, *args):
+        '''
+        Runs a job and returns its result (see run_job). Raises JobFailed if the job failed. An identical job that is already waiting for its
+        result is joined instead of being queued again.
+        '''
+        if not self.tasks:
+            return await run_job(kind, args)
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            job_id = await loop.run_in_executor(None, _queue, kind, args)
+            future = loop.create_future()
+            self.pending[job_id] = future
+        self.jobs += 1
+        self._notify()
+        try:
+            return await future
+        finally:
+            self.pending.pop(job_id, None)
+
+    def queued(self):
+        '''
+        Returns the number of jobs waiting for a worker.
+        '''
+        return storage.connect().execute("SELECT COUNT(*) FROM jobs WHERE State = 'queued'").fetchone()[0]
+
+    def _notify(self):
+        # Wakes the idle workers up (see _listen): a job was queued
+        for process in self.processes:
+            if process is not None and process.returncode is None:
+                try:
+                    process.stdin.write(b'\n')
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+    async def _collect(self):
+        # Hands the finished jobs to their callers, and adds the workers' reports (see absorb)
+        async with self.lock:
+            rows = await asyncio.get_running_loop().run_in_executor(None, _take_finished)
+            for row in rows:
+                (result, report) = pickle.loads(row['Result']) if row['Result'] is not None else (None, None)
+                if report is not None:
+                    absorb(report)
+                future = self.pending.pop(row['ID'], None)
+                if future is not None and not future.done():
+                    if row['State'] == 'done':
+                        future.set_result(result)
+                    else:
+                        future.set_exception(JobFailed(row['Error']))
+
+    async def _watch(self, slot):
+        # Runs the worker of a slot: collects the results it announces, and restarts it when it dies (its jobs are queued again). Every
+        # SUPERVISE_INTERVAL seconds, the results are collected anyway (in case an announcement was lost). Errors (ex: a locked database)
+        # are logged and the watch goes on, so the callers never wait forever.
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                process = self.processes[slot]
+                if process is None:
+                    process = self.processes[slot] = await self._spawn()
+                try:
+                    line = await asyncio.wait_for(process.stdout.readline(), SUPERVISE_INTERVAL)
+                except asyncio.TimeoutError:
+                    if self.pending:
+                        await self._collect()
+                    continue
+                if line:
+                    await self._collect()
+                    continue
+                # End of its stdout: the worker died
+                await process.wait()
+                logger.warning('Worker %d died (exit code %s): restarting it', process.pid, process.returncode)
+                self.processes[slot] = None
+                self.restarts += 1
+                self.retried += await loop.run_in_executor(None, _requeue, process.pid)
+                await self._collect()
+                self._notify()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Supervision of worker slot %d failed', slot)
+                await asyncio.sleep(SUPERVISE_INTERVAL)
+
+pool = WorkerPool()
+
+if __name__ == '__main__':
+    worker_main()